@@ -0,0 +1,100 @@
+"""
+Micro-benchmark del codec de mensajes.
+
+Compara, para cada tipo de mensaje del protocolo, el formato anterior (contenido
+JSON dentro de otro JSON, timestamps ISO y datetime.fromisoformat al recibir)
+con el codec binario y con su modo JSON de depuración: microsegundos por
+codificación y decodificación, y bytes en la red por frame.
+
+Uso:
+    python bench_codec.py [iteraciones]
+"""
+import json
+import sys
+import time
+import timeit
+from datetime import datetime
+
+from nodes import encode_ack, encode_frame, encode_message, decode_message
+
+
+def sample_messages():
+    """Un mensaje representativo de cada tipo: {nombre: (contenido, msg_id)}"""
+    return {
+        'REQUEST': {'type': 'REQUEST', 'resource': 42, 'request_id': '3-1207', 'clock': 1834, 'origin': 3},
+        'REPLY': {'type': 'REPLY', 'resource': 42, 'request_id': '3-1207', 'clock': 1836, 'origin': 1},
+        'INVENTORY_UPDATE': {'type': 'INVENTORY_UPDATE', 'item_id': 42, 'new_quantity': 17,
+                             'version': 311, 'origin': 3},
+        'CHAT': 'Hola, ¿hay stock del artículo 42?',
+    }
+
+
+def legacy_encode(content, msg_id):
+    """Formato anterior: contenido serializado y luego el mensaje completo otra vez"""
+    if isinstance(content, dict):
+        content = json.dumps(dict(content, timestamp=datetime.now().isoformat()))
+    message = {'destination': 5001, 'content': content, 'msg_id': msg_id, 'origin': 3,
+               'timestamp': datetime.now().isoformat()}
+    return encode_frame(json.dumps(message).encode('utf-8'))
+
+
+def legacy_decode(frame):
+    message = json.loads(frame[4:].decode('utf-8'))
+    datetime.fromisoformat(message['timestamp'])
+    try:
+        json.loads(message['content'])
+    except ValueError:
+        pass  # Texto de chat
+    return message
+
+
+def codec_encode(codec):
+    def encode(content, msg_id):
+        message = {'destination': 5001, 'content': content, 'msg_id': msg_id, 'origin': 3,
+                   'timestamp': time.time_ns()}
+        return encode_frame(encode_message(message, codec))
+    return encode
+
+
+def codec_decode(frame):
+    return decode_message(frame[4:])
+
+
+def measure(encode, decode, content, iterations):
+    """Devuelve (µs por codificación, µs por decodificación, bytes por frame)"""
+    frame = encode(content, 1207)
+    encode_us = timeit.timeit(lambda: encode(content, 1207), number=iterations) / iterations * 1e6
+    decode_us = timeit.timeit(lambda: decode(frame), number=iterations) / iterations * 1e6
+    return encode_us, decode_us, len(frame)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    formats = {
+        'legacy': (legacy_encode, legacy_decode),
+        'binary': (codec_encode('binary'), codec_decode),
+        'json': (codec_encode('json'), codec_decode),
+    }
+    messages = sample_messages()
+
+    print(f"{iterations} iterations per measurement")
+    print(f"{'message':<18}{'format':<8}{'encode µs':>11}{'decode µs':>11}{'bytes':>8}")
+    for name, content in messages.items():
+        for format_name, (encode, decode) in formats.items():
+            encode_us, decode_us, size = measure(encode, decode, content, iterations)
+            print(f"{name:<18}{format_name:<8}{encode_us:>11.2f}{decode_us:>11.2f}{size:>8}")
+
+    # Los ACK son frames propios: antes un dict JSON, ahora msg_id en un encabezado fijo
+    legacy_ack = lambda _, msg_id: encode_frame(json.dumps({'type': 'ACK', 'ack': msg_id}).encode('utf-8'))
+    ack_formats = {
+        'legacy': (legacy_ack, lambda frame: json.loads(frame[4:])),
+        'binary': (lambda _, msg_id: encode_frame(encode_ack(msg_id)), codec_decode),
+        'json': (lambda _, msg_id: encode_frame(encode_ack(msg_id, 'json')), codec_decode),
+    }
+    for format_name, (encode, decode) in ack_formats.items():
+        encode_us, decode_us, size = measure(encode, decode, None, iterations)
+        print(f"{'ACK':<18}{format_name:<8}{encode_us:>11.2f}{decode_us:>11.2f}{size:>8}")
+
+
+if __name__ == "__main__":
+    main()
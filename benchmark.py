@@ -0,0 +1,352 @@
+"""
+Banco de pruebas en loopback para un clúster de nodos.
+
+Levanta N instancias de Node en 127.0.0.1 con puertos libres y bases temporales
+(en hilos de este proceso o en procesos separados) y ejecuta cargas con guion:
+
+    send       send_message con ACK, repartido entre los demás nodos
+    purchase   purchase_items (exclusión mutua con request_critical_section)
+    queued     queue_purchase: con --concurrency > 1 los pedidos simultáneos comparten
+               una entrada a la sección crítica
+    propagate  update_inventory + propagate_inventory_update; a mitad de la carga
+               se detienen --kill nodos para medir cómo sigue la difusión
+
+Para cada carga informa latencia p50/p95/p99, operaciones por segundo, mensajes
+y bytes por operación en formato JSON, para comparar corridas entre sí.
+
+Uso:
+    python benchmark.py --nodes 5 --workload all --ops 500 --kill 1 --output run.json
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from nodes import Node
+
+ITEMS = 16
+INITIAL_STOCK = 10 ** 6
+
+
+def find_base_port(count, attempts=50):
+    """Busca `count` puertos libres consecutivos (los nodos usan base_port + id)"""
+    for _ in range(attempts):
+        base = random.randint(20000, 60000 - count)
+        sockets = []
+        try:
+            for port in range(base, base + count):
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sockets.append(s)
+                s.bind(('127.0.0.1', port))
+            return base
+        except OSError:
+            continue
+        finally:
+            for s in sockets:
+                s.close()
+    raise RuntimeError(f"No free block of {count} ports found")
+
+
+def percentile(sorted_values, fraction):
+    """Percentil por rango más cercano de una lista ya ordenada"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, ok, duration, traffic_before, traffic_after):
+    """Resumen de una carga: latencias en ms, throughput y tráfico por operación"""
+    ops = len(latencies)
+    values = sorted(latency * 1000 for latency in latencies)
+    messages = traffic_after['messages_sent'] - traffic_before['messages_sent']
+    wire_bytes = traffic_after['bytes_sent'] - traffic_before['bytes_sent']
+    return {
+        'ops': ops,
+        'ok': ok,
+        'failed': ops - ok,
+        'duration_s': round(duration, 4),
+        'ops_per_s': round(ops / duration, 2) if duration > 0 else None,
+        'latency_ms': {
+            'p50': round(percentile(values, 0.50), 3) if values else None,
+            'p95': round(percentile(values, 0.95), 3) if values else None,
+            'p99': round(percentile(values, 0.99), 3) if values else None,
+            'max': round(values[-1], 3) if values else None,
+            'mean': round(sum(values) / ops, 3) if values else None,
+        },
+        'messages_per_op': round(messages / ops, 2) if ops else None,
+        'bytes_per_op': round(wire_bytes / ops, 1) if ops else None,
+    }
+
+
+def _node_options(args):
+    return {
+        'runtime': args.runtime,
+        'codec': args.codec,
+        'replication': args.replication,
+        'dissemination': args.dissemination,
+        'batch_window': args.batch_window,
+        'heartbeat_interval': args.heartbeat_interval,
+        'archive_interval': None,
+        'log_level': args.log_level,
+    }
+
+
+def _make_node(node_id, base_port, count, db_dir, options, ready):
+    peers = {base_port + i: '127.0.0.1' for i in range(count) if i != node_id}
+    node = Node(node_id, base_port + node_id, peers, node_ip='127.0.0.1', server_ready_event=ready,
+                base_port=base_port, db_path=os.path.join(db_dir, f"node_{node_id}.db"), **options)
+    threading.Thread(target=node.start_server, daemon=True).start()
+    return node
+
+
+def _seed(node):
+    for item_id in range(ITEMS):
+        node.inventory.ensure(item_id, f"item-{item_id}", 1.0, INITIAL_STOCK)
+    if node.crdt is not None:
+        # Node sembró los contadores al arrancar, con el catálogo aún vacío
+        node.crdt.seed()
+
+
+def _process_main(node_id, base_port, count, db_dir, options, conn):
+    """Nodo en un proceso aparte; obedece órdenes simples por el pipe"""
+    sys.stdout = open(os.devnull, 'w')
+    ready = threading.Event()
+    node = _make_node(node_id, base_port, count, db_dir, options, ready)
+    ready.wait()
+    _seed(node)
+    conn.send('ready')
+    while True:
+        command = conn.recv()
+        if command == 'traffic':
+            conn.send(dict(node.traffic))
+        elif command == 'stop':
+            node.shutdown()
+            conn.send('stopped')
+            return
+
+
+class Cluster:
+    """Nodos del banco: el nodo 0 (conductor) vive en este proceso, los demás en hilos o procesos"""
+    def __init__(self, count, mode, options):
+        self.count = count
+        self.mode = mode
+        self.base_port = find_base_port(count)
+        self.db_dir = tempfile.mkdtemp(prefix='node-bench-')
+        self.nodes = {}  # {id: Node} en este proceso
+        self.processes = {}  # {id: (Process, Pipe)}
+        self.stopped = set()
+        self.final_traffic = {}  # {id: tráfico del nodo al momento de detenerlo}
+
+        for node_id in range(1, count):
+            if mode == 'process':
+                parent, child = multiprocessing.Pipe()
+                process = multiprocessing.get_context('spawn').Process(
+                    target=_process_main, args=(node_id, self.base_port, count, self.db_dir, options, child),
+                    daemon=True
+                )
+                process.start()
+                self.processes[node_id] = (process, parent)
+            else:
+                ready = threading.Event()
+                self.nodes[node_id] = _make_node(node_id, self.base_port, count, self.db_dir, options, ready)
+                ready.wait()
+                _seed(self.nodes[node_id])
+        for process, conn in self.processes.values():
+            conn.recv()
+        ready = threading.Event()
+        self.driver = self.nodes[0] = _make_node(0, self.base_port, count, self.db_dir, options, ready)
+        ready.wait()
+        _seed(self.driver)
+        if options.get('replication') == 'log':
+            # Las cargas se miden con un líder ya elegido
+            while self.driver.log_status()['leader'] is None:
+                time.sleep(0.05)
+
+    def stock(self):
+        """Unidades en el inventario del conductor"""
+        return sum(quantity for quantity, _ in self.driver.inventory.items().values())
+
+    def peers(self):
+        return [self.base_port + node_id for node_id in range(1, self.count) if node_id not in self.stopped]
+
+    def traffic(self):
+        """Tráfico sumado de todos los nodos (los detenidos cuentan hasta el momento de su caída)"""
+        total = {'messages_sent': 0, 'bytes_sent': 0, 'messages_received': 0, 'bytes_received': 0}
+        parts = list(self.final_traffic.values())
+        parts += [node.traffic for node_id, node in self.nodes.items() if node_id not in self.stopped]
+        for node_id, (_, conn) in self.processes.items():
+            if node_id not in self.stopped:
+                conn.send('traffic')
+                parts.append(conn.recv())
+        for part in parts:
+            for key in total:
+                total[key] += part[key]
+        return total
+
+    def stop_node(self, node_id):
+        """Detiene un nodo (el proceso se termina; en hilos se llama a shutdown)"""
+        if node_id in self.processes:
+            process, conn = self.processes[node_id]
+            conn.send('traffic')
+            self.final_traffic[node_id] = conn.recv()
+            self.stopped.add(node_id)
+            process.terminate()
+            process.join()
+        else:
+            self.final_traffic[node_id] = dict(self.nodes[node_id].traffic)
+            self.stopped.add(node_id)
+            self.nodes[node_id].shutdown()
+
+    def close(self):
+        for node_id in range(self.count):
+            if node_id not in self.stopped:
+                if node_id in self.processes:
+                    _, conn = self.processes[node_id]
+                    conn.send('stop')
+                    conn.recv()
+                    self.processes[node_id][0].join()
+                else:
+                    self.nodes[node_id].shutdown()
+                self.stopped.add(node_id)
+        shutil.rmtree(self.db_dir, ignore_errors=True)
+
+
+def run_workload(cluster, operation, ops, concurrency, between=None):
+    """
+    Ejecuta `ops` llamadas a operation(i) -> bool con `concurrency` hilos.
+    `between` (opcional) se invoca una vez cuando se completó la mitad de las operaciones.
+    """
+    latencies = [None] * ops
+    results = [False] * ops
+    counter = iter(range(ops))
+    lock = threading.Lock()
+    done = {'count': 0, 'fired': between is None}
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            started = time.perf_counter()
+            try:
+                results[i] = bool(operation(i))
+            except Exception:
+                results[i] = False
+            latencies[i] = time.perf_counter() - started
+            with lock:
+                done['count'] += 1
+                fire = not done['fired'] and done['count'] >= ops // 2
+                if fire:
+                    done['fired'] = True
+            if fire:
+                between()
+
+    before = cluster.traffic()
+    stock_before = cluster.stock()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+    duration = time.perf_counter() - started
+    time.sleep(0.2)  # Dejar que terminen las entregas en segundo plano antes de contar
+    result = summarize(latencies, sum(results), duration, before, cluster.traffic())
+    # Cambio de stock visto por el conductor: una carga que vende y no lo mueve no midió nada
+    result['stock_change'] = cluster.stock() - stock_before
+    return result
+
+
+def bench_send(cluster, args):
+    peers = cluster.peers()
+
+    def operation(i):
+        return cluster.driver.send_message(
+            {'destination': peers[i % len(peers)], 'content': f"bench {i}"}, wait_ack=True
+        )
+    return run_workload(cluster, operation, args.ops, args.concurrency)
+
+
+def bench_purchase(cluster, args):
+    def operation(i):
+        return cluster.driver.purchase_items({random.randrange(ITEMS): 1}, timeout=args.timeout)
+    return run_workload(cluster, operation, args.ops, args.concurrency)
+
+
+def bench_queued(cluster, args):
+    def operation(i):
+        return cluster.driver.queue_purchase({random.randrange(ITEMS): 1}, timeout=args.timeout)
+    return run_workload(cluster, operation, args.ops, args.concurrency)
+
+
+def bench_propagate(cluster, args):
+    victims = list(range(cluster.count - 1, 0, -1))[:args.kill]
+
+    def operation(i):
+        return cluster.driver.update_inventory(i % ITEMS, -1)
+
+    def kill():
+        for node_id in victims:
+            cluster.stop_node(node_id)
+    result = run_workload(cluster, operation, args.ops, args.concurrency, between=kill if victims else None)
+    result['killed_nodes'] = victims
+    return result
+
+
+WORKLOADS = {'send': bench_send, 'purchase': bench_purchase, 'queued': bench_queued, 'propagate': bench_propagate}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Loopback benchmark for the distributed inventory nodes")
+    parser.add_argument('--nodes', type=int, default=4)
+    parser.add_argument('--mode', choices=('thread', 'process'), default='thread')
+    parser.add_argument('--workload', choices=(*WORKLOADS, 'all'), default='all')
+    parser.add_argument('--ops', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--kill', type=int, default=0, help="Nodes stopped halfway through 'propagate'")
+    parser.add_argument('--timeout', type=float, default=5.0)
+    parser.add_argument('--runtime', choices=('thread', 'asyncio'), default='thread')
+    parser.add_argument('--codec', choices=('binary', 'json'), default='binary')
+    parser.add_argument('--replication', choices=('version', 'crdt', 'log'), default='version')
+    parser.add_argument('--dissemination', choices=('direct', 'gossip', 'tree'), default='direct',
+                        help="How inventory updates spread; gossip and tree still confirm on a majority of receipts")
+    parser.add_argument('--batch-window', type=float, default=0.002)
+    parser.add_argument('--heartbeat-interval', type=float, default=0.5)
+    parser.add_argument('--log-level', default='INFO', help="Node log level (per-message logs are sampled)")
+    parser.add_argument('--output', help="Write the JSON report to this file as well")
+    args = parser.parse_args(argv)
+    if args.nodes < 2:
+        parser.error("--nodes must be at least 2")
+
+    names = list(WORKLOADS) if args.workload == 'all' else [args.workload]
+    report = {'config': vars(args), 'workloads': {}}
+    # La salida de los nodos es muy verbosa: sólo el reporte va a stdout
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        cluster = Cluster(args.nodes, args.mode, _node_options(args))
+        try:
+            for name in names:
+                report['workloads'][name] = WORKLOADS[name](cluster, args)
+            # Histogramas del nodo conductor: espera del candado, de la mayoría, commits, codec...
+            report['driver_latency'] = cluster.driver.metrics.snapshot()['latency']
+        finally:
+            cluster.close()
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    return report
+
+
+if __name__ == "__main__":
+    main()
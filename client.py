@@ -0,0 +1,164 @@
+"""
+Cliente programático de la API de un nodo (Node(client_port=...) o CLIENT_PORT).
+
+Sin input(): compras de uno o varios artículos, lotes de pedidos, reposición y
+consultas de inventario. Las peticiones viajan como frames JSON con un ID; se pueden
+tener muchas en vuelo sobre la misma conexión (pipelining) y cada respuesta resuelve
+el Future de su petición aunque lleguen en otro orden.
+
+Uso como librería:
+    with NodeClient(6001) as client:
+        client.purchase({3: 1})
+        futures = [client.submit('purchase', order={3: 1}) for _ in range(100)]
+        results = [f.result() for f in futures]
+
+Uso desde la línea de comandos:
+    python client.py --port 6001 query
+    python client.py --port 6001 purchase 3:2 7:1
+    python client.py --port 6001 restock 3 50
+"""
+import argparse
+import itertools
+import json
+import socket
+import threading
+from concurrent.futures import Future
+
+from nodes import FrameReader, encode_frame
+
+
+class NodeClientError(Exception):
+    """Error devuelto por el nodo para una petición"""
+
+
+class NodeClient:
+    """Conexión persistente a la API de clientes de un nodo"""
+    def __init__(self, port, host='127.0.0.1', timeout=5.0):
+        """
+        Args:
+            port: Puerto de la API (client_port del nodo)
+            host: Dirección del nodo; la API sólo escucha en la interfaz local
+            timeout: Tiempo (s) que el nodo espera los candados de cada compra
+        """
+        self.timeout = timeout
+        self.sock = socket.create_connection((host, port))
+        self._ids = itertools.count(1)
+        self._pending = {}  # {id: Future} de las peticiones en vuelo
+        self._lock = threading.Lock()
+        self._closed = False
+        threading.Thread(target=self._read_responses, daemon=True).start()
+
+    def _read_responses(self):
+        """Resuelve los Futures con las respuestas, en el orden en que lleguen"""
+        error = ConnectionError("Connection to node closed")
+        try:
+            for payload in FrameReader(self.sock):
+                response = json.loads(payload)
+                with self._lock:
+                    future = self._pending.pop(response.get('id'), None)
+                if future is None:
+                    continue
+                if 'error' in response:
+                    future.set_exception(NodeClientError(response['error']))
+                else:
+                    future.set_result(response.get('result'))
+        except (OSError, ValueError) as e:
+            error = e
+        with self._lock:
+            self._closed = True
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(error)
+
+    def submit(self, op, **params):
+        """Envía una petición sin esperar la respuesta; devuelve un Future con su resultado"""
+        request_id = next(self._ids)
+        request = dict(params, id=request_id, op=op)
+        request.setdefault('timeout', self.timeout)
+        future = Future()
+        frame = encode_frame(json.dumps(request).encode('utf-8'))
+        with self._lock:
+            if self._closed:
+                raise ConnectionError("Connection to node closed")
+            self._pending[request_id] = future
+            # Los frames se escriben enteros y en orden: el lector del nodo no los mezcla
+            self.sock.sendall(frame)
+        return future
+
+    def call(self, op, **params):
+        """Envía una petición y espera su resultado"""
+        return self.submit(op, **params).result()
+
+    def purchase(self, order):
+        """Compra {item_id: cantidad} como un pedido; True si se compró todo"""
+        return self.call('purchase', order=order)
+
+    def purchase_many(self, orders):
+        """Varios pedidos en una sola petición (una entrada a la sección crítica); un bool por pedido"""
+        return self.call('purchase_batch', orders=orders)
+
+    def restock(self, item_id, quantity):
+        """Repone `quantity` unidades de un artículo"""
+        return self.call('restock', item_id=item_id, quantity=quantity)
+
+    def query(self, item_id=None):
+        """Inventario del nodo (o un solo artículo) como {item_id: {name, quantity, price, version}}"""
+        return {int(key): value for key, value in self.call('query', item_id=item_id).items()}
+
+    def stats(self):
+        """Métricas del nodo (las mismas que GET /stats)"""
+        return self.call('stats')
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _parse_order(items):
+    """['3:2', '7'] -> {3: 2, 7: 1}"""
+    order = {}
+    for item in items:
+        item_id, _, quantity = item.partition(':')
+        order[int(item_id)] = order.get(int(item_id), 0) + int(quantity or 1)
+    return order
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Client for the node API")
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--timeout', type=float, default=5.0)
+    commands = parser.add_subparsers(dest='command', required=True)
+    query = commands.add_parser('query', help="Show the inventory (or one item)")
+    query.add_argument('item_id', type=int, nargs='?')
+    purchase = commands.add_parser('purchase', help="Purchase items as one order: ITEM[:QTY] ...")
+    purchase.add_argument('items', nargs='+')
+    restock = commands.add_parser('restock', help="Add stock to an item")
+    restock.add_argument('item_id', type=int)
+    restock.add_argument('quantity', type=int)
+    commands.add_parser('stats', help="Show the node metrics")
+    args = parser.parse_args(argv)
+
+    with NodeClient(args.port, args.host, args.timeout) as client:
+        if args.command == 'query':
+            result = client.query(args.item_id)
+        elif args.command == 'purchase':
+            result = client.purchase(_parse_order(args.items))
+        elif args.command == 'restock':
+            result = client.restock(args.item_id, args.quantity)
+        else:
+            result = client.stats()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,199 +3,3721 @@ Communication System between Nodes - Versión Corregida
 Implementación de un sistema distribuido con confirmación de mensajes
 """
 import os
+import asyncio
+import gzip
 import socket
 import threading
 import json
-from datetime import datetime
+import hashlib
+import heapq
+import bisect
+import itertools
+import math
+import random
+import queue
+import logging
+import logging.handlers
+import sys
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import sqlite3
+import struct
 import time
 
+logger = logging.getLogger('nodes')
+
+# Mensajes de control que no se registran en el historial
+UNLOGGED_TYPES = frozenset(('HEARTBEAT', 'LOG_APPEND', 'LOG_APPEND_RESULT', 'LOG_VOTE_REQUEST', 'LOG_VOTE',
+                            'RUMOR_RECEIPT'))
+# Mensajes que no cuentan en el tráfico del protocolo (Node.traffic)
+UNCOUNTED_TYPES = frozenset(('HEARTBEAT',))
+
+# Tamaño de los rangos de item_id que resume cada hash del digest de sincronización
+SYNC_BUCKET_SIZE = 32
+
+# Protocolo de red: cada mensaje va precedido de su longitud (4 bytes, big-endian)
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def encode_frame(payload):
+    """Antepone el prefijo de longitud a un payload en bytes"""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame too large: {len(payload)} bytes")
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+# Codec de mensajes: un encabezado fijo y un cuerpo binario según el tipo.
+# Los payloads que empiezan por '{' son JSON (modo depuración) y se aceptan siempre.
+WIRE_VERSION = 1
+WIRE_JSON = ord('{')
+# versión, tipo, nodo origen, puerto destino, msg_id, timestamp (ns desde epoch)
+ENVELOPE = struct.Struct('!BBIIQq')
+ACK_ENVELOPE = struct.Struct('!BBQ')  # versión, tipo, msg_id confirmado
+CLOCK_BODY = struct.Struct('!q')
+INVENTORY_BODY = struct.Struct('!qqq')  # item_id, new_quantity, version
+KEY_TAG = struct.Struct('!B')
+KEY_INT = struct.Struct('!q')
+KEY_STR = struct.Struct('!H')
+KIND_TEXT, KIND_JSON, KIND_REQUEST, KIND_REPLY, KIND_INVENTORY_UPDATE, KIND_ACK = range(6)
+# Campos que viajan en el cuerpo binario; un contenido con otros campos va como KIND_JSON
+LOCK_FIELDS = frozenset(('type', 'resource', 'request_id', 'clock', 'origin'))
+INVENTORY_FIELDS = frozenset(('type', 'item_id', 'new_quantity', 'version', 'origin'))
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+UINT32_MAX, UINT64_MAX = 2 ** 32 - 1, 2 ** 64 - 1
+
+
+def timestamp_to_iso(timestamp_ns):
+    """Convierte un timestamp en nanosegundos desde epoch a ISO 8601 (hora local)"""
+    seconds, nanos = divmod(timestamp_ns, 1_000_000_000)
+    return datetime.fromtimestamp(seconds).replace(microsecond=nanos // 1000).isoformat()
+
+
+def content_to_text(content):
+    """Texto con el que se guarda un contenido en el log: JSON para los dicts del protocolo"""
+    return content if isinstance(content, str) or content is None else json.dumps(content)
+
+
+def _is_int(value, low=INT64_MIN, high=INT64_MAX):
+    """True si `value` es un int (no bool) que cabe en [low, high]"""
+    return type(value) is int and low <= value <= high
+
+
+def _is_key(value):
+    """True si _pack_key puede codificar `value` sin perder su tipo"""
+    return value is None or _is_int(value) or (type(value) is str and len(value.encode('utf-8')) <= 0xFFFF)
+
+
+def _pack_key(value):
+    """Codifica un valor None, int o str (recursos e IDs de solicitud)"""
+    if value is None:
+        return KEY_TAG.pack(0)
+    if isinstance(value, int):
+        return KEY_TAG.pack(1) + KEY_INT.pack(value)
+    data = str(value).encode('utf-8')
+    return KEY_TAG.pack(2) + KEY_STR.pack(len(data)) + data
+
+
+def _unpack_key(buffer, offset):
+    """Decodifica un valor de _pack_key; devuelve (valor, nuevo offset)"""
+    (tag,) = KEY_TAG.unpack_from(buffer, offset)
+    offset += KEY_TAG.size
+    if tag == 0:
+        return None, offset
+    if tag == 1:
+        return KEY_INT.unpack_from(buffer, offset)[0], offset + KEY_INT.size
+    (length,) = KEY_STR.unpack_from(buffer, offset)
+    offset += KEY_STR.size
+    return bytes(buffer[offset:offset + length]).decode('utf-8'), offset + length
+
+
+def encode_message(message, codec='binary'):
+    """
+    Serializa un mensaje {'origin', 'destination', 'msg_id', 'timestamp', 'content'}.
+    `content` es un dict del protocolo o un texto de chat; `timestamp` está en ns desde epoch.
+    Con codec='json' se produce JSON legible (una sola codificación) para depurar.
+    Un campo que no cabe en su formato binario (None, bool, fuera de rango) no lanza
+    struct.error: el cuerpo va como KIND_JSON, o el mensaje entero como JSON si es el
+    encabezado el que no cabe.
+    """
+    if codec == 'json' or not (
+            _is_int(message['origin'], 0, UINT32_MAX) and _is_int(message['destination'], 0, UINT32_MAX)
+            and _is_int(message['msg_id'], 0, UINT64_MAX) and _is_int(message['timestamp'])):
+        return json.dumps(message).encode('utf-8')
+    content = message['content']
+    if isinstance(content, str):
+        kind, body = KIND_TEXT, content.encode('utf-8')
+    else:
+        msg_type = content.get('type')
+        if msg_type in ('REQUEST', 'REPLY') and content.keys() <= LOCK_FIELDS and _is_int(content.get('clock')) \
+                and _is_key(content.get('resource')) and _is_key(content.get('request_id')):
+            kind = KIND_REQUEST if msg_type == 'REQUEST' else KIND_REPLY
+            body = (CLOCK_BODY.pack(content['clock']) + _pack_key(content.get('resource'))
+                    + _pack_key(content.get('request_id')))
+        elif msg_type == 'INVENTORY_UPDATE' and content.keys() <= INVENTORY_FIELDS \
+                and all(_is_int(content.get(field)) for field in ('item_id', 'new_quantity', 'version')):
+            kind = KIND_INVENTORY_UPDATE
+            body = INVENTORY_BODY.pack(content['item_id'], content['new_quantity'], content['version'])
+        else:
+            kind, body = KIND_JSON, json.dumps(content, separators=(',', ':')).encode('utf-8')
+    return ENVELOPE.pack(WIRE_VERSION, kind, message['origin'], message['destination'],
+                         message['msg_id'], message['timestamp']) + body
+
+
+def encode_ack(msg_id, codec='binary'):
+    """Payload del ACK de un mensaje procesado"""
+    if codec == 'json':
+        return json.dumps({'type': 'ACK', 'ack': msg_id}).encode('utf-8')
+    return ACK_ENVELOPE.pack(WIRE_VERSION, KIND_ACK, msg_id)
+
+
+def decode_message(payload):
+    """
+    Deserializa un payload de encode_message o encode_ack (binario o JSON).
+    Los ACK se devuelven como {'type': 'ACK', 'ack': msg_id}.
+    """
+    if payload[:1] == b'{':
+        return json.loads(payload)
+    if payload[0] != WIRE_VERSION:
+        raise ValueError(f"Unsupported wire version: {payload[0]}")
+    kind = payload[1]
+    if kind == KIND_ACK:
+        return {'type': 'ACK', 'ack': ACK_ENVELOPE.unpack_from(payload)[2]}
+    _, _, origin, destination, msg_id, timestamp = ENVELOPE.unpack_from(payload)
+    body = memoryview(payload)[ENVELOPE.size:]
+    if kind == KIND_TEXT:
+        content = bytes(body).decode('utf-8')
+    elif kind == KIND_JSON:
+        content = json.loads(bytes(body))
+    elif kind in (KIND_REQUEST, KIND_REPLY):
+        (clock,) = CLOCK_BODY.unpack_from(body)
+        resource, offset = _unpack_key(body, CLOCK_BODY.size)
+        request_id, _ = _unpack_key(body, offset)
+        content = {'type': 'REQUEST' if kind == KIND_REQUEST else 'REPLY', 'resource': resource,
+                   'request_id': request_id, 'clock': clock, 'origin': origin}
+    elif kind == KIND_INVENTORY_UPDATE:
+        item_id, new_quantity, version = INVENTORY_BODY.unpack_from(body)
+        content = {'type': 'INVENTORY_UPDATE', 'item_id': item_id, 'new_quantity': new_quantity,
+                   'version': version, 'origin': origin}
+    else:
+        raise ValueError(f"Unknown message kind: {kind}")
+    return {'origin': origin, 'destination': destination, 'msg_id': msg_id,
+            'timestamp': timestamp, 'content': content}
+
+
+class FrameReader:
+    """
+    Lector incremental de frames con prefijo de longitud.
+    Acumula lo recibido del socket y entrega los mensajes completos,
+    por lo que soporta lecturas parciales y varios mensajes por conexión.
+    """
+    def __init__(self, sock, bufsize=65536):
+        self.sock = sock
+        self.bufsize = bufsize
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Agrega bytes recibidos y devuelve la lista de payloads completos"""
+        self._buffer += data
+        frames = []
+        while len(self._buffer) >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self._buffer)
+            if length > MAX_FRAME_SIZE:
+                raise ValueError(f"Frame too large: {length} bytes")
+            end = FRAME_HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            frames.append(bytes(self._buffer[FRAME_HEADER.size:end]))
+            del self._buffer[:end]
+        return frames
+
+    def __iter__(self):
+        """Itera sobre los payloads hasta que el otro extremo cierra la conexión"""
+        while True:
+            data = self.sock.recv(self.bufsize)
+            if not data:
+                if self._buffer:
+                    raise ConnectionError("Connection closed in the middle of a frame")
+                return
+            yield from self.feed(data)
+
+
+class ConnectionPool:
+    """
+    Pool de conexiones TCP persistentes hacia los demás nodos.
+    Mantiene una conexión abierta por puerto de destino y la reabre si se rompe.
+    El receptor responde con frames ACK por la misma conexión; un hilo lector por
+    conexión los entrega a quien espera ese msg_id.
+    """
+    def __init__(self, nodes_info, timeout=5.0):
+        """
+        Args:
+            nodes_info: Diccionario {puerto: ip} de nodos disponibles
+            timeout: Timeout de conexión y envío en segundos
+        """
+        self.nodes_info = nodes_info
+        self.timeout = timeout
+        self._connections = {}  # {puerto: socket}
+        self._peer_locks = {}  # {puerto: Lock} serializa los envíos a un mismo nodo
+        self._waiters = {}  # {msg_id: (socket, Future)} envíos que esperan su ACK
+        self._seen = set()  # Puertos con los que ya hubo conexión (para contar reconexiones)
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'reconnects': 0}
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _peer_lock(self, port):
+        with self._lock:
+            lock = self._peer_locks.get(port)
+            if lock is None:
+                lock = self._peer_locks[port] = threading.Lock()
+            return lock
+
+    def _connect(self, port):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.settimeout(self.timeout)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            s.connect((self.nodes_info[port], port))
+        except Exception:
+            s.close()
+            raise
+        self._connections[port] = s
+        threading.Thread(target=self._read_acks, args=(port, s), daemon=True).start()
+        return s
+
+    def _read_acks(self, port, s):
+        """Lee los ACK que llegan por la conexión hasta que se cierra"""
+        reader = FrameReader(s)
+        try:
+            while True:
+                try:
+                    data = s.recv(reader.bufsize)
+                except socket.timeout:
+                    continue
+                if not data:
+                    break
+                for payload in reader.feed(data):
+                    ack = decode_message(payload)
+                    with self._lock:
+                        waiter = self._waiters.pop(ack.get('ack'), None)
+                    if waiter is not None and not waiter[1].done():
+                        waiter[1].set_result(ack)
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self._lock:
+                if self._connections.get(port) is s:
+                    del self._connections[port]
+                orphans = [msg_id for msg_id, (sock, _) in self._waiters.items() if sock is s]
+                futures = [self._waiters.pop(msg_id)[1] for msg_id in orphans]
+            try:
+                s.close()
+            except OSError:
+                pass
+            for future in futures:
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Connection to {port} closed before ACK"))
+
+    def _discard(self, port):
+        s = self._connections.pop(port, None)
+        if s is not None:
+            try:
+                s.close()
+            except OSError:
+                pass
+
+    def _send_on(self, s, data, msg_id):
+        future = None
+        if msg_id is not None:
+            future = Future()
+            with self._lock:
+                self._waiters[msg_id] = (s, future)
+        try:
+            s.sendall(data)
+        except OSError:
+            self.forget(msg_id)
+            raise
+        return future
+
+    def send(self, port, data, msg_id=None):
+        """
+        Envía bytes al nodo en `port` reutilizando la conexión abierta si existe.
+
+        Args:
+            msg_id: Si se indica, se devuelve un Future que se resuelve con el ACK de ese mensaje
+        """
+        with self._peer_lock(port):
+            # El hilo lector quita del pool las conexiones que el otro extremo cerró
+            s = self._connections.get(port)
+            if s is not None:
+                self._count('hits')
+            else:
+                self._count('reconnects' if port in self._seen else 'misses')
+                self._seen.add(port)
+                s = self._connect(port)
+
+            try:
+                return self._send_on(s, data, msg_id)
+            except OSError:
+                # La conexión se rompió entre la verificación y el envío: reintentar una vez
+                self._discard(port)
+                self._count('reconnects')
+                s = self._connect(port)
+                try:
+                    return self._send_on(s, data, msg_id)
+                except OSError:
+                    self._discard(port)
+                    raise
+
+    def forget(self, msg_id):
+        """Deja de esperar el ACK de un mensaje (p. ej. tras un timeout)"""
+        if msg_id is not None:
+            with self._lock:
+                self._waiters.pop(msg_id, None)
+
+    def close(self, port=None):
+        """Cierra todas las conexiones del pool (o sólo la del nodo en `port`)"""
+        with self._lock:
+            ports = list(self._connections) if port is None else [port]
+        for port in ports:
+            with self._peer_lock(port):
+                self._discard(port)
+
+
+class AsyncConnectionPool:
+    """
+    Equivalente asíncrono de ConnectionPool para el runtime asyncio.
+    Debe usarse siempre desde el event loop del nodo.
+    """
+    def __init__(self, nodes_info, timeout=5.0):
+        self.nodes_info = nodes_info
+        self.timeout = timeout
+        self._connections = {}  # {puerto: (reader, writer)}
+        self._peer_locks = {}
+        self._waiters = {}  # {msg_id: (writer, asyncio.Future)}
+        self.stats = {'hits': 0, 'misses': 0, 'reconnects': 0}
+
+    async def _connect(self, port):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.nodes_info[port], port), self.timeout
+        )
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._connections[port] = (reader, writer)
+        asyncio.get_running_loop().create_task(self._read_acks(port, reader, writer))
+        return writer
+
+    async def _read_acks(self, port, reader, writer):
+        """Lee los ACK que llegan por la conexión hasta que se cierra"""
+        try:
+            while True:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                (length,) = FRAME_HEADER.unpack(header)
+                ack = decode_message(await reader.readexactly(length))
+                waiter = self._waiters.pop(ack.get('ack'), None)
+                if waiter is not None and not waiter[1].done():
+                    waiter[1].set_result(ack)
+        except (asyncio.IncompleteReadError, OSError, ValueError):
+            pass
+        finally:
+            if self._connections.get(port, (None, None))[1] is writer:
+                del self._connections[port]
+            writer.close()
+            for msg_id in [m for m, (w, _) in self._waiters.items() if w is writer]:
+                future = self._waiters.pop(msg_id)[1]
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Connection to {port} closed before ACK"))
+
+    def _discard(self, port):
+        conn = self._connections.pop(port, None)
+        if conn is not None:
+            conn[1].close()
+
+    async def _write(self, writer, data, msg_id):
+        future = None
+        if msg_id is not None:
+            future = asyncio.get_running_loop().create_future()
+            self._waiters[msg_id] = (writer, future)
+        try:
+            writer.write(data)
+            await asyncio.wait_for(writer.drain(), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            self.forget(msg_id)
+            raise
+        return future
+
+    async def send(self, port, data, msg_id=None):
+        """
+        Envía bytes al nodo en `port` reutilizando la conexión abierta si existe.
+
+        Args:
+            msg_id: Si se indica, se devuelve un Future que se resuelve con el ACK de ese mensaje
+        """
+        lock = self._peer_locks.setdefault(port, asyncio.Lock())
+        async with lock:
+            conn = self._connections.get(port)
+            if conn is not None and not conn[0].at_eof() and not conn[1].is_closing():
+                self.stats['hits'] += 1
+                writer = conn[1]
+            else:
+                if conn is not None:
+                    self._discard(port)
+                    self.stats['reconnects'] += 1
+                else:
+                    self.stats['misses'] += 1
+                writer = await self._connect(port)
+
+            try:
+                return await self._write(writer, data, msg_id)
+            except (OSError, asyncio.TimeoutError):
+                self._discard(port)
+                self.stats['reconnects'] += 1
+                writer = await self._connect(port)
+                try:
+                    return await self._write(writer, data, msg_id)
+                except (OSError, asyncio.TimeoutError):
+                    self._discard(port)
+                    raise
+
+    def forget(self, msg_id):
+        """Deja de esperar el ACK de un mensaje (p. ej. tras un timeout)"""
+        if msg_id is not None:
+            self._waiters.pop(msg_id, None)
+
+    def close(self, port=None):
+        """Cierra todas las conexiones del pool (o sólo la del nodo en `port`)"""
+        for port in (list(self._connections) if port is None else [port]):
+            self._discard(port)
+
+
+# Logs de los nodos: los hilos que atienden mensajes sólo encolan el registro;
+# un único hilo (QueueListener) lo escribe en la salida estándar
+LOG_QUEUE = queue.Queue()
+_log_listener = None
+_log_setup_lock = threading.Lock()
+
+
+class _ConsoleHandler(logging.StreamHandler):
+    """Escribe en el sys.stdout vigente, así contextlib.redirect_stdout también silencia los logs"""
+    def emit(self, record):
+        self.stream = sys.stdout
+        super().emit(record)
+
+
+def configure_logging():
+    """Conecta el logger 'nodes' a la cola de logs (sólo la primera vez) y lo devuelve"""
+    global _log_listener
+    with _log_setup_lock:
+        if _log_listener is None:
+            handler = _ConsoleHandler()
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            _log_listener = logging.handlers.QueueListener(LOG_QUEUE, handler)
+            _log_listener.start()
+            logger.addHandler(logging.handlers.QueueHandler(LOG_QUEUE))
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+    return logger
+
+
+def flush_logs():
+    """Espera a que el hilo de logs escriba todo lo encolado"""
+    LOG_QUEUE.join()
+
+
+class LoadSampler:
+    """
+    Muestreo de logs por mensaje: pasan todos mientras haya menos de `threshold` por
+    segundo; por encima sólo uno de cada `every`, y se cuentan los descartados.
+    """
+    def __init__(self, threshold=200, every=100):
+        self.threshold = threshold
+        self.every = every
+        self.lock = threading.Lock()
+        self._second = None
+        self._count = 0
+        self._dropped = 0
+
+    def sample(self):
+        """Devuelve (pasa, descartados en el segundo anterior)"""
+        second = int(time.monotonic())
+        with self.lock:
+            dropped = 0
+            if second != self._second:
+                dropped, self._dropped = self._dropped, 0
+                self._second = second
+                self._count = 0
+            self._count += 1
+            if self._count <= self.threshold or self._count % self.every == 0:
+                return True, dropped
+            self._dropped += 1
+            return False, dropped
+
+
+class NodeLog(logging.LoggerAdapter):
+    """Logger de un nodo: antepone [Node N] y muestrea los logs por mensaje cuando hay carga"""
+    def __init__(self, id_node, level=None, metrics=None):
+        node_logger = configure_logging().getChild(f"node{id_node}")
+        if level is not None:
+            node_logger.setLevel(level.upper() if isinstance(level, str) else level)
+        super().__init__(node_logger, {'node': id_node})
+        self.sampler = LoadSampler()
+        self.metrics = metrics
+
+    def process(self, msg, kwargs):
+        return f"[Node {self.extra['node']}] {msg}", kwargs
+
+    def sampled(self):
+        """
+        True si corresponde escribir un log por mensaje (envío, recepción, REPLY...).
+        Uso: `if self.log.sampled(): self.log.info("...%s", valor)`, así el texto sólo se arma si se escribe.
+        """
+        if not self.isEnabledFor(logging.INFO):
+            return False
+        passed, dropped = self.sampler.sample()
+        if dropped:
+            self.info("%d per-message log lines sampled out under load", dropped)
+            if self.metrics is not None:
+                self.metrics.inc('log_lines_sampled_out', amount=dropped)
+        return passed
+
+
+class LatencyHistogram:
+    """
+    Histograma de latencias con cubetas logarítmicas (4 por potencia de 2, desde 1 µs):
+    registrar es O(1) y los percentiles tienen un error relativo menor al 19 %.
+    """
+    BUCKETS = 160  # Hasta 2^40 µs
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        micros = seconds * 1e6
+        index = int(4 * math.log2(micros)) + 1 if micros >= 1 else 0
+        self.counts[min(index, self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        """Límite superior (s) de la cubeta donde cae el percentil"""
+        rank = max(1, math.ceil(fraction * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.max, 2 ** (index / 4) / 1e6)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count * 1000, 3),
+            'p50_ms': round(self.percentile(0.50) * 1000, 3),
+            'p95_ms': round(self.percentile(0.95) * 1000, 3),
+            'p99_ms': round(self.percentile(0.99) * 1000, 3),
+            'max_ms': round(self.max * 1000, 3),
+        }
+
+
+class Metrics:
+    """
+    Contadores e histogramas de latencia del nodo por nombre y etiqueta (tipo de
+    mensaje, nodo, resultado). Actualizarlos cuesta un lock y un par de sumas;
+    snapshot() devuelve una copia lista para serializar a JSON.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self._counters = {}  # {(nombre, etiqueta): valor}
+        self._histograms = {}  # {(nombre, etiqueta): LatencyHistogram}
+
+    def inc(self, name, label=None, amount=1):
+        key = (name, label)
+        with self.lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, label=None):
+        key = (name, label)
+        with self.lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, label=None):
+        """Registra en el histograma `name` la duración del bloque"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, label)
+
+    def snapshot(self):
+        """{'uptime_s', 'counters': {nombre: {etiqueta: valor}}, 'latency': {nombre: {etiqueta: resumen}}}"""
+        with self.lock:
+            counters = dict(self._counters)
+            summaries = {key: histogram.summary() for key, histogram in self._histograms.items()}
+        result = {'uptime_s': round(time.time() - self.started, 3), 'counters': {}, 'latency': {}}
+        for section, values in (('counters', counters), ('latency', summaries)):
+            for (name, label), value in sorted(values.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+                result[section].setdefault(name, {})['all' if label is None else str(label)] = value
+        return result
+
+
+class Storage:
+    """
+    Capa de persistencia SQLite del nodo.
+    Mantiene una única conexión en modo WAL compartida por todos los hilos y
+    un hilo escritor que inserta el log de mensajes en lotes (group commit).
+    Los cambios de inventario se confirman de inmediato con `transaction()`.
+    La tabla `messages` es la partición caliente del log: los días cerrados se
+    mueven a archivos NDJSON comprimidos (uno por día) que las consultas siguen leyendo.
+    Cada archivo es una secuencia de miembros gzip de ARCHIVE_BLOCK_ROWS filas; la columna
+    `blocks` de message_archives guarda [primer id, offset en bytes] de cada miembro.
+    """
+    PRAGMAS = (
+        # Sólo surte efecto en bases nuevas: permite devolver al disco las páginas archivadas
+        "PRAGMA auto_vacuum=INCREMENTAL",
+        "PRAGMA journal_mode=WAL",
+        # En WAL, FULL sincroniza sólo el WAL en cada commit: el inventario sigue siendo durable
+        "PRAGMA synchronous=FULL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA busy_timeout=5000",
+    )
+    # Filas por miembro gzip de un archivo: una página descomprime a lo sumo un bloque de más
+    ARCHIVE_BLOCK_ROWS = 1000
+
+    def __init__(self, db_name, flush_interval=0.05, batch_size=256, archive_dir=None, metrics=None):
+        """
+        Args:
+            db_name: Ruta del archivo SQLite
+            flush_interval: Tiempo máximo (s) que un mensaje espera en cola antes del commit; None
+                no arranca el hilo escritor y confirma cada `batch_size` mensajes (o en flush())
+                en el hilo que los registra
+            batch_size: Número máximo de mensajes por commit
+            archive_dir: Directorio de los archivos de mensajes archivados
+            metrics: Metrics donde se registra la duración de los commits (opcional)
+        """
+        self.db_name = db_name
+        self.metrics = metrics
+        self.archive_dir = archive_dir or f"{os.path.splitext(db_name)[0]}_archive"
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+        self._depth = 0  # Nivel de anidamiento de transaction()
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        for pragma in self.PRAGMAS:
+            self.conn.execute(pragma)
+        self._queue = queue.Queue()
+        self._pending = []  # Filas aún sin confirmar cuando no hay hilo escritor
+        self._stopped = threading.Event()
+        self._writer = None
+        if flush_interval is not None:
+            self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+            self._writer.start()
+
+    @contextmanager
+    def transaction(self, label='transaction'):
+        """
+        Ejecuta un bloque en una transacción con commit inmediato (o rollback si falla).
+        Las transacciones anidadas en el mismo hilo se unen a la exterior.
+        `label` identifica el commit en la métrica db_commit.
+        """
+        with self.lock:
+            cursor = self.conn.cursor()
+            self._depth += 1
+            try:
+                yield cursor
+                if self._depth == 1:
+                    started = time.perf_counter()
+                    self.conn.commit()
+                    if self.metrics is not None:
+                        self.metrics.observe('db_commit', time.perf_counter() - started, label)
+            except BaseException:
+                if self._depth == 1:
+                    self.conn.rollback()
+                raise
+            finally:
+                self._depth -= 1
+                cursor.close()
+
+    @contextmanager
+    def snapshot(self):
+        """
+        Abre una conexión de sólo lectura dentro de una transacción: en modo WAL todas
+        sus consultas ven la misma foto de la base mientras los demás hilos siguen escribiendo.
+        """
+        conn = sqlite3.connect(f"file:{self.db_name}?mode=ro", uri=True, check_same_thread=False)
+        try:
+            conn.execute("BEGIN")
+            yield conn
+        finally:
+            conn.rollback()
+            conn.close()
+
+    def iter_query(self, sql, params=(), chunk_size=500):
+        """Recorre el resultado de una consulta por partes, sin cargarlo completo en memoria"""
+        with self.snapshot() as conn:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+                yield from rows
+
+    def query(self, sql, params=()):
+        """Ejecuta una consulta de lectura y devuelve todas las filas"""
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def query_one(self, sql, params=()):
+        """Ejecuta una consulta de lectura y devuelve la primera fila (o None)"""
+        with self.lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def log_message(self, row):
+        """Encola una fila (origin, destination, msg_type, content, timestamp) para el escritor por lotes"""
+        if self._writer is not None:
+            self._queue.put(row)
+            return
+        with self.lock:
+            self._pending.append(row)
+            if len(self._pending) >= self.batch_size:
+                self._write_batch(self._pending)
+                self._pending = []
+
+    def _writer_loop(self):
+        while not self._stopped.is_set() or not self._queue.empty():
+            try:
+                row = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            batch = []
+            taken = 1
+            marker = None  # Event de un flush() que espera a este lote
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                # None (aviso de close()) o una marca de flush(): el lote sale sin esperar la ventana
+                if row is None or isinstance(row, threading.Event):
+                    marker = row
+                    break
+                batch.append(row)
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.batch_size or remaining <= 0:
+                    break
+                try:
+                    row = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                taken += 1
+            try:
+                if batch:
+                    self._write_batch(batch)
+            finally:
+                for _ in range(taken):
+                    self._queue.task_done()
+                if marker is not None:
+                    marker.set()
+
+    def _write_batch(self, batch):
+        try:
+            with self.transaction('message_batch') as cursor:
+                cursor.executemany("""
+                    INSERT INTO messages (origin, destination, msg_type, content, timestamp)
+                    VALUES (?, ?, ?, ?, ?)
+                """, batch)
+            if self.metrics is not None:
+                self.metrics.inc('db_messages_written', amount=len(batch))
+        except Exception as e:
+            logger.error(f"[Storage {self.db_name}] Batch insert error: {e}")
+
+    def flush(self):
+        """
+        Espera a que los mensajes encolados hasta ahora estén confirmados en disco.
+        Los que se encolen mientras tanto no se esperan: con tráfico continuo la cola nunca queda vacía.
+        """
+        if self._writer is None:
+            with self.lock:
+                if self._pending:
+                    self._write_batch(self._pending)
+                    self._pending = []
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        while not done.wait(0.5):
+            if not self._writer.is_alive():
+                return  # close() ya detuvo al escritor
+
+    def query_messages(self, origin=None, destination=None, msg_type=None, since=None, until=None,
+                       after_id=0, limit=100):
+        """
+        Consulta paginada del log de mensajes (paginación por clave sobre id).
+
+        Args:
+            origin, destination, msg_type: Filtros exactos (opcionales)
+            since, until: Rango de timestamps ISO, since inclusivo y until exclusivo (opcionales)
+            after_id: Cursor devuelto por la página anterior (0 para empezar)
+            limit: Filas por página
+
+        Returns:
+            (filas, cursor_siguiente); el cursor es None en la última página.
+            Cada fila es (id, origin, destination, msg_type, content, timestamp).
+        """
+        clauses, params = ["id > ?"], [after_id]
+        for column, value in (('origin', origin), ('destination', destination), ('msg_type', msg_type)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("timestamp < ?")
+            params.append(until)
+        params.append(limit)
+        rows = self.query(f"""
+            SELECT id, origin, destination, msg_type, content, timestamp FROM messages
+            WHERE {' AND '.join(clauses)}
+            ORDER BY id LIMIT ?
+        """, params)
+
+        # Completar con las particiones archivadas; cada archivo está ordenado por id, así
+        # que basta leer hasta `limit` filas de cada uno y cortar cuando ya no pueden mejorar la página
+        archives = self.query(
+            "SELECT path, day, min_id, blocks FROM message_archives WHERE max_id > ? ORDER BY min_id", (after_id,)
+        )
+        for path, day, min_id, blocks in archives:
+            if len(rows) >= limit and min_id > rows[limit - 1][0]:
+                break
+            if (until is not None and until <= day) or (since is not None and since >= self._next_day(day)):
+                continue
+            matched = []
+            for row in self._read_archive(path, self._block_offset(blocks, after_id)):
+                if row[0] <= after_id or (origin is not None and row[1] != origin) \
+                        or (destination is not None and row[2] != destination) \
+                        or (msg_type is not None and row[3] != msg_type) \
+                        or (since is not None and row[5] < since) or (until is not None and row[5] >= until):
+                    continue
+                matched.append(tuple(row))
+                if len(matched) == limit:
+                    break
+            if matched:
+                rows = heapq.nsmallest(limit, rows + matched)
+        return rows, (rows[-1][0] if len(rows) == limit else None)
+
+    def iter_messages(self, page_size=500, **filters):
+        """Recorre todas las filas que cumplen los filtros, una página a la vez"""
+        cursor = 0
+        while cursor is not None:
+            rows, cursor = self.query_messages(after_id=cursor, limit=page_size, **filters)
+            yield from rows
+
+    @staticmethod
+    def _next_day(day):
+        return (date.fromisoformat(day) + timedelta(days=1)).isoformat()
+
+    @staticmethod
+    def _block_offset(blocks, after_id):
+        """Offset del miembro gzip que contiene la primera fila con id > after_id"""
+        if not blocks:
+            return 0  # Archivo de un solo miembro (anterior al índice de bloques)
+        blocks = json.loads(blocks)
+        index = bisect.bisect_right([first_id for first_id, _ in blocks], after_id + 1) - 1
+        return blocks[max(index, 0)][1]
+
+    @staticmethod
+    def _read_archive(path, offset=0):
+        """Recorre las filas de un archivo de mensajes archivados desde el miembro gzip en `offset`"""
+        with open(path, 'rb') as raw:
+            raw.seek(offset)
+            with gzip.open(raw, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    yield json.loads(line)
+
+    def iter_archived(self):
+        """
+        Recorre todas las filas archivadas en orden de id. Cada archivo ya está ordenado
+        por id, pero sus rangos pueden solaparse (filas que llegaron tarde para un día)
+        """
+        paths = [path for (path,) in self.query("SELECT path FROM message_archives ORDER BY min_id")]
+        for row in heapq.merge(*(self._read_archive(path) for path in paths), key=lambda row: row[0]):
+            yield tuple(row)
+
+    def archive_messages(self, before):
+        """
+        Mueve a archivos gzip las filas de `messages` con timestamp anterior a `before`,
+        un archivo por día. Las inserciones siguen yendo sólo a la partición caliente.
+
+        Returns:
+            Número de filas archivadas
+        """
+        os.makedirs(self.archive_dir, exist_ok=True)
+        archived = 0
+        while True:
+            oldest = self.query_one("SELECT MIN(timestamp) FROM messages WHERE timestamp < ?", (before,))
+            if not oldest or oldest[0] is None:
+                break
+            day = oldest[0][:10]
+            end = min(self._next_day(day), before)
+            # Las filas que lleguen tarde para el mismo día terminan en otro archivo (otro min_id)
+            first = self.query_one(
+                "SELECT MIN(id) FROM messages WHERE timestamp >= ? AND timestamp < ?", (day, end)
+            )[0]
+            path = os.path.join(self.archive_dir, f"messages_{day}_{first}.ndjson.gz")
+            count, max_id = 0, 0
+            blocks, lines = [], []
+            with open(path + '.tmp', 'wb') as f:
+                for row in self.iter_query("""
+                    SELECT id, origin, destination, msg_type, content, timestamp FROM messages
+                    WHERE timestamp >= ? AND timestamp < ? ORDER BY id
+                """, (day, end)):
+                    if not lines:
+                        blocks.append([row[0], f.tell()])
+                    lines.append(json.dumps(row, ensure_ascii=False) + '\n')
+                    if len(lines) == self.ARCHIVE_BLOCK_ROWS:
+                        f.write(gzip.compress(''.join(lines).encode('utf-8')))
+                        lines = []
+                    count += 1
+                    max_id = row[0]
+                if lines:
+                    f.write(gzip.compress(''.join(lines).encode('utf-8')))
+            os.replace(path + '.tmp', path)
+            with self.transaction() as cursor:
+                cursor.execute(
+                    "DELETE FROM messages WHERE timestamp >= ? AND timestamp < ? AND id <= ?", (day, end, max_id)
+                )
+                cursor.execute("""
+                    INSERT OR REPLACE INTO message_archives (path, day, min_id, max_id, rows, blocks)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (path, day, first, max_id, count, json.dumps(blocks)))
+            archived += count
+        if archived:
+            with self.lock:
+                self.conn.execute("PRAGMA incremental_vacuum")
+        return archived
+
+    def prune_archives(self, before_day):
+        """Elimina los archivos de días anteriores a `before_day` (retención). Devuelve cuántos borró"""
+        expired = self.query("SELECT path FROM message_archives WHERE day < ?", (before_day,))
+        for (path,) in expired:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM message_archives WHERE day < ?", (before_day,))
+        return len(expired)
+
+    def close(self):
+        """Vacía la cola, detiene el escritor y cierra la conexión"""
+        self._stopped.set()
+        if self._writer is None:
+            self.flush()
+        else:
+            self._queue.put(None)
+            self._writer.join()
+        with self.lock:
+            self.conn.close()
+
+
+class InventoryCache:
+    """
+    Copia en memoria de la tabla `inventory` con escritura directa (write-through).
+    Cada artículo guarda (cantidad, versión); las lecturas nunca tocan el disco y
+    cada escritura se confirma en SQLite antes de actualizar el mapa.
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self.lock = threading.RLock()
+        self._items = {}  # {item_id: (quantity, version)}
+
+    def load(self):
+        """Carga (o recarga) todo el inventario desde SQLite"""
+        rows = self.storage.query("SELECT id, quantity, version FROM inventory")
+        with self.lock:
+            self._items = {item_id: (quantity, version) for item_id, quantity, version in rows}
+
+    def get(self, item_id):
+        """Devuelve (cantidad, versión) del artículo o None si no existe"""
+        return self._items.get(item_id)
+
+    def items(self):
+        """Copia de {item_id: (cantidad, versión)}"""
+        with self.lock:
+            return dict(self._items)
+
+    def quantity(self, item_id):
+        entry = self._items.get(item_id)
+        return entry[0] if entry else 0
+
+    def _write(self, item_id, quantity, version):
+        with self.storage.transaction() as cursor:
+            cursor.execute("""
+                UPDATE inventory
+                SET quantity = ?, version = ?, last_updated = ?
+                WHERE id = ?
+            """, (quantity, version, datetime.now().isoformat(), item_id))
+        self._items[item_id] = (quantity, version)
+
+    def apply_delta(self, item_id, quantity_change):
+        """
+        Aplica un cambio local de cantidad.
+
+        Returns:
+            (cantidad_anterior, cantidad_nueva, versión_nueva)
+
+        Raises:
+            KeyError: si el artículo no existe
+            ValueError: si no hay stock suficiente
+        """
+        with self.lock:
+            quantity, version = self._items[item_id]
+            new_quantity = quantity + quantity_change
+            if new_quantity < 0:
+                raise ValueError(f"Not enough stock for item {item_id}")
+            self._write(item_id, new_quantity, version + 1)
+            return quantity, new_quantity, version + 1
+
+    def apply_remote(self, item_id, quantity, version):
+        """
+        Aplica una actualización remota sólo si es más reciente que la local. Con la misma
+        versión gana la cantidad menor: todas las réplicas eligen igual y nunca reaparece stock vendido.
+        """
+        with self.lock:
+            entry = self._items.get(item_id)
+            if entry is None or (version, -quantity) <= (entry[1], -entry[0]):
+                return False
+            self._write(item_id, quantity, version)
+            return True
+
+    def ensure(self, item_id, name, price, quantity=0, version=0):
+        """Crea el artículo si no existe; devuelve True si lo creó"""
+        with self.lock:
+            if item_id in self._items:
+                return False
+            with self.storage.transaction() as cursor:
+                cursor.execute("""
+                    INSERT INTO inventory (id, name, quantity, price, last_updated, version)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (item_id, name, quantity, price, datetime.now().isoformat(), version))
+            self._items[item_id] = (quantity, version)
+            return True
+
+    def set(self, item_id, quantity, version):
+        """Fija cantidad y versión de un artículo existente"""
+        with self.lock:
+            self._write(item_id, quantity, version)
+
+
+# Recurso usado cuando la sección crítica no se asocia a un artículo concreto
+GLOBAL_RESOURCE = '*'
+
+
+class ResourceLock:
+    """Estado de exclusión mutua (Ricart-Agrawala) de un recurso, normalmente un item_id"""
+    def __init__(self):
+        self.state = 'RELEASED'  # 'RELEASED', 'WANTED' o 'HELD'
+        self.request_clock = 0  # Marca Lamport de nuestra solicitud
+        self.request_id = None  # ID de la solicitud en curso; los REPLY de otras se ignoran
+        self.replies_received = 0
+        self.awaiting = set()  # Puertos de los nodos cuyo REPLY falta
+        self.unreachable = set()  # Nodos de `awaiting` que no se pudieron contactar: la solicitud falla
+        self.deferred = []  # REQUEST recibidos que se responden al liberar el recurso
+
+
+class PNCounterStore:
+    """
+    Inventario replicado como CRDT: un contador PN por artículo.
+    Cada nodo sólo incrementa sus propias entradas P (altas) y N (bajas); la fusión
+    toma el máximo por entrada, así que el orden de entrega, los duplicados y los
+    reintentos no cambian el resultado. El valor fusionado se escribe en `inventory`.
+    La entrada del nodo 0 es el stock inicial del catálogo. Sólo la escribe una réplica
+    (`seeder`, la de menor id) y las demás la reciben al fusionar: si cada una sembrara su
+    propia vista, la fusión por máximo se quedaría con la mayor y podría superar el stock real.
+    Orden de candados: inventory.lock, luego self.lock y por último el de Storage,
+    el mismo que usa InventoryCache.
+    """
+    SEED_NODE = 0
+
+    def __init__(self, storage, inventory, seeder=True):
+        self.storage = storage
+        self.inventory = inventory
+        self.seeder = seeder
+        self.lock = threading.RLock()
+        self._counters = {}  # {item_id: {node_id: [p, n]}}
+
+    def load(self):
+        """Carga los contadores desde SQLite"""
+        rows = self.storage.query("SELECT item_id, node_id, p, n FROM crdt_counters")
+        with self.lock:
+            self._counters = {}
+            for item_id, node_id, p, n in rows:
+                self._counters.setdefault(item_id, {})[node_id] = [p, n]
+
+    def seed(self):
+        """Inicializa los contadores de los artículos que todavía no tienen (con el stock actual si es seeder)"""
+        with self.inventory.lock, self.lock, self.storage.transaction() as cursor:
+            for item_id in self.inventory.items():
+                self._counter(cursor, item_id)
+
+    def _counter(self, cursor, item_id):
+        """
+        Contador de un artículo; si el artículo se agregó al inventario después de seed()
+        el seeder lo crea con su stock actual como aporte del catálogo, y las demás réplicas
+        vacío hasta recibir ese aporte. None si el artículo no existe.
+        Requiere inventory.lock y self.lock.
+        """
+        counter = self._counters.get(item_id)
+        if counter is None:
+            entry = self.inventory.get(item_id)
+            if entry is None:
+                return None
+            counter = self._counters[item_id] = {}
+            if self.seeder:
+                counter[self.SEED_NODE] = [entry[0], 0]
+                self._store(cursor, item_id, self.SEED_NODE)
+        return counter
+
+    @staticmethod
+    def _value(counter):
+        return sum(p for p, _ in counter.values()) - sum(n for _, n in counter.values())
+
+    def value(self, item_id):
+        with self.lock:
+            return self._value(self._counters[item_id])
+
+    def state(self, item_ids=None):
+        """Estado serializable {item_id: {node_id: [p, n]}} de los artículos pedidos (o de todos)"""
+        with self.lock:
+            ids = self._counters.keys() if item_ids is None else item_ids
+            return {
+                item_id: {node_id: list(pn) for node_id, pn in self._counters[item_id].items()}
+                for item_id in ids if item_id in self._counters
+            }
+
+    def _store(self, cursor, item_id, node_id):
+        p, n = self._counters[item_id][node_id]
+        cursor.execute("""
+            INSERT INTO crdt_counters (item_id, node_id, p, n) VALUES (?, ?, ?, ?)
+            ON CONFLICT(item_id, node_id) DO UPDATE SET p = excluded.p, n = excluded.n
+        """, (item_id, node_id, p, n))
+
+    def materialize(self, item_id):
+        """Escribe el valor fusionado en la tabla inventory (y en la caché)"""
+        entry = self.inventory.get(item_id)
+        if entry is not None:
+            self.inventory.set(item_id, self._value(self._counters[item_id]), entry[1] + 1)
+
+    def apply_local(self, item_id, node_id, quantity_change):
+        """
+        Aplica un cambio hecho por este nodo.
+
+        Returns:
+            (cantidad_anterior, cantidad_nueva)
+
+        Raises:
+            KeyError: si el artículo no existe
+            ValueError: si no hay stock suficiente
+        """
+        with self.inventory.lock, self.lock, self.storage.transaction() as cursor:
+            counter = self._counter(cursor, item_id)
+            if counter is None:
+                raise KeyError(item_id)
+            old_value = self._value(counter)
+            if old_value + quantity_change < 0:
+                raise ValueError(f"Not enough stock for item {item_id}")
+            pn = counter.setdefault(node_id, [0, 0])
+            if quantity_change >= 0:
+                pn[0] += quantity_change
+            else:
+                pn[1] -= quantity_change
+            self._store(cursor, item_id, node_id)
+            self.materialize(item_id)
+            return old_value, old_value + quantity_change
+
+    def merge(self, remote_state):
+        """
+        Fusiona el estado recibido de otro nodo (máximo por entrada).
+
+        Returns:
+            Lista de item_ids cuyo valor cambió
+        """
+        changed = []
+        with self.inventory.lock, self.lock, self.storage.transaction() as cursor:
+            for item_id, remote_counter in remote_state.items():
+                item_id = int(item_id)
+                counter = self._counter(cursor, item_id)
+                if counter is None:
+                    # Artículo aún desconocido: se guarda el estado para cuando se dé de alta
+                    counter = self._counters.setdefault(item_id, {})
+                updated = False
+                for node_id, (p, n) in remote_counter.items():
+                    node_id = int(node_id)
+                    local = counter.setdefault(node_id, [0, 0])
+                    if p > local[0] or n > local[1]:
+                        local[0], local[1] = max(local[0], p), max(local[1], n)
+                        self._store(cursor, item_id, node_id)
+                        updated = True
+                if updated:
+                    self.materialize(item_id)
+                    changed.append(item_id)
+        return changed
+
+
+class OperationLog:
+    """
+    Copia local del log de operaciones de inventario replicado con un líder (replication='log').
+    Las entradas (término, operación) se guardan en memoria y en la tabla `op_log`. El
+    término actual, el voto emitido y el último índice aplicado se guardan en `op_log_state`.
+    El resultado de cada request_id aplicado va a `op_log_applied` en la misma transacción
+    que avanza last_applied: un reintento duplicado en el log no se aplica dos veces ni
+    después de reiniciar.
+    Los índices empiezan en 1; el índice 0 representa el log vacío, de término 0.
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self.lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # Serializa escrituras y truncados del log en SQLite
+        self.entries = []  # [(término, operación)]; la entrada i está en entries[i - 1]
+        self.persisted = 0  # Último índice confirmado en SQLite
+        self.term = 0
+        self.voted_for = None
+        self.last_applied = 0
+
+    def load(self):
+        """Carga el log y el estado persistido (al arrancar o tras una caída)"""
+        rows = self.storage.query("SELECT term, op FROM op_log ORDER BY idx")
+        state = dict(self.storage.query("SELECT key, value FROM op_log_state"))
+        with self.lock:
+            self.entries = [(term, json.loads(op)) for term, op in rows]
+            self.persisted = len(self.entries)
+            self.term = state.get('term') or 0
+            self.voted_for = state.get('voted_for')
+            self.last_applied = min(state.get('last_applied') or 0, self.persisted)
+            applied = self.entries[:self.last_applied]
+        # Bases anteriores a op_log_applied: lo ya aplicado se registra con resultado desconocido
+        with self.storage.transaction('op_log') as cursor:
+            cursor.executemany(
+                "INSERT OR IGNORE INTO op_log_applied (request_id, idx, result) VALUES (?, ?, NULL)",
+                [(op['request_id'], index) for index, (_, op) in enumerate(applied, 1) if op.get('request_id')]
+            )
+
+    @property
+    def last_index(self):
+        return len(self.entries)
+
+    def term_at(self, index):
+        """Término de la entrada `index` (0 si no existe)"""
+        return self.entries[index - 1][0] if 0 < index <= len(self.entries) else 0
+
+    def last_term(self):
+        return self.term_at(self.last_index)
+
+    def entries_from(self, index, limit):
+        """Hasta `limit` entradas desde `index`, como [[término, operación]] listas para enviar"""
+        with self.lock:
+            return [[term, op] for term, op in self.entries[index - 1:index - 1 + limit]]
+
+    def append(self, term, ops):
+        """Agrega operaciones del líder en memoria; flush() las persiste. Devuelve el último índice"""
+        with self.lock:
+            self.entries.extend((term, op) for op in ops)
+            return len(self.entries)
+
+    def merge(self, prev_index, entries):
+        """
+        Agrega las entradas recibidas del líder a continuación de `prev_index`.
+        Si una entrada existente tiene otro término se descarta desde ahí en adelante.
+        Las entradas quedan persistidas al volver.
+
+        Returns:
+            Último índice que coincide con el log del líder
+        """
+        with self._flush_lock:
+            with self.lock:
+                index = prev_index
+                for term, op in entries:
+                    index += 1
+                    if index <= len(self.entries):
+                        if self.entries[index - 1][0] == term:
+                            continue
+                        self._truncate(index)
+                    self.entries.append((term, op))
+            self._flush()
+        return prev_index + len(entries)
+
+    def _truncate(self, index):
+        """Descarta las entradas desde `index`; requiere lock y _flush_lock"""
+        del self.entries[index - 1:]
+        if self.persisted >= index:
+            with self.storage.transaction('op_log') as cursor:
+                cursor.execute("DELETE FROM op_log WHERE idx >= ?", (index,))
+            self.persisted = index - 1
+
+    def flush(self):
+        """
+        Persiste en una sola transacción todas las entradas pendientes. Los hilos que
+        llegan mientras otro escribe encuentran su entrada ya guardada (group commit).
+        Devuelve el último índice persistido.
+        """
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self.lock:
+            start = self.persisted + 1
+            rows = [(start + offset, term, json.dumps(op, separators=(',', ':')))
+                    for offset, (term, op) in enumerate(self.entries[self.persisted:])]
+        if rows:
+            with self.storage.transaction('op_log') as cursor:
+                cursor.executemany("INSERT OR REPLACE INTO op_log (idx, term, op) VALUES (?, ?, ?)", rows)
+            with self.lock:
+                self.persisted = max(self.persisted, rows[-1][0])
+        return self.persisted
+
+    def save_vote(self, term, voted_for):
+        """Persiste el término actual y el voto antes de actuar según ellos"""
+        with self.storage.transaction() as cursor:
+            cursor.executemany("INSERT OR REPLACE INTO op_log_state (key, value) VALUES (?, ?)",
+                               [('term', term), ('voted_for', voted_for)])
+        self.term = term
+        self.voted_for = voted_for
+
+    def applied_result(self, request_id):
+        """(True, resultado) si ya se aplicó una operación con ese request_id; (False, None) si no"""
+        row = self.storage.query_one("SELECT result FROM op_log_applied WHERE request_id = ?", (request_id,))
+        return (False, None) if row is None else (True, row[0])
+
+    def record_applied(self, request_id, index, result):
+        """Registra el resultado de una operación; se llama dentro de la transacción que la aplica"""
+        with self.storage.transaction() as cursor:
+            cursor.execute("INSERT OR IGNORE INTO op_log_applied (request_id, idx, result) VALUES (?, ?, ?)",
+                           (request_id, index, result))
+
+    def mark_applied(self, index):
+        """Registra el último índice aplicado; se llama dentro de la transacción que lo aplica"""
+        with self.storage.transaction() as cursor:
+            cursor.execute("INSERT OR REPLACE INTO op_log_state (key, value) VALUES ('last_applied', ?)",
+                           (index,))
+        self.last_applied = index
+
+
+class UpdateBatcher:
+    """
+    Etapa de envío por lotes de las actualizaciones de inventario.
+    Una actualización hacia un nodo sin lote en camino sale de inmediato. Mientras un lote
+    viaja, lo nuevo se acumula durante una ventana corta (o hasta un tamaño máximo), se queda
+    sólo con la última actualización de cada item_id y sale en un único INVENTORY_BATCH.
+    El ACK de un lote resuelve los Futures de todas las actualizaciones que lleva.
+    """
+    def __init__(self, send_batch, executor, window=0.002, max_size=64):
+        """
+        Args:
+            send_batch: Función (puerto, [payloads]) -> bool que envía un lote
+            executor: Pool de hilos donde se ejecutan los envíos
+            window: Tiempo (s) que se espera para juntar lo que llega con un lote en camino
+            max_size: Número de artículos distintos que dispara el envío inmediato
+        """
+        self.send_batch = send_batch
+        self.executor = executor
+        self.window = window
+        self.max_size = max_size
+        self._pending = {}  # {puerto: {item_id: (payload, [Future])}}
+        self._first_pending = {}  # {puerto: instante en que llegó lo más viejo pendiente}
+        self._inflight = set()  # Puertos con un lote en camino
+        self._idle = set()  # Puertos cuyo pendiente llegó sin lote en camino: no esperan la ventana
+        self.stats = {'updates': 0, 'coalesced': 0, 'batches': 0}
+        self._condition = threading.Condition()
+        self._closed = False
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def submit(self, port, item_id, payload):
+        """Encola una actualización; el Future se resuelve con el resultado del lote que la lleve"""
+        future = Future()
+        with self._condition:
+            if self._closed:
+                future.set_result(False)
+                return future
+            self.stats['updates'] += 1
+            pending = self._pending.setdefault(port, {})
+            previous = pending.pop(item_id, None)
+            futures = [future]
+            if previous is not None:
+                # Sólo viaja el valor más reciente del artículo
+                self.stats['coalesced'] += 1
+                futures = previous[1] + futures
+            pending[item_id] = (payload, futures)
+            if port not in self._first_pending:
+                self._first_pending[port] = time.monotonic()
+                if port not in self._inflight:
+                    self._idle.add(port)
+            self._condition.notify_all()
+        return future
+
+    def _ready_ports(self, now):
+        return [
+            port for port, pending in self._pending.items()
+            if pending and port not in self._inflight
+            and (port in self._idle or len(pending) >= self.max_size
+                 or now - self._first_pending[port] >= self.window)
+        ]
+
+    def _next_deadline(self):
+        waiting = [self._first_pending[port] + self.window
+                   for port, pending in self._pending.items() if pending and port not in self._inflight]
+        return min(waiting) if waiting else None
+
+    def close(self):
+        """Detiene el envío; lo que quedaba pendiente se resuelve como no entregado"""
+        with self._condition:
+            self._closed = True
+            pending, self._pending = self._pending, {}
+            self._condition.notify_all()
+        for updates in pending.values():
+            self._resolve(updates, False)
+
+    @staticmethod
+    def _resolve(pending, ok):
+        for _, futures in pending.values():
+            for future in futures:
+                future.set_result(ok)
+
+    def _flush_loop(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        return
+                    now = time.monotonic()
+                    ready = self._ready_ports(now)
+                    if ready:
+                        break
+                    deadline = self._next_deadline()
+                    self._condition.wait(None if deadline is None else max(0, deadline - now))
+                batches = []
+                for port in ready:
+                    pending = self._pending.pop(port)
+                    del self._first_pending[port]
+                    self._idle.discard(port)
+                    self._inflight.add(port)
+                    self.stats['batches'] += 1
+                    batches.append((port, pending))
+            for index, (port, pending) in enumerate(batches):
+                try:
+                    self.executor.submit(self._send, port, pending)
+                except RuntimeError:
+                    # El pool ya se cerró (shutdown del nodo o del intérprete): no sale nada más
+                    self.close()
+                    for _, unsent in batches[index:]:
+                        self._resolve(unsent, False)
+                    return
+
+    def _send(self, port, pending):
+        try:
+            ok = self.send_batch(port, [payload for payload, _ in pending.values()])
+        except Exception:
+            ok = False
+        with self._condition:
+            self._inflight.discard(port)
+            self._condition.notify_all()
+        self._resolve(pending, ok)
+
+
+class OrderQueue:
+    """
+    Cola de pedidos que comparten una misma entrada a la sección crítica.
+    El primer hilo que encuentra la cola libre atiende, además del suyo, todos los
+    pedidos que llegaron mientras tanto (combinación): el costo de pedir los candados
+    se reparte entre el lote. Los demás hilos esperan el resultado de su pedido.
+    """
+    def __init__(self, process, scheduler, max_batch=64):
+        """
+        Args:
+            process: Función ([pedidos], timeout) -> [bool] que atiende un lote completo
+            scheduler: Esperas del nodo (SystemScheduler o el reloj virtual del simulador)
+            max_batch: Pedidos como máximo por entrada a la sección crítica
+        """
+        self.process = process
+        self.scheduler = scheduler
+        self.max_batch = max_batch
+        self.stats = {'orders': 0, 'batches': 0}
+        self._pending = deque()  # Entradas {'order', 'timeout', 'ok'} en orden de llegada
+        self._busy = False  # Hay un hilo atendiendo lotes
+        self._condition = threading.Condition()
+
+    def submit(self, order, timeout=5):
+        """Encola un pedido y espera a que algún lote lo atienda; devuelve True si se compró"""
+        entry = {'order': order, 'timeout': timeout, 'ok': None}
+        with self._condition:
+            self.stats['orders'] += 1
+            self._pending.append(entry)
+            self.scheduler.wait_for(self._condition, lambda: entry['ok'] is not None or not self._busy)
+            if entry['ok'] is not None:
+                return entry['ok']
+            self._busy = True
+        try:
+            # Atender lotes en orden de llegada hasta que salga el propio pedido
+            while entry['ok'] is None:
+                with self._condition:
+                    batch = [self._pending.popleft() for _ in range(min(self.max_batch, len(self._pending)))]
+                    self.stats['batches'] += 1
+                try:
+                    results = self.process([e['order'] for e in batch], max(e['timeout'] for e in batch))
+                except Exception as e:
+                    logger.error(f"Error processing order batch: {e}")
+                    results = [False] * len(batch)
+                with self._condition:
+                    for pending, ok in zip(batch, results):
+                        pending['ok'] = ok
+                    self._condition.notify_all()
+        finally:
+            with self._condition:
+                self._busy = False
+                self._condition.notify_all()
+        return entry['ok']
+
+
+class MessageRecord:
+    """Entrada compacta del historial en memoria"""
+    __slots__ = ('origin', 'destination', 'msg_type', 'clock', 'timestamp', 'payload', 'persisted')
+
+    def __init__(self, origin, destination, msg_type, clock, timestamp, payload, persisted):
+        self.origin = origin
+        self.destination = destination
+        self.msg_type = msg_type
+        self.clock = clock
+        self.timestamp = timestamp  # ns desde epoch
+        self.payload = payload  # Referencia al contenido original (dict o texto), no una copia
+        self.persisted = persisted  # Ya está (o está encolado) en la tabla messages
+
+    def row(self):
+        """Fila (origin, destination, msg_type, content, timestamp) de la tabla messages"""
+        return (self.origin, self.destination, self.msg_type, content_to_text(self.payload),
+                timestamp_to_iso(self.timestamp))
+
+    def to_dict(self):
+        return {
+            'origin': self.origin,
+            'destination': self.destination,
+            'type': self.msg_type,
+            'clock': self.clock,
+            'timestamp': timestamp_to_iso(self.timestamp),
+            'content': content_to_text(self.payload)
+        }
+
+
+class MessageLog:
+    """
+    Historial de mensajes en memoria con capacidad fija (buffer circular).
+    Al desalojar una entrada que todavía no está en disco se encola en la tabla messages,
+    de modo que la memoria no crece con el tiempo y no se pierde historial.
+    """
+    def __init__(self, storage, capacity=1024):
+        self.storage = storage
+        self.capacity = capacity
+        self._records = [None] * capacity
+        self._next = 0  # Próxima posición a escribir
+        self._size = 0
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    def append(self, record):
+        with self._lock:
+            old = self._records[self._next]
+            if old is not None:
+                self.evicted += 1
+                if not old.persisted:
+                    self.storage.log_message(old.row())
+            self._records[self._next] = record
+            self._next = (self._next + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+
+    def __len__(self):
+        return self._size
+
+    def spill(self):
+        """Encola en SQLite todas las entradas que aún no están en disco"""
+        with self._lock:
+            for record in self._records:
+                if record is not None and not record.persisted:
+                    self.storage.log_message(record.row())
+                    record.persisted = True
+
+    def records(self):
+        """Copia de las entradas actuales, de la más vieja a la más nueva"""
+        with self._lock:
+            start = (self._next - self._size) % self.capacity
+            return [self._records[(start + i) % self.capacity] for i in range(self._size)]
+
+
+class FailureDetector:
+    """
+    Detector de fallos phi-accrual y vista de membresía (ALIVE, SUSPECT o DEAD por nodo).
+    Con los intervalos entre latidos recientes de cada nodo estima cuán improbable es
+    el silencio actual (phi); superar los umbrales lo vuelve sospechoso o muerto.
+    Un error de conexión lo marca muerto de inmediato y un latido nuevo lo revive.
+    La vista sólo decide a quién se difunde; un nodo muerto sigue en la membresía (y el
+    candado sigue necesitando su REPLY) hasta que se lo quita con remove_member.
+    """
+    def __init__(self, interval=1.0, suspect_phi=3.0, dead_phi=8.0, window=100, min_std=None):
+        """
+        Args:
+            interval: Intervalo esperado (s) entre latidos
+            suspect_phi, dead_phi: Umbrales de phi para SUSPECT y DEAD
+            window: Intervalos recientes que se usan para la estimación
+            min_std: Desviación mínima (s), evita falsos positivos con latidos muy regulares
+        """
+        self.interval = interval
+        self.suspect_phi = suspect_phi
+        self.dead_phi = dead_phi
+        self.window = window
+        self.min_std = min_std if min_std is not None else interval / 4
+        self.lock = threading.Lock()
+        self._intervals = {}  # {puerto: deque de intervalos (s) entre latidos}
+        self._last = {}  # {puerto: instante (monotonic) del último latido}
+        self._status = {}  # {puerto: 'ALIVE' | 'SUSPECT' | 'DEAD'}
+
+    def add(self, port, now=None):
+        """Agrega un nodo a la vista como si acabara de enviar un latido"""
+        with self.lock:
+            self._intervals[port] = deque([self.interval], maxlen=self.window)
+            self._last[port] = time.monotonic() if now is None else now
+            self._status[port] = 'ALIVE'
+
+    def remove(self, port):
+        with self.lock:
+            self._intervals.pop(port, None)
+            self._last.pop(port, None)
+            self._status.pop(port, None)
+
+    def heartbeat(self, port, now=None):
+        """Registra un latido; devuelve el estado anterior (None si el nodo no está en la vista)"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            previous = self._status.get(port)
+            if previous is None:
+                return None
+            if previous == 'DEAD':
+                # Vuelve de una caída: la historia de intervalos anterior ya no sirve
+                self._intervals[port] = deque([self.interval], maxlen=self.window)
+            else:
+                self._intervals[port].append(now - self._last[port])
+            self._last[port] = now
+            self._status[port] = 'ALIVE'
+            return previous
+
+    def mark_dead(self, port):
+        """Marca un nodo como muerto (p. ej. conexión rechazada); devuelve True si estaba vivo"""
+        with self.lock:
+            if self._status.get(port, 'DEAD') == 'DEAD':
+                return False
+            self._status[port] = 'DEAD'
+            return True
+
+    def _phi(self, port, now):
+        intervals = self._intervals[port]
+        mean = sum(intervals) / len(intervals)
+        std = max(self.min_std, (sum((x - mean) ** 2 for x in intervals) / len(intervals)) ** 0.5)
+        # Aproximación logística de la cola de la normal (como en Akka)
+        y = (now - self._last[port] - mean) / std
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if y > 0:
+            # Tras un silencio muy largo e se anula: phi queda acotado en vez de fallar con log10(0)
+            return -math.log10(max(e / (1.0 + e), sys.float_info.min))
+        return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+    def phi(self, port, now=None):
+        with self.lock:
+            return self._phi(port, time.monotonic() if now is None else now)
+
+    def update(self, now=None):
+        """Recalcula los estados; devuelve la lista de cambios (puerto, anterior, nuevo)"""
+        now = time.monotonic() if now is None else now
+        changes = []
+        with self.lock:
+            for port, status in self._status.items():
+                if status == 'DEAD':
+                    continue  # Sólo un latido lo revive
+                phi = self._phi(port, now)
+                new = 'DEAD' if phi >= self.dead_phi else 'SUSPECT' if phi >= self.suspect_phi else 'ALIVE'
+                if new != status:
+                    self._status[port] = new
+                    changes.append((port, status, new))
+        return changes
+
+    def status(self, port):
+        return self._status.get(port)
+
+    def live(self, ports):
+        """Filtra los puertos descartando los nodos muertos (los sospechosos se siguen usando)"""
+        return [port for port in ports if self._status.get(port) != 'DEAD']
+
+    def view(self):
+        """{puerto: (estado, phi)} de todos los nodos de la vista"""
+        now = time.monotonic()
+        with self.lock:
+            return {port: (status, round(self._phi(port, now), 2)) for port, status in self._status.items()}
+
+
+class GossipDissemination:
+    """
+    Difusión epidémica: cada nodo reenvía un rumor nuevo a `fanout` nodos al azar.
+    Con un TTL de unos log_fanout(N) saltos llega a todo el clúster con alta probabilidad
+    y el origen sólo hace `fanout` envíos, sin importar el tamaño del clúster.
+    """
+    def __init__(self, fanout=3):
+        self.fanout = fanout
+
+    def ttl(self, cluster_size):
+        """Saltos que puede dar un rumor antes de dejar de reenviarse"""
+        return math.ceil(math.log(max(cluster_size, 2)) / math.log(max(self.fanout, 2))) + 2
+
+    def first_hops(self, own_port, peers):
+        return random.sample(peers, min(self.fanout, len(peers)))
+
+    def next_hops(self, own_port, root_port, sender_port, peers):
+        candidates = [port for port in peers if port not in (root_port, sender_port)]
+        return random.sample(candidates, min(self.fanout, len(candidates)))
+
+
+class TreeDissemination:
+    """
+    Difusión por un árbol `fanout`-ario con raíz en el origen, construido sobre la membresía
+    ordenada por puerto: cada nodo sólo reenvía a sus hijos, así que cada mensaje llega una
+    vez a cada nodo y el origen hace `fanout` envíos. Si un hijo no responde, el padre
+    se hace cargo de sus hijos.
+    """
+    def __init__(self, fanout=2):
+        self.fanout = fanout  # Aridad del árbol
+
+    def ttl(self, cluster_size):
+        return cluster_size  # El árbol termina solo; el TTL nunca corta
+
+    def children(self, port, root_port, members):
+        """Hijos de `port` en el árbol con raíz `root_port` sobre los puertos `members`"""
+        order = sorted(set(members) | {root_port})
+        start = order.index(root_port)
+        order = order[start:] + order[:start]
+        if port not in order:
+            return []
+        i = order.index(port)
+        return order[self.fanout * i + 1:self.fanout * (i + 1) + 1]
+
+    def first_hops(self, own_port, peers):
+        return self.children(own_port, own_port, peers + [own_port])
+
+    def next_hops(self, own_port, root_port, sender_port, peers):
+        return self.children(own_port, root_port, peers + [own_port])
+
+
+class SystemScheduler:
+    """
+    Tiempo, esperas e hilos de envío del protocolo sobre el reloj y los hilos reales.
+    El simulador (simulator.py) lo reemplaza por uno con reloj virtual, donde las
+    esperas avanzan el tiempo simulado en lugar de bloquear.
+    """
+    def monotonic(self):
+        return time.monotonic()
+
+    def time_ns(self):
+        return time.time_ns()
+
+    def wait_for(self, condition, predicate, timeout=None):
+        """Como condition.wait_for; hay que tener tomado `condition`"""
+        return condition.wait_for(predicate, timeout=timeout)
+
+    def executor(self, max_workers, name):
+        """Pool donde el nodo hace sus envíos en paralelo"""
+        return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+
 class Node:
-    def __init__(self, id_node, port, nodes_info, node_ip='0.0.0.0', server_ready_event=None, base_port=5000):
+    def __init__(self, id_node, port, nodes_info, node_ip='0.0.0.0', server_ready_event=None, base_port=5000,
+                 runtime='thread', db_flush_interval=0.05, db_batch_size=256,
+                 purchase_mode='lock', escrow_low_watermark=2, replication='version',
+                 batch_window=0.002, batch_max_size=64, history_capacity=1024,
+                 hot_days=1, retention_days=None, archive_interval=3600, codec='binary',
+                 heartbeat_interval=1.0, suspect_phi=3.0, dead_phi=8.0,
+                 dissemination='direct', fanout=3, anti_entropy_interval=None, db_path=None,
+                 transport=None, scheduler=None, log_level=None, stats_port=None,
+                 client_port=None, client_workers=32, order_batch_size=64,
+                 election_timeout=1.0, log_batch_size=256, log_max_inflight=8):
+        """
+        Args:
+            id_node: Identificador único del nodo (1, 2, 3...)
+            port: Puerto de escucha
+            nodes_info: Diccionario {puerto: ip} de nodos disponibles
+            node_ip: IP del nodo
+            server_ready_event: Evento para sincronización
+            base_port: Puerto base para cálculo de IDs
+            runtime: 'thread' (un hilo por conexión) o 'asyncio' (un event loop para la E/S y
+                un pool de hilos para procesar los mensajes)
+            db_flush_interval: Intervalo máximo (s) entre commits del log de mensajes; None los
+                confirma por lotes en el hilo que recibe, sin hilo escritor
+            db_batch_size: Número máximo de mensajes por commit del log
+            purchase_mode: 'lock' (exclusión mutua por artículo) o 'escrow' (venta local de una cuota)
+            escrow_low_watermark: Cuota mínima a partir de la cual se pide stock prestado
+            replication: 'version' (cantidad absoluta con versión), 'crdt' (contadores PN) o
+                'log' (log de operaciones con líder al estilo Raft; reemplaza los candados)
+            batch_window: Ventana (s) para agrupar actualizaciones de inventario; 0 las envía de a una
+            batch_max_size: Artículos distintos por lote que disparan el envío sin esperar la ventana
+            history_capacity: Mensajes que se conservan en memoria antes de pasar sólo a SQLite
+            hot_days: Días (contando hoy) que el log de mensajes se queda en la tabla caliente
+            retention_days: Días que se conservan los archivos del log; None los guarda siempre
+            archive_interval: Segundos entre rotaciones del log; None las desactiva
+            codec: 'binary' (encabezados struct) o 'json' (legible, para depurar); se reciben ambos
+            heartbeat_interval: Segundos entre latidos a los demás nodos; None desactiva el detector
+            suspect_phi, dead_phi: Umbrales del detector de fallos phi-accrual
+            dissemination: Cómo se difunden las actualizaciones de inventario y la anti-entropía:
+                'direct' (el origen envía a todos), 'gossip' (rumores con `fanout`) o
+                'tree' (árbol de difusión de aridad `fanout`). En los dos últimos las confirmaciones
+                suben agregadas por el camino del rumor hasta el origen, que sigue esperando a
+                la mayoría. En todos los modos los REPLY del candado llevan la fila del artículo
+            fanout: Nodos a los que reenvía cada salto en 'gossip' / aridad del árbol en 'tree'
+            anti_entropy_interval: Segundos entre rondas de sync_inventory en segundo plano;
+                por defecto 10 en 'gossip' (repara los rumores que no llegaron) y desactivado si no
+            db_path: Ruta de la base SQLite (por defecto node_<id>.db en el directorio actual)
+            transport: Reemplaza la red TCP; objeto con send(node, message_dict, wait_ack, ack_timeout)
+                que entrega el frame con _process_message del destino (lo usa simulator.py)
+            scheduler: Reloj, esperas y pool de envíos del protocolo (por defecto SystemScheduler)
+            log_level: Nivel de log del nodo ('DEBUG', 'INFO', 'WARNING'...); por defecto INFO
+            stats_port: Puerto local donde se sirven las métricas en JSON (GET /stats); None no lo abre
+            client_port: Puerto local de la API para clientes programáticos (client.py); None no lo abre
+            client_workers: Peticiones de clientes que se atienden a la vez (las demás esperan en cola)
+            order_batch_size: Pedidos encolados que se atienden como máximo en una misma sección crítica
+            election_timeout: Segundos sin noticias del líder antes de pedir votos (en 'log'); el
+                valor real se sortea entre 1x y 2x y el líder envía latidos cada cuarto de este tiempo
+            log_batch_size: Entradas como máximo por LOG_APPEND
+            log_max_inflight: LOG_APPEND sin respuesta que el líder mantiene en vuelo por seguidor
+        """
+        if runtime not in ('thread', 'asyncio'):
+            raise ValueError(f"Unknown runtime: {runtime}")
+        if purchase_mode not in ('lock', 'escrow'):
+            raise ValueError(f"Unknown purchase mode: {purchase_mode}")
+        if replication not in ('version', 'crdt', 'log'):
+            raise ValueError(f"Unknown replication mode: {replication}")
+        if replication == 'log' and purchase_mode == 'escrow':
+            raise ValueError("The escrow purchase mode cannot be combined with the replicated log")
+        if codec not in ('binary', 'json'):
+            raise ValueError(f"Unknown codec: {codec}")
+        if dissemination not in ('direct', 'gossip', 'tree'):
+            raise ValueError(f"Unknown dissemination: {dissemination}")
+        self.id_node = id_node
+        self.metrics = Metrics()
+        self.log = NodeLog(id_node, log_level, self.metrics)
+        self.port = port
+        self.ip = node_ip
+        self.nodes_info = nodes_info
+        self.server = None
+        self.server_ready_event = server_ready_event
+        self.base_port = base_port
+        self.runtime = runtime
+        self.codec = codec
+        self.transport = transport
+        self.scheduler = scheduler or SystemScheduler()
+        self._stopped = threading.Event()  # Detiene el servidor y los hilos de fondo (shutdown)
+        self._server_conns = set()  # Conexiones entrantes abiertas (runtime thread) o sus writers (asyncio)
+        # Mensajes y bytes del protocolo enviados/recibidos (sin latidos ni ACK)
+        self.traffic = {'messages_sent': 0, 'bytes_sent': 0, 'messages_received': 0, 'bytes_received': 0}
+        self._traffic_lock = threading.Lock()
+        self.pool = ConnectionPool(nodes_info)
+        self.async_pool = AsyncConnectionPool(nodes_info)
+        self.loop = None  # Event loop del runtime asyncio
+        self.handler_pool = None  # Hilos donde el runtime asyncio procesa los mensajes recibidos
+        self._msg_ids = itertools.count(1)  # IDs de mensaje que el receptor devuelve en su ACK
+        self.db_name = db_path or f"node_{self.id_node}.db"
+        self.storage = Storage(self.db_name, flush_interval=db_flush_interval, batch_size=db_batch_size,
+                               metrics=self.metrics)
+        self.messages = MessageLog(self.storage, capacity=history_capacity)
+        self._init_db()
+        self.inventory = InventoryCache(self.storage)
+        self.inventory.load()
+        self.replication = replication
+        self.crdt = None
+        if replication == 'crdt':
+            # El stock del catálogo lo aporta sólo el nodo de menor id de la membresía inicial
+            seeder = all(id_node < port - base_port for port in nodes_info)
+            self.crdt = PNCounterStore(self.storage, self.inventory, seeder)
+            self.crdt.load()
+            self.crdt.seed()
+        self.oplog = None
+        if replication == 'log':
+            self.oplog = OperationLog(self.storage)
+            self.oplog.load()
+        self.purchase_mode = purchase_mode
+        self.escrow_low_watermark = escrow_low_watermark
+        self.escrow = dict(self.storage.query("SELECT item_id, share FROM escrow"))  # {item_id: cuota local}
+        self.escrow_condition = threading.Condition()  # Protege escrow y despierta a quien espera préstamos
+        self._escrow_waiters = {}  # {request_id: {'granted': n, 'responses': n}}
+        self._escrow_resync = False  # Hay un sync_inventory en curso por un ESCROW_SOLD rechazado
+        self._sync_sessions = {}  # {sync_id: estadísticas de una sincronización en curso}
+        self._snapshots = {}  # {snapshot_id: progreso de un bootstrap en curso}
+        self.sync_condition = threading.Condition()
+        self.clock = 0  # Reloj lógico Lamport
+        self.resource_locks = {}  # {recurso: ResourceLock}, un candado distribuido por artículo
+        self._request_seq = 0
+        self.cs_condition = threading.Condition()  # Protege resource_locks y despierta a los solicitantes
+        self.peer_latencies = {}  # {puerto: deque de latencias (s) de entregas recientes}
+        self._latency_lock = threading.Lock()
+        self.sender_pool = self.scheduler.executor(max(4, len(nodes_info)), f"node{id_node}-send")
+        self.batcher = None
+        if batch_window > 0:
+            self.batcher = UpdateBatcher(self._send_inventory_batch, self.sender_pool,
+                                         window=batch_window, max_size=batch_max_size)
+        self.hot_days = hot_days
+        self.retention_days = retention_days
+        self.archive_interval = archive_interval
+        if archive_interval:
+            threading.Thread(target=self._archive_loop, daemon=True).start()
+        self.detector = FailureDetector(heartbeat_interval or 1.0, suspect_phi, dead_phi)
+        for port in nodes_info:
+            self.detector.add(port)
+        self.heartbeat_interval = heartbeat_interval
+        self._probing = set()  # Puertos con un latido en curso (no se acumulan sondeos a nodos caídos)
+        self._probing_lock = threading.Lock()  # El bucle de latidos y los hilos de sondeo tocan _probing
+        if heartbeat_interval:
+            threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+        self.dissemination = {
+            'direct': None, 'gossip': GossipDissemination(fanout), 'tree': TreeDissemination(fanout)
+        }[dissemination]
+        self._rumor_ids = itertools.count(1)
+        self._seen_rumors = OrderedDict()  # rumor_id -> None, los más viejos se descartan primero
+        self._seen_capacity = 65536
+        self._rumor_lock = threading.Lock()
+        self._rumor_receipts = {}  # {rumor_id: nodos que lo aplicaron} de los rumores propios en curso
+        # {rumor_id: estado} de los rumores ajenos que este nodo reenvió; se guardan un rato
+        # después de informar para pasarle al padre las confirmaciones que lleguen tarde
+        self._rumor_relays = OrderedDict()
+        self._relay_capacity = 4096
+        self._open_relays = {}  # {rumor_id: plazo} de los que todavía no informaron al padre
+        self.rumor_condition = threading.Condition()  # Protege _rumor_receipts y _rumor_relays
+        if anti_entropy_interval is None and dissemination == 'gossip':
+            anti_entropy_interval = 10.0
+        self.anti_entropy_interval = anti_entropy_interval
+        if anti_entropy_interval:
+            threading.Thread(target=self._anti_entropy_loop, daemon=True).start()
+        self.stats_server = None
+        if stats_port:
+            self.start_stats_server(stats_port)
+        self.orders = OrderQueue(self.purchase_batch, self.scheduler, max_batch=order_batch_size)
+        # Estado del log replicado (replication='log'); lo protege raft_condition
+        self.raft_condition = threading.Condition()
+        self.raft_role = 'follower'  # 'follower', 'candidate' o 'leader'
+        self.leader_port = None
+        self.election_timeout = election_timeout
+        self.log_batch_size = log_batch_size
+        self.log_max_inflight = log_max_inflight
+        self.commit_index = 0
+        self._election_deadline = 0
+        self._votes = set()
+        self._followers = {}  # {puerto: progreso de la replicación hacia ese seguidor} (en el líder)
+        self._log_waiters = {}  # {request_id: resultado} de operaciones enviadas desde este nodo
+        # request_id -> resultado de lo aplicado hace poco; op_log_applied tiene todo lo demás
+        self._applied_requests = OrderedDict()
+        self._applied_capacity = 65536
+        self._log_session = self.scheduler.time_ns()  # Distingue los request_id de distintos arranques
+        if self.oplog is not None:
+            self.commit_index = self.oplog.last_applied
+            self._reset_election_deadline()
+            threading.Thread(target=self._election_loop, daemon=True).start()
+            threading.Thread(target=self._log_flush_loop, daemon=True).start()
+            threading.Thread(target=self._log_apply_loop, daemon=True).start()
+        self.client_workers = client_workers
+        self.client_server = None
+        self.client_pool = None
+        self._client_conns = set()  # Conexiones abiertas de clientes programáticos
+        if client_port:
+            self.start_client_server(client_port)
+
+    def _anti_entropy_loop(self):
+        """Sincroniza periódicamente con algunos nodos para reparar actualizaciones perdidas"""
+        while not self._stopped.wait(self.anti_entropy_interval):
+            try:
+                self.sync_inventory()
+            except Exception as e:
+                self.log.error(f"Anti-entropy error: {e}")
+
+    def live_peers(self):
+        """Puertos de los demás nodos que no están marcados como muertos"""
+        return self.detector.live(list(self.nodes_info))
+
+    def _heartbeat_loop(self):
+        """Envía latidos periódicos y actualiza la vista de membresía"""
+        while not self._stopped.is_set():
+            for port in list(self.nodes_info):
+                with self._probing_lock:
+                    if port in self._probing:
+                        continue
+                    self._probing.add(port)
+                # Un hilo por sondeo: un nodo inalcanzable no ocupa el pool de envíos
+                threading.Thread(target=self._probe, args=(port,), daemon=True).start()
+            for port, old, new in self.detector.update():
+                self._on_status_change(port, old, new)
+            self._expire_rumor_relays()
+            self._stopped.wait(self.heartbeat_interval)
+
+    def _probe(self, port):
+        """Envía un latido; a los nodos muertos les sirve de sondeo para detectar su regreso"""
+        try:
+            self.send_message({'destination': port, 'content': {'type': 'HEARTBEAT', 'origin': self.id_node}})
+        finally:
+            with self._probing_lock:
+                self._probing.discard(port)
+
+    def _peer_unreachable(self, port):
+        """Un envío falló por la red: el nodo se da por muerto sin esperar al detector"""
+        self.metrics.inc('send_errors', port - self.base_port)
+        if self.detector.mark_dead(port):
+            self._on_status_change(port, 'ALIVE', 'DEAD')
+
+    def _on_status_change(self, port, old, new):
+        self.log.info(f"Node {port - self.base_port} is now {new} (was {old})")
+        if new == 'DEAD':
+            self._fail_awaiting(port)
+
+    def _fail_awaiting(self, port):
+        """
+        Hace fallar las solicitudes de candado que esperan el REPLY de un nodo que parece caído.
+        Puede estar vivo pero lento o aislado, así que no basta con dejar de esperarlo
+        """
+        with self.cs_condition:
+            for lock in self.resource_locks.values():
+                if port in lock.awaiting:
+                    lock.unreachable.add(port)
+            self.cs_condition.notify_all()
+
+    def _stop_awaiting(self, port):
+        """Los candados en espera dejan de contar con la respuesta de un nodo que salió de la membresía"""
+        with self.cs_condition:
+            for lock in self.resource_locks.values():
+                lock.awaiting.discard(port)
+                lock.unreachable.discard(port)
+            self.cs_condition.notify_all()
+
+    def add_member(self, port, ip):
+        """Agrega un nodo a la membresía en caliente; devuelve True si era nuevo"""
+        if port == self.port or self.nodes_info.get(port) == ip:
+            return False
+        self.nodes_info[port] = ip  # Mismo dict que usan los pools de conexiones
+        self.detector.add(port)
+        self.log.info(f"Node {port - self.base_port} joined ({ip}:{port})")
+        return True
+
+    def remove_member(self, port):
+        """Quita un nodo de la membresía y cierra su conexión"""
+        if self.nodes_info.pop(port, None) is None:
+            return False
+        self.detector.remove(port)
+        self.pool.close(port)
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.async_pool.close, port)
+        self._stop_awaiting(port)
+        self.log.info(f"Node {port - self.base_port} left")
+        return True
+
+    def join(self, seed_port, seed_ip, advertise_ip=None):
+        """
+        Se une a un clúster en marcha a través de un nodo semilla: la semilla responde con
+        la membresía completa y anuncia al nuevo nodo a los demás.
+
+        Args:
+            advertise_ip: IP con la que los demás contactan a este nodo (por defecto la de escucha)
+        """
+        if advertise_ip is None:
+            advertise_ip = self.ip if self.ip != '0.0.0.0' else socket.gethostbyname(socket.gethostname())
+        self.add_member(seed_port, seed_ip)
+        return self.send_message({'destination': seed_port, 'content': {
+            'type': 'JOIN', 'port': self.port, 'ip': advertise_ip, 'origin': self.id_node
+        }}, wait_ack=True)
+
+    def leave(self):
+        """Avisa a los demás nodos que este nodo sale del clúster (en escrow, antes cede su cuota)"""
+        if self.purchase_mode == 'escrow':
+            self._hand_over_escrow()
+        for port in list(self.nodes_info):
+            self.send_message({'destination': port, 'content': {'type': 'LEAVE', 'origin': self.id_node}})
+
+    def handle_join(self, message):
+        """Registra al nodo que se une, le envía la membresía y lo anuncia a los demás"""
+        port, ip = message['port'], message['ip']
+        others = [p for p in self.nodes_info if p != port]
+        self.add_member(port, ip)
+        # El nuevo nodo ya conoce a la semilla: sólo le faltan los demás
+        self._send_members(port, {str(p): addr for p, addr in self.nodes_info.items() if p != port})
+        for other in self.detector.live(others):
+            self._send_members(other, {str(port): ip})
+
+    def _send_members(self, port, members):
+        self.sender_pool.submit(self.send_message, {'destination': port, 'content': {
+            'type': 'MEMBERS', 'members': members, 'origin': self.id_node
+        }})
+
+    def handle_heartbeat(self, message):
+        port = self.base_port + message['origin']
+        previous = self.detector.heartbeat(port)
+        if previous in ('SUSPECT', 'DEAD'):
+            self._on_status_change(port, previous, 'ALIVE')
+
+    def handle_members(self, message):
+        for port, ip in message['members'].items():
+            self.add_member(int(port), ip)
+
+    def _archive_loop(self):
+        """Rota el log de mensajes al arrancar y luego cada archive_interval segundos"""
+        while not self._stopped.is_set():
+            self.rotate_history()
+            self._stopped.wait(self.archive_interval)
+
+    def rotate_history(self):
+        """
+        Mueve a archivos comprimidos los días que salieron de la ventana caliente y
+        borra los archivos que superan la retención.
+
+        Returns:
+            (filas archivadas, archivos eliminados)
+        """
+        try:
+            today = date.today()
+            self.messages.spill()
+            self.storage.flush()
+            archived = self.storage.archive_messages((today - timedelta(days=self.hot_days - 1)).isoformat())
+            pruned = 0
+            if self.retention_days is not None:
+                pruned = self.storage.prune_archives((today - timedelta(days=self.retention_days)).isoformat())
+            if archived or pruned:
+                self.log.info(f"History rotated: {archived} messages archived, "
+                              f"{pruned} archives expired")
+            return archived, pruned
+        except Exception as e:
+            self.log.error(f"History rotation error: {e}")
+            return 0, 0
+
+    def increment_clock(self):
+        """Incrementa el reloj lógico"""
+        self.clock += 1
+
+    def synchronize_clock(self, received_clock):
+        """Sincroniza el reloj lógico con un valor recibido"""
+        self.clock = max(self.clock, received_clock) + 1
+
+    def _resource_lock(self, resource):
+        """Devuelve (creándolo si hace falta) el estado del candado de un recurso; requiere cs_condition"""
+        lock = self.resource_locks.get(resource)
+        if lock is None:
+            lock = self.resource_locks[resource] = ResourceLock()
+        return lock
+
+    def request_critical_section(self, timeout=5, resources=None, action=None):
+        """
+        Solicita acceso a la sección crítica de uno o varios recursos con un timeout.
+
+        Args:
+            timeout: Tiempo máximo (s) de espera por cada recurso
+            resources: Recursos a bloquear (p. ej. item_ids); por defecto el candado global
+            action: Función a ejecutar dentro de la sección crítica (por defecto self.purchase_item)
+
+        Returns:
+            True si se ejecutó la sección crítica
+        """
+        # Orden determinista para evitar interbloqueos entre compras de varios artículos
+        resources = sorted(set(resources), key=str) if resources else [GLOBAL_RESOURCE]
+        acquired = []
+        for resource in resources:
+            if not self._acquire_resource(resource, timeout):
+                for held in reversed(acquired):
+                    self._release_resource(held)
+                return False
+            acquired.append(resource)
+
+        self.log.info("Received all necessary replies. Entering critical section.")
+        try:
+            self.enter_critical_section(action)
+        finally:
+            self.exit_critical_section(acquired)
+        return True
+
+    def _acquire_resource(self, resource, timeout):
+        """Obtiene el candado distribuido de un recurso pidiendo permiso a todos los nodos"""
+        started = self.scheduler.monotonic()
+        deadline = started + timeout
+        with self.cs_condition:
+            lock = self._resource_lock(resource)
+            # Otro hilo local ya usa o pide este recurso
+            if not self.scheduler.wait_for(self.cs_condition, lambda: lock.state == 'RELEASED', timeout):
+                self.log.warning(f"Timeout waiting for local holder of resource {resource}.")
+                self.metrics.observe('lock_acquire', self.scheduler.monotonic() - started, 'timeout')
+                return False
+            self.increment_clock()
+            self._request_seq += 1
+            request_id = f"{self.id_node}-{self._request_seq}"
+            lock.state = 'WANTED'
+            lock.request_clock = self.clock
+            lock.request_id = request_id
+            lock.replies_received = 0
+            # Se espera respuesta de toda la membresía: un nodo lento o aislado que el detector da
+            # por muerto puede tener el candado. Sólo remove_member (o su LEAVE) deja de esperarlo
+            peers = list(self.nodes_info)
+            lock.awaiting = set(peers)
+            lock.unreachable = set()
+            message = {
+                'type': 'REQUEST',
+                'resource': resource,
+                'request_id': request_id,
+                'clock': self.clock,
+                'origin': self.id_node
+            }
+
+        def on_sent(future, port):
+            if future.result():
+                if self.log.sampled():
+                    self.log.info("Sent REQUEST to Node %s", port - self.base_port)
+                return
+            self.log.warning(f"Failed to send REQUEST to Node {port - self.base_port}")
+            with self.cs_condition:
+                if lock.request_id == request_id and port in lock.awaiting:
+                    # Sin su REPLY no hay exclusión mutua: la solicitud falla en lugar de seguir sin él
+                    lock.unreachable.add(port)
+                    self.cs_condition.notify_all()
+
+        # Enviar mensaje REQUEST a todos los nodos en paralelo
+        for port in peers:
+            future = self.sender_pool.submit(self.send_message, {
+                'destination': port,
+                'content': message
+            })
+            future.add_done_callback(lambda f, port=port: on_sent(f, port))
+
+        # Esperar respuestas: handle_reply despierta este hilo con cada REPLY
+        with self.cs_condition:
+            self.scheduler.wait_for(
+                self.cs_condition, lambda: not lock.awaiting or lock.unreachable,
+                max(0, deadline - self.scheduler.monotonic())
+            )
+            if not lock.awaiting:
+                lock.state = 'HELD'
+                self.metrics.observe('lock_acquire', self.scheduler.monotonic() - started, 'acquired')
+                return True
+            if lock.unreachable:
+                self.metrics.observe('lock_acquire', self.scheduler.monotonic() - started, 'unreachable')
+                self.log.warning(f"Nodes {sorted(port - self.base_port for port in lock.unreachable)} "
+                                 f"unreachable for resource {resource}. Aborting critical section request.")
+            else:
+                self.metrics.observe('lock_acquire', self.scheduler.monotonic() - started, 'timeout')
+                self.log.warning(f"Timeout waiting for replies for resource {resource}. "
+                                 f"Aborting critical section request.")
+            self.log.warning(f"Received {lock.replies_received} replies, still missing "
+                             f"{sorted(port - self.base_port for port in lock.awaiting)}.")
+
+        # Abortamos y liberamos a los nodos que quedaron esperando nuestra respuesta
+        self._release_resource(resource)
+        return False
+
+    def _release_resource(self, resource):
+        """Libera el candado de un recurso y responde los REQUEST diferidos"""
+        with self.cs_condition:
+            lock = self._resource_lock(resource)
+            lock.state = 'RELEASED'
+            lock.request_id = None
+            deferred, lock.deferred = lock.deferred, []
+            self.cs_condition.notify_all()
+        for pending_request in deferred:
+            # Sólo un nodo que salió de la membresía ya no necesita la respuesta; uno que
+            # el detector da por muerto puede estar vivo y esperándola
+            if self.base_port + pending_request['origin'] in self.nodes_info:
+                self._send_reply(pending_request)
+
+    def handle_request(self, message):
+        """Maneja un mensaje REQUEST recibido"""
+        resource = message.get('resource', GLOBAL_RESOURCE)
+        with self.cs_condition:
+            self.synchronize_clock(message['clock'])
+            lock = self._resource_lock(resource)
+            # Diferir si tengo el recurso o si mi solicitud pendiente tiene prioridad
+            defer = lock.state == 'HELD' or (
+                lock.state == 'WANTED'
+                and (lock.request_clock, self.id_node) < (message['clock'], message['origin'])
+            )
+            if defer:
+                # Agregar la solicitud a la cola del recurso
+                lock.deferred.append(message)
+                return
+        self._send_reply(message)
+
+    def _send_reply(self, request):
+        """Envía un REPLY al origen de un REQUEST"""
+        origin = request['origin']
+        with self.cs_condition:
+            reply_message = {
+                'type': 'REPLY',
+                'resource': request.get('resource', GLOBAL_RESOURCE),
+                'request_id': request.get('request_id'),
+                'clock': self.clock,
+                'origin': self.id_node
+            }
+        self._attach_item_state(reply_message)
+        self.send_message({
+            'destination': self.base_port + origin,
+            'content': reply_message
+        })
+        if self.log.sampled():
+            self.log.info("Sent REPLY to Node %s.", origin)
+
+    def _attach_item_state(self, reply_message):
+        """
+        Agrega al REPLY la fila local del artículo bloqueado. La actualización del último dueño
+        del candado puede llegar después de su REPLY (por otro camino en gossip o árbol) o
+        perderse (sólo se espera a la mayoría); así quien entra a la sección crítica ya tiene
+        una vista al menos tan nueva como la de cada nodo.
+        """
+        item_id = reply_message['resource']
+        if self.replication == 'crdt':
+            counters = self.crdt.state([item_id])
+            if counters:
+                reply_message['counters'] = counters
+            return
+        entry = self.inventory.get(item_id)
+        if entry is not None:
+            reply_message['new_quantity'], reply_message['version'] = entry
+
+    def handle_reply(self, message):
+        """Maneja un mensaje REPLY recibido"""
+        resource = message.get('resource', GLOBAL_RESOURCE)
+        if 'counters' in message:
+            self._apply_inventory_update({'type': 'CRDT_MERGE', 'counters': message['counters']})
+        elif 'version' in message:
+            self._apply_inventory_update({'type': 'INVENTORY_UPDATE', 'item_id': resource,
+                                          'new_quantity': message['new_quantity'], 'version': message['version']})
+        with self.cs_condition:
+            self.synchronize_clock(message['clock'])
+            lock = self._resource_lock(resource)
+            if lock.request_id is None or message.get('request_id') != lock.request_id:
+                # REPLY tardío de un intento que ya expiró
+                if self.log.sampled():
+                    self.log.info("Ignored late REPLY from Node %s for request %s",
+                                  message['origin'], message.get('request_id'))
+                return
+            lock.replies_received += 1
+            lock.awaiting.discard(self.base_port + message['origin'])
+            replies = lock.replies_received
+            self.cs_condition.notify_all()
+        if self.log.sampled():
+            self.log.info("Received REPLY from Node %s for resource %s. Total replies: %s",
+                          message['origin'], resource, replies)
+
+    def enter_critical_section(self, action=None):
+        """Entra en la sección crítica"""
+        self.log.debug("In critical section.")
+        # Aquí se realiza la operación crítica (por ejemplo, comprar un artículo)
+        (action or self.purchase_item)()
+
+    def exit_critical_section(self, resources=(GLOBAL_RESOURCE,)):
+        """Sale de la sección crítica liberando los recursos en orden inverso"""
+        self.log.debug("Exiting critical section.")
+        for resource in reversed(list(resources)):
+            self._release_resource(resource)
+
+    def purchase_items(self, order, timeout=5):
+        """
+        Compra uno o varios artículos bajo exclusión mutua por artículo.
+
+        Args:
+            order: Diccionario {item_id: cantidad}
+
+        Returns:
+            True si se compraron todos los artículos
+        """
+        started = self.scheduler.monotonic()
+        if self.replication == 'log':
+            ok = self.submit_operations([self._purchase_operation(order)], timeout=timeout)[0]
+        elif self.purchase_mode == 'escrow':
+            ok = self.escrow_purchase(order, timeout=timeout)
+        else:
+            ok = self._locked_purchase(order, timeout)
+        self.metrics.observe('purchase', self.scheduler.monotonic() - started, 'ok' if ok else 'failed')
+        return ok
+
+    @staticmethod
+    def _purchase_operation(order):
+        """Operación del log replicado para un pedido (pares en lista: las claves JSON serían texto)"""
+        return {'op': 'purchase', 'order': [[item_id, quantity] for item_id, quantity in order.items()]}
+
+    def _locked_purchase(self, order, timeout):
+        """Compra dentro de la sección crítica de los artículos del pedido"""
+        result = {'ok': False}
+
+        def purchase():
+            missing = [item_id for item_id in order if self.inventory.get(item_id) is None]
+            if missing:
+                self.log.warning(f"Error: Items {missing} not found in inventory")
+                return
+            done = []
+            for item_id, quantity in order.items():
+                if not self.update_inventory(item_id, -quantity):
+                    # Compensar los artículos ya comprados de este pedido
+                    for bought_id, bought_quantity in reversed(done):
+                        self.update_inventory(bought_id, bought_quantity)
+                    return
+                done.append((item_id, quantity))
+            result['ok'] = True
+
+        if not self.request_critical_section(timeout=timeout, resources=list(order), action=purchase):
+            return False
+        return result['ok']
+
+    def queue_purchase(self, order, timeout=5):
+        """
+        Como purchase_items, pero el pedido espera en self.orders y se atiende junto con
+        los que lleguen a la vez, en una sola entrada a la sección crítica.
+
+        Args:
+            order: Diccionario {item_id: cantidad}
+
+        Returns:
+            True si se compraron todos los artículos
+        """
+        started = self.scheduler.monotonic()
+        ok = self.orders.submit(order, timeout)
+        self.metrics.observe('purchase', self.scheduler.monotonic() - started, 'ok' if ok else 'failed')
+        return ok
+
+    def purchase_batch(self, orders, timeout=5):
+        """
+        Atiende varios pedidos con una sola entrada a la sección crítica de la unión de sus artículos.
+        Cada pedido se acepta o se rechaza por separado; el stock de cada artículo se
+        descuenta (y se replica) una sola vez por lote.
+
+        Args:
+            orders: Lista de diccionarios {item_id: cantidad}
+
+        Returns:
+            Lista con un bool por pedido
+        """
+        if not orders:
+            return []
+        started = self.scheduler.monotonic()
+        if self.replication == 'log':
+            # Sin candados: el orden del log decide y todo el lote viaja en las mismas rondas
+            results = self.submit_operations([self._purchase_operation(order) for order in orders], timeout)
+        elif self.purchase_mode == 'escrow':
+            # Sin candados: cada pedido vende de la cuota local
+            results = [self.escrow_purchase(order, timeout=timeout) for order in orders]
+        else:
+            results = [False] * len(orders)
+
+            def purchase():
+                results[:] = self._apply_order_batch(orders)
+
+            resources = {item_id for order in orders for item_id in order}
+            self.request_critical_section(timeout=timeout, resources=list(resources), action=purchase)
+        self.metrics.inc('orders_batched', amount=len(orders))
+        self.metrics.observe('purchase_batch', self.scheduler.monotonic() - started,
+                             'ok' if all(results) else 'partial')
+        return results
+
+    def _apply_order_batch(self, orders):
+        """Aplica un lote de pedidos dentro de la sección crítica; devuelve un bool por pedido"""
+        accepted = [False] * len(orders)
+        totals = {}  # {item_id: unidades que descuenta el lote}
+        for index, order in enumerate(orders):
+            missing = [item_id for item_id in order if self.inventory.get(item_id) is None]
+            if missing:
+                self.log.warning(f"Error: Items {missing} not found in inventory")
+                continue
+            if any(self.inventory.quantity(item_id) - totals.get(item_id, 0) < quantity
+                   for item_id, quantity in order.items()):
+                self.log.warning(f"Error: Not enough stock for order {order}")
+                continue
+            for item_id, quantity in order.items():
+                totals[item_id] = totals.get(item_id, 0) + quantity
+            accepted[index] = True
+
+        # Un único cambio (y una única ronda de replicación) por artículo
+        failed = set()
+        for item_id, total in sorted(totals.items()):
+            if not self.update_inventory(item_id, -total):
+                failed.add(item_id)
+        if failed:
+            # Los pedidos con algún artículo fallido se rechazan y se devuelve lo ya descontado
+            refunds = {}
+            for index, order in enumerate(orders):
+                if accepted[index] and failed.intersection(order):
+                    accepted[index] = False
+                    for item_id, quantity in order.items():
+                        if item_id not in failed:
+                            refunds[item_id] = refunds.get(item_id, 0) + quantity
+            for item_id, quantity in refunds.items():
+                self.update_inventory(item_id, quantity)
+        return accepted
+
+    def restock(self, item_id, quantity, timeout=5):
+        """
+        Repone stock de un artículo existente.
+        En modo 'lock' el cambio se hace dentro de la sección crítica del artículo, para no
+        competir por la misma versión con una compra; en 'escrow' se suma a la cuota local.
+
+        Returns:
+            True si se repuso el stock
+        """
+        if quantity <= 0:
+            raise ValueError("Restock quantity must be positive")
+        if self.inventory.get(item_id) is None:
+            self.log.warning(f"Error: Item {item_id} not found in inventory")
+            return False
+        if self.replication == 'log':
+            return self.submit_operations([{'op': 'adjust', 'item_id': item_id, 'delta': quantity}], timeout)[0]
+        if self.purchase_mode == 'escrow':
+            with self.escrow_condition:
+                self._set_escrow_shares({item_id: quantity})
+            self.inventory.apply_delta(item_id, quantity)
+            # Una venta negativa: los demás nodos suman las unidades a su vista local
+            self._broadcast_async({'type': 'ESCROW_SOLD', 'item_id': item_id, 'quantity': -quantity})
+            return True
+
+        result = {'ok': False}
+
+        def restock():
+            result['ok'] = self.update_inventory(item_id, quantity)
+
+        if not self.request_critical_section(timeout=timeout, resources=[item_id], action=restock):
+            return False
+        return result['ok']
+
+    def _majority(self):
+        return (len(self.nodes_info) + 1) // 2 + 1
+
+    def _reset_election_deadline(self):
+        """Sortea el próximo timeout de elección entre 1x y 2x election_timeout"""
+        self._election_deadline = (self.scheduler.monotonic()
+                                   + random.uniform(self.election_timeout, 2 * self.election_timeout))
+
+    def _election_loop(self):
+        """Inicia una elección cuando el líder deja de dar señales"""
+        while not self._stopped.wait(self.election_timeout / 10):
+            with self.raft_condition:
+                expired = (self.raft_role != 'leader'
+                           and self.scheduler.monotonic() >= self._election_deadline)
+            if expired:
+                self._start_election()
+
+    def _start_election(self):
+        """Pasa a candidato en un término nuevo, se vota y pide el voto a los demás nodos"""
+        with self.raft_condition:
+            term = self.oplog.term + 1
+            self.oplog.save_vote(term, self.id_node)
+            self.raft_role = 'candidate'
+            self.leader_port = None
+            self._votes = {self.id_node}
+            self._reset_election_deadline()
+            request = {
+                'type': 'LOG_VOTE_REQUEST',
+                'term': term,
+                'last_index': self.oplog.last_index,
+                'last_term': self.oplog.last_term(),
+                'origin': self.id_node
+            }
+            if len(self._votes) >= self._majority():
+                self._become_leader()
+                return
+        self.log.info(f"Starting election for term {term}")
+        for port in list(self.nodes_info):
+            self.sender_pool.submit(self.send_message, {'destination': port, 'content': request})
+
+    def _step_down(self, term):
+        """Adopta un término mayor visto en otro nodo y vuelve a seguidor; requiere raft_condition"""
+        if term > self.oplog.term:
+            self.oplog.save_vote(term, None)
+        if self.raft_role != 'follower':
+            self.log.info(f"Stepping down to follower in term {term}")
+        self.raft_role = 'follower'
+        self.raft_condition.notify_all()
+
+    def _become_leader(self):
+        """Asume el liderazgo del término actual; requiere raft_condition"""
+        term = self.oplog.term
+        self.raft_role = 'leader'
+        self.leader_port = self.port
+        self._followers = {
+            port: {'next': self.oplog.last_index + 1, 'match': 0, 'inflight': deque(),
+                   'sent_at': 0, 'commit_sent': 0}
+            for port in self.nodes_info
+        }
+        # Una entrada vacía del término nuevo permite confirmar lo que quedó de términos anteriores
+        self.oplog.append(term, [{'op': 'noop'}])
+        for port in self._followers:
+            threading.Thread(target=self._replicate_to, args=(port, term), daemon=True).start()
+        self.raft_condition.notify_all()
+        self.log.info(f"Elected leader for term {term}")
+
+    def handle_log_vote_request(self, message):
+        """Concede el voto si no votó a otro en este término y el log del candidato está al día"""
+        with self.raft_condition:
+            if message['term'] > self.oplog.term:
+                self._step_down(message['term'])
+            up_to_date = ((message['last_term'], message['last_index'])
+                          >= (self.oplog.last_term(), self.oplog.last_index))
+            granted = (message['term'] == self.oplog.term and up_to_date
+                       and self.oplog.voted_for in (None, message['origin']))
+            if granted:
+                self.oplog.save_vote(message['term'], message['origin'])
+                self._reset_election_deadline()
+            reply = {'type': 'LOG_VOTE', 'term': self.oplog.term, 'granted': granted, 'origin': self.id_node}
+        self.send_message({'destination': self.base_port + message['origin'], 'content': reply})
+
+    def handle_log_vote(self, message):
+        with self.raft_condition:
+            if message['term'] > self.oplog.term:
+                self._step_down(message['term'])
+                return
+            if self.raft_role != 'candidate' or message['term'] != self.oplog.term or not message['granted']:
+                return
+            self._votes.add(message['origin'])
+            if len(self._votes) >= self._majority():
+                self._become_leader()
+
+    def _replicate_to(self, port, term):
+        """
+        Envía el log a un seguidor mientras este nodo sea líder del término `term`.
+        Mantiene hasta log_max_inflight lotes sin respuesta (pipelining); sin nada nuevo
+        envía un LOG_APPEND vacío como latido, que además lleva el índice confirmado.
+        """
+        follower = self._followers[port]
+        heartbeat = self.election_timeout / 4
+        while not self._stopped.is_set():
+            with self.raft_condition:
+                while True:
+                    if self.raft_role != 'leader' or self.oplog.term != term or self._stopped.is_set():
+                        return
+                    now = self.scheduler.monotonic()
+                    if follower['inflight'] and now - follower['inflight'][0][1] > self.election_timeout:
+                        # Lotes sin respuesta: se reenvía desde lo último confirmado
+                        follower['inflight'].clear()
+                        follower['next'] = follower['match'] + 1
+                    has_entries = (follower['next'] <= self.oplog.last_index
+                                   and len(follower['inflight']) < self.log_max_inflight)
+                    if (has_entries or follower['commit_sent'] < self.commit_index
+                            or now - follower['sent_at'] >= heartbeat):
+                        break
+                    self.raft_condition.wait(heartbeat - (now - follower['sent_at']))
+                prev_index = follower['next'] - 1
+                entries = self.oplog.entries_from(follower['next'], self.log_batch_size) if has_entries else []
+                message = {
+                    'type': 'LOG_APPEND',
+                    'term': term,
+                    'prev_index': prev_index,
+                    'prev_term': self.oplog.term_at(prev_index),
+                    'entries': entries,
+                    'commit': self.commit_index,
+                    'origin': self.id_node
+                }
+                if entries:
+                    follower['next'] += len(entries)
+                    follower['inflight'].append((prev_index + len(entries), now))
+                follower['sent_at'] = now
+                follower['commit_sent'] = self.commit_index
+            if entries:
+                self.metrics.inc('log_entries_sent', port - self.base_port, len(entries))
+            if not self.send_message({'destination': port, 'content': message}):
+                with self.raft_condition:
+                    follower['inflight'].clear()
+                    follower['next'] = follower['match'] + 1
+                # Un seguidor caído no avanza: se reintenta con la cadencia de una elección
+                self._stopped.wait(self.election_timeout)
+
+    def handle_log_append(self, message):
+        """Seguidor: agrega al log lo que envía el líder si coincide con lo anterior y responde"""
+        leader = message['origin']
+        with self.raft_condition:
+            term = self.oplog.term
+            if message['term'] < term:
+                success, match = False, 0
+            else:
+                if message['term'] > term or self.raft_role != 'follower':
+                    self._step_down(message['term'])
+                    term = message['term']
+                self.leader_port = self.base_port + leader
+                self._reset_election_deadline()
+                prev_index = message['prev_index']
+                if prev_index > self.oplog.last_index:
+                    success, match = False, self.oplog.last_index
+                elif self.oplog.term_at(prev_index) != message['prev_term']:
+                    # Lo ya confirmado coincide seguro con el líder: se reintenta desde ahí
+                    success, match = False, min(self.commit_index, prev_index - 1)
+                else:
+                    success = True
+                    match = self.oplog.merge(prev_index, message['entries'])
+                    if message['commit'] > self.commit_index:
+                        self.commit_index = min(message['commit'], match)
+                        self.raft_condition.notify_all()
+        self.send_message({'destination': self.base_port + leader, 'content': {
+            'type': 'LOG_APPEND_RESULT',
+            'term': term,
+            'success': success,
+            'match': match,
+            'prev_index': message['prev_index'],
+            'origin': self.id_node
+        }})
+
+    def handle_log_append_result(self, message):
+        """Líder: registra hasta dónde coincide cada seguidor y avanza el índice confirmado"""
+        with self.raft_condition:
+            if message['term'] > self.oplog.term:
+                self._step_down(message['term'])
+                return
+            follower = self._followers.get(self.base_port + message['origin'])
+            if self.raft_role != 'leader' or message['term'] != self.oplog.term or follower is None:
+                return
+            if message['success']:
+                follower['match'] = max(follower['match'], message['match'])
+                while follower['inflight'] and follower['inflight'][0][0] <= follower['match']:
+                    follower['inflight'].popleft()
+                self._advance_commit()
+            elif message['prev_index'] < follower['next']:
+                # Los lotes enviados detrás del rechazado también fallarán: se reenvía desde `match`
+                follower['inflight'].clear()
+                follower['next'] = max(follower['match'], message['match']) + 1
+            self.raft_condition.notify_all()
+
+    def _advance_commit(self):
+        """Confirma el mayor índice que ya está en la mayoría de los logs; requiere raft_condition"""
+        matches = sorted([self.oplog.persisted] + [f['match'] for f in self._followers.values()], reverse=True)
+        index = matches[self._majority() - 1]
+        # Sólo se cuentan réplicas de entradas del término actual (las anteriores quedan confirmadas con ellas)
+        if index > self.commit_index and self.oplog.term_at(index) == self.oplog.term:
+            self.commit_index = index
+            self.raft_condition.notify_all()
+
+    def _log_flush_loop(self):
+        """
+        Líder: persiste en una sola transacción todo lo agregado desde la escritura anterior
+        (group commit) y recalcula el índice confirmado. Las entradas se envían a los
+        seguidores sin esperar esta escritura; el líder sólo se cuenta cuando terminó.
+        """
+        while not self._stopped.is_set():
+            with self.raft_condition:
+                self.raft_condition.wait_for(
+                    lambda: self.oplog.last_index > self.oplog.persisted or self._stopped.is_set(),
+                    timeout=self.election_timeout
+                )
+            try:
+                self.oplog.flush()
+            except Exception as e:
+                self.log.error(f"Error persisting log entries: {e}")
+                self._stopped.wait(self.election_timeout)
+                continue
+            with self.raft_condition:
+                if self.raft_role == 'leader':
+                    self._advance_commit()
+
+    def _log_apply_loop(self):
+        """Aplica al inventario, en orden, las entradas confirmadas"""
+        while not self._stopped.is_set():
+            with self.raft_condition:
+                self.raft_condition.wait_for(
+                    lambda: self.commit_index > self.oplog.last_applied or self._stopped.is_set(),
+                    timeout=self.election_timeout
+                )
+                target = self.commit_index
+            start = self.oplog.last_applied + 1
+            if target < start:
+                continue
+            try:
+                entries = self.oplog.entries_from(start, target - start + 1)
+                results = {}
+                with self.inventory.lock, self.storage.transaction('op_log_apply'):
+                    for index, (_, op) in enumerate(entries, start):
+                        results[op.get('request_id')] = self._apply_operation(op, index)
+                    self.oplog.mark_applied(start + len(entries) - 1)
+                for request_id, result in results.items():
+                    self._remember_applied(request_id, result)
+            except Exception as e:
+                self.log.error(f"Error applying log entries {start}-{target}: {e}")
+                self._stopped.wait(self.election_timeout)
+                continue
+            with self.raft_condition:
+                for request_id, result in results.items():
+                    if request_id in self._log_waiters:
+                        self._log_waiters[request_id] = result
+                self.raft_condition.notify_all()
+
+    def _remember_applied(self, request_id, result):
+        if request_id is None:
+            return
+        self._applied_requests[request_id] = result
+        if len(self._applied_requests) > self._applied_capacity:
+            self._applied_requests.popitem(last=False)
+
+    def _apply_operation(self, op, index):
+        """
+        Aplica la operación confirmada en `index`; todos los nodos obtienen el mismo resultado
+        porque la aplican sobre el mismo estado y en el mismo orden. Hay que llamarla dentro
+        de la transacción que avanza last_applied.
+        """
+        request_id = op.get('request_id')
+        if request_id in self._applied_requests:
+            # Reintento de una operación aplicada hace poco
+            return bool(self._applied_requests[request_id])
+        if request_id is not None:
+            found, result = self.oplog.applied_result(request_id)
+            if found:
+                # Reintento de una operación aplicada antes (quizá antes de reiniciar)
+                return bool(result)
+        if op['op'] == 'purchase':
+            changes = [(item_id, -quantity) for item_id, quantity in op['order']]
+        elif op['op'] == 'adjust':
+            changes = [(op['item_id'], op['delta'])]
+        else:
+            changes = []
+        ok = all(self.inventory.get(item_id) is not None and self.inventory.quantity(item_id) + delta >= 0
+                 for item_id, delta in changes)
+        if ok:
+            for item_id, delta in changes:
+                self.inventory.apply_delta(item_id, delta)
+        if request_id is not None:
+            self.oplog.record_applied(request_id, index, ok)
+        return ok
+
+    def submit_operations(self, ops, timeout=5):
+        """
+        Agrega operaciones al log replicado y espera a que se apliquen.
+        Desde un seguidor se reenvían al líder con LOG_SUBMIT; si no hay líder o el envío
+        falla se reintenta hasta el timeout (un reintento que llega dos veces se aplica una sola).
+
+        Args:
+            ops: Lista de operaciones ({'op': 'purchase', 'order': [[item_id, cantidad]]} o
+                {'op': 'adjust', 'item_id': ..., 'delta': ...})
+
+        Returns:
+            Lista con un bool por operación; False también si no se confirmó a tiempo
+            (en ese caso la operación aún puede aplicarse más tarde)
+        """
+        started = self.scheduler.monotonic()
+        deadline = started + timeout
+        with self.raft_condition:
+            ops = [dict(op, request_id=f"{self.id_node}-{self._log_session}-{next(self._msg_ids)}")
+                   for op in ops]
+            for op in ops:
+                self._log_waiters[op['request_id']] = None
+
+        def pending():
+            return [op for op in ops if self._log_waiters[op['request_id']] is None]
+
+        appended_term = None  # Término en que este nodo, como líder, ya agregó las operaciones
+        try:
+            while self.scheduler.monotonic() < deadline:
+                with self.raft_condition:
+                    undone = pending()
+                    if not undone:
+                        break
+                    if self.raft_role == 'leader' and appended_term != self.oplog.term:
+                        appended_term = self.oplog.term
+                        self.oplog.append(self.oplog.term, undone)
+                        self.raft_condition.notify_all()
+                    leader_port = self.leader_port
+                if leader_port not in (None, self.port):
+                    self.send_message({'destination': leader_port, 'content': {
+                        'type': 'LOG_SUBMIT', 'ops': undone, 'origin': self.id_node
+                    }})
+                with self.raft_condition:
+                    # Sin líder conocido se espera a que termine una elección; si no, a la aplicación o al reintento
+                    if leader_port is None:
+                        predicate = lambda: not pending() or self.leader_port is not None
+                    else:
+                        predicate = lambda: not pending()
+                    self.raft_condition.wait_for(
+                        predicate, min(2 * self.election_timeout, max(0, deadline - self.scheduler.monotonic()))
+                    )
+        finally:
+            with self.raft_condition:
+                results = [self._log_waiters.pop(op['request_id']) is True for op in ops]
+        self.metrics.observe('log_commit', self.scheduler.monotonic() - started,
+                             'ok' if all(results) else 'failed')
+        return results
+
+    def handle_log_submit(self, message):
+        """Líder: agrega al log las operaciones que reenvía un seguidor (si ya no es líder, las ignora)"""
+        with self.raft_condition:
+            if self.raft_role != 'leader':
+                return
+            self.oplog.append(self.oplog.term, message['ops'])
+            self.raft_condition.notify_all()
+
+    def log_status(self):
+        """Rol, término, líder e índices del log replicado (None fuera de replication='log')"""
+        if self.oplog is None:
+            return None
+        with self.raft_condition:
+            return {
+                'role': self.raft_role,
+                'term': self.oplog.term,
+                'leader': None if self.leader_port is None else self.leader_port - self.base_port,
+                'last_index': self.oplog.last_index,
+                'commit_index': self.commit_index,
+                'last_applied': self.oplog.last_applied,
+            }
+
+    def init_escrow(self, timeout=5):
+        """
+        Toma la cuota de este nodo de cada artículo. Todas las cuotas salen de una misma base
+        acordada: el stock que veía el nodo de menor id cuando repartió y la lista de nodos
+        entre los que repartió. Los demás nodos la piden y la guardan, así que las cuotas
+        suman exactamente ese stock aunque las vistas locales difieran.
+        Un nodo que no estaba en el reparto (se unió después) empieza sin cuota y pide
+        prestado al vender; los artículos que ya tienen cuota no cambian.
+
+        Returns:
+            True si se obtuvo la base del reparto
+        """
+        basis = self._escrow_basis()
+        if not set(self.inventory.items()) <= set(basis):
+            if self._is_escrow_coordinator():
+                basis = self._create_escrow_basis()
+            else:
+                basis = self._fetch_escrow_basis(timeout) or basis
+                if not basis:
+                    self.log.warning("Escrow basis not available; selling only borrowed stock")
+                    return False
+        with self.escrow_condition:
+            with self.storage.transaction() as cursor:
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO escrow_basis (item_id, quantity, members) VALUES (?, ?, ?)",
+                    [(item_id, quantity, json.dumps(members)) for item_id, (quantity, members) in basis.items()]
+                )
+                for item_id, (quantity, members) in basis.items():
+                    if item_id in self.escrow:
+                        continue
+                    share = 0
+                    if self.id_node in members:
+                        rank = members.index(self.id_node)
+                        share = quantity // len(members) + (1 if rank < quantity % len(members) else 0)
+                    cursor.execute("INSERT INTO escrow (item_id, share) VALUES (?, ?)", (item_id, share))
+                    self.escrow[item_id] = share
+        self.log.info(f"Escrow initialized for {len(self.escrow)} items.")
+        return True
+
+    def _escrow_basis(self):
+        """{item_id: (stock repartido, [ids de nodo])} de la base guardada"""
+        return {item_id: (quantity, json.loads(members)) for item_id, quantity, members
+                in self.storage.query("SELECT item_id, quantity, members FROM escrow_basis")}
+
+    def _is_escrow_coordinator(self):
+        """El nodo de menor id de la membresía es el que fija la base del reparto"""
+        return all(self.id_node < port - self.base_port for port in self.nodes_info)
+
+    def _create_escrow_basis(self):
+        """Fija, con el stock local, la base de los artículos que todavía no la tienen"""
+        members = json.dumps(sorted([self.id_node] + [port - self.base_port for port in self.nodes_info]))
+        with self.storage.transaction() as cursor:
+            cursor.executemany(
+                "INSERT OR IGNORE INTO escrow_basis (item_id, quantity, members) VALUES (?, ?, ?)",
+                [(item_id, quantity, members) for item_id, (quantity, _) in self.inventory.items().items()]
+            )
+        return self._escrow_basis()
+
+    def _fetch_escrow_basis(self, timeout=5):
+        """Pide la base a los demás nodos; devuelve la primera que llega (o None)"""
+        with self.escrow_condition:
+            self._request_seq += 1
+            request_id = f"{self.id_node}-basis-{self._request_seq}"
+            waiter = self._escrow_waiters[request_id] = {'basis': None, 'responses': 0}
+        peers = self.live_peers()
+        for port in peers:
+            self.sender_pool.submit(self.send_message, {'destination': port, 'content': {
+                'type': 'ESCROW_BASIS_REQUEST', 'request_id': request_id, 'origin': self.id_node
+            }})
+        with self.escrow_condition:
+            self.scheduler.wait_for(
+                self.escrow_condition,
+                lambda: waiter['basis'] is not None or waiter['responses'] >= len(peers),
+                timeout
+            )
+            del self._escrow_waiters[request_id]
+        return waiter['basis']
+
+    def handle_escrow_basis_request(self, message):
+        """Responde con la base del reparto; el nodo de menor id la fija si todavía no existe"""
+        basis = self._escrow_basis()
+        if not set(self.inventory.items()) <= set(basis) and self._is_escrow_coordinator():
+            basis = self._create_escrow_basis()
+        self.send_message({'destination': self.base_port + message['origin'], 'content': {
+            'type': 'ESCROW_BASIS',
+            'request_id': message['request_id'],
+            'basis': {str(item_id): [quantity, nodes] for item_id, (quantity, nodes) in basis.items()},
+            'origin': self.id_node
+        }})
+
+    def handle_escrow_basis(self, message):
+        with self.escrow_condition:
+            waiter = self._escrow_waiters.get(message['request_id'])
+            if waiter is None:
+                return
+            waiter['responses'] += 1
+            if message['basis'] and waiter['basis'] is None:
+                waiter['basis'] = {int(item_id): (quantity, members)
+                                   for item_id, (quantity, members) in message['basis'].items()}
+            self.escrow_condition.notify_all()
+
+    def _hand_over_escrow(self):
+        """Al salir del clúster, cede toda la cuota local al nodo vivo de menor id"""
+        peers = self.live_peers()
+        if not peers:
+            return
+        port = min(peers)
+        with self.escrow_condition:
+            shares = {item_id: share for item_id, share in self.escrow.items() if share > 0}
+            # Se descuenta antes de enviar, como en handle_escrow_request
+            self._set_escrow_shares({item_id: -share for item_id, share in shares.items()})
+        for item_id, share in shares.items():
+            self.send_message({'destination': port, 'content': {
+                'type': 'ESCROW_GRANT', 'request_id': None, 'item_id': item_id, 'amount': share,
+                'origin': self.id_node
+            }}, wait_ack=True)
+        self.log.info(f"Handed over escrow shares of {len(shares)} items to Node {port - self.base_port}")
+
+    def _set_escrow_shares(self, changes):
+        """Aplica {item_id: delta} a las cuotas locales de forma durable; requiere escrow_condition"""
+        with self.storage.transaction() as cursor:
+            for item_id, delta in changes.items():
+                share = self.escrow.get(item_id, 0) + delta
+                cursor.execute("""
+                    INSERT INTO escrow (item_id, share) VALUES (?, ?)
+                    ON CONFLICT(item_id) DO UPDATE SET share = excluded.share
+                """, (item_id, share))
+        for item_id, delta in changes.items():
+            self.escrow[item_id] = self.escrow.get(item_id, 0) + delta
+
+    def escrow_purchase(self, order, timeout=5):
+        """
+        Compra vendiendo de la cuota local, sin ronda de red en el caso común.
+        Si la cuota no alcanza se pide prestado a los demás nodos; nunca se vende
+        más de lo que el nodo tiene asignado, así que no hay sobreventa global.
+
+        Args:
+            order: Diccionario {item_id: cantidad}
+        """
+        with self.escrow_condition:
+            shortfall = {
+                item_id: quantity - self.escrow.get(item_id, 0)
+                for item_id, quantity in order.items()
+                if self.escrow.get(item_id, 0) < quantity
+            }
+        for item_id, missing in shortfall.items():
+            self._borrow_escrow(item_id, missing + self.escrow_low_watermark, timeout)
+
+        with self.escrow_condition:
+            if any(self.escrow.get(item_id, 0) < quantity for item_id, quantity in order.items()):
+                self.log.warning(f"Error: Not enough escrow stock for order {order}")
+                return False
+            self._set_escrow_shares({item_id: -quantity for item_id, quantity in order.items()})
+            low = [item_id for item_id in order if self.escrow[item_id] <= self.escrow_low_watermark]
+
+        for item_id, quantity in order.items():
+            try:
+                self.inventory.apply_delta(item_id, -quantity)
+            except (KeyError, ValueError) as e:
+                self.log.error(f"Error updating local inventory view for item {item_id}: {e}")
+            # Aviso sin espera para que las réplicas reflejen la venta
+            self._broadcast_async({'type': 'ESCROW_SOLD', 'item_id': item_id, 'quantity': quantity})
+        self.log.info(f"Escrow purchase completed: {order}")
+
+        # Reponer la cuota en segundo plano antes de que se agote
+        for item_id in low:
+            self.sender_pool.submit(self._borrow_escrow, item_id, self.escrow_low_watermark * 2, timeout)
+        return True
+
+    def _broadcast_async(self, content):
+        """Envía un mensaje a todos los nodos sin esperar el resultado"""
+        content = dict(content, origin=self.id_node)
+        for port in self.live_peers():
+            self.sender_pool.submit(self.send_message, {'destination': port, 'content': content})
+
+    def _borrow_escrow(self, item_id, amount, timeout=5):
+        """Pide prestado stock de un artículo a los demás nodos y espera las concesiones"""
+        with self.escrow_condition:
+            self._request_seq += 1
+            request_id = f"{self.id_node}-escrow-{self._request_seq}"
+            waiter = self._escrow_waiters[request_id] = {'granted': 0, 'responses': 0}
+        peers = self.live_peers()
+        request = {
+            'type': 'ESCROW_REQUEST',
+            'request_id': request_id,
+            'item_id': item_id,
+            'amount': amount,
+            'origin': self.id_node
+        }
+        for port in peers:
+            self.sender_pool.submit(self.send_message, {'destination': port, 'content': request})
+
+        with self.escrow_condition:
+            self.scheduler.wait_for(
+                self.escrow_condition,
+                lambda: waiter['granted'] >= amount or waiter['responses'] >= len(peers),
+                timeout
+            )
+            del self._escrow_waiters[request_id]
+            granted = waiter['granted']
+        self.log.info(f"Borrowed {granted}/{amount} units of item {item_id}")
+        return granted
+
+    def handle_escrow_request(self, message):
+        """Cede parte de la cuota local a un nodo que se quedó sin stock"""
+        item_id = message['item_id']
+        with self.escrow_condition:
+            share = self.escrow.get(item_id, 0)
+            # Se cede como mucho la mitad (redondeando hacia abajo): una cuota de 1 no se cede
+            grant = min(message['amount'], share // 2)
+            if grant > 0:
+                # Se descuenta antes de enviar: si el mensaje se pierde el stock queda sin vender, nunca duplicado
+                self._set_escrow_shares({item_id: -grant})
+        self.send_message({
+            'destination': self.base_port + message['origin'],
+            'content': {
+                'type': 'ESCROW_GRANT',
+                'request_id': message['request_id'],
+                'item_id': item_id,
+                'amount': grant,
+                'origin': self.id_node
+            }
+        })
+        if self.log.sampled():
+            self.log.info("Granted %s units of item %s to Node %s", grant, item_id, message['origin'])
+
+    def handle_escrow_grant(self, message):
+        """Suma a la cuota local el stock cedido por otro nodo"""
+        with self.escrow_condition:
+            if message['amount'] > 0:
+                # Aunque la espera haya expirado, el stock cedido nunca se descarta
+                self._set_escrow_shares({message['item_id']: message['amount']})
+            waiter = self._escrow_waiters.get(message['request_id'])
+            if waiter is not None:
+                waiter['granted'] += message['amount']
+                waiter['responses'] += 1
+            self.escrow_condition.notify_all()
+
+    def handle_escrow_sold(self, message):
+        """Refleja en la vista local una venta (o reposición) hecha por otro nodo con su propia cuota"""
+        try:
+            self.inventory.apply_delta(message['item_id'], -message['quantity'])
+        except (KeyError, ValueError) as e:
+            # La vista local quedó desfasada (un aviso perdido o desordenado): se rechaza el
+            # delta y se reconcilia con los demás nodos en lugar de dejar la vista sin cambio
+            self.log.warning("Rejected ESCROW_SOLD of %s units of item %s from Node %s: %s",
+                             message['quantity'], message['item_id'], message.get('origin'), e)
+            with self.escrow_condition:
+                if self._escrow_resync:
+                    return
+                self._escrow_resync = True
+            self.sender_pool.submit(self._resync_escrow_view)
+
+    def _resync_escrow_view(self):
+        try:
+            self.sync_inventory()
+        finally:
+            with self.escrow_condition:
+                self._escrow_resync = False
+
+    def _purchase_item_ui(self):
+        """Interfaz para comprar un artículo con exclusión mutua"""
+        try:
+            item_id = int(input("Enter the item ID to purchase: "))
+            quantity = int(input("Enter the quantity to purchase: "))
+
+            # Solicitar acceso a la sección crítica del artículo y comprar
+            if self.purchase_items({item_id: quantity}):
+                print(f"Purchased {quantity} of item {item_id}.")
+            else:
+                print(f"Failed to purchase item {item_id}.")
+
+        except ValueError:
+            print("Invalid input. Please enter numeric values.")
+
+    def _update_inventory_ui(self):
+        """Interfaz para reponer (cantidad positiva) o descontar (negativa) stock de un artículo"""
+        try:
+            item_id = int(input("Enter the item ID: "))
+            change = int(input("Enter the quantity change (+ restock, - remove): "))
+            if change == 0:
+                print("Nothing to update.")
+                return
+            ok = self.restock(item_id, change) if change > 0 else self.purchase_items({item_id: -change})
+            if ok:
+                print(f"Inventory updated for item {item_id}.")
+            else:
+                print(f"Failed to update item {item_id}.")
+
+        except ValueError:
+            print("Invalid input. Please enter numeric values.")
+
+    def _add_client_ui(self):
+        """Interfaz para registrar un cliente"""
+        name = input("Client name: ").strip()
+        if not name:
+            print("Error: Name cannot be empty")
+            return
+        email = input("Client email (optional): ").strip()
+        print(f"Client added with ID {self.add_client(name, email or None)}.")
+
+    def _view_clients(self):
+        """Muestra los clientes registrados en este nodo"""
+        print("\nClients:")
+        print("=" * 40)
+        for client_id, name, email, created in self.list_clients():
+            print(f"ID: {client_id}, Name: {name}, Email: {email or '-'}, Created: {created}")
+
+    def propagate_inventory_update(self, item_id, new_quantity, version, deadline=5.0):
+        """
+        Propaga la actualización de inventario a los demás nodos en paralelo y
+        retorna en cuanto la mayoría la confirma; las entregas restantes terminan en segundo plano.
+
+        Args:
+            deadline: Tiempo máximo (s) de espera por la mayoría
+        """
+        started = self.scheduler.monotonic()
+        # La mayoría se calcula sobre toda la membresía, pero sólo se envía a los nodos vivos
+        peers = self.live_peers()
+        total_nodes = len(self.nodes_info) + 1  # Incluye este nodo
+        majority = (total_nodes // 2) + 1
+        state = {'confirmations': 1, 'pending': len(peers)}  # Ya está confirmado localmente
+        done = threading.Condition()
+
+        if self.replication == 'crdt':
+            # Se envía el estado completo del contador: fusionarlo varias veces es inocuo
+            update_message = {
+                'type': 'CRDT_MERGE',
+                'counters': self.crdt.state([item_id]),
+                'origin': self.id_node
+            }
+        else:
+            update_message = {
+                'type': 'INVENTORY_UPDATE',
+                'item_id': item_id,
+                'new_quantity': new_quantity,
+                'version': version,
+                'origin': self.id_node
+            }
+        content = update_message
+        if self.dissemination is not None:
+            delivered = self._disseminate(update_message, deadline)
+            self.metrics.observe('quorum_wait', self.scheduler.monotonic() - started,
+                                 'confirmed' if delivered else 'not_confirmed')
+            return delivered
+
+        def delivered(port, started, ok):
+            self._record_peer_latency(port, self.scheduler.monotonic() - started)
+            with done:
+                state['pending'] -= 1
+                if ok:
+                    state['confirmations'] += 1
+                done.notify_all()
+
+        def deliver(port):
+            started = self.scheduler.monotonic()
+            try:
+                ok = self.send_message({'destination': port, 'content': content}, wait_ack=True)
+            except Exception as e:
+                self.log.error(f"Error sending inventory update to Node {port - self.base_port}: {e}")
+                ok = False
+            delivered(port, started, ok)
+
+        for port in peers:
+            if self.batcher is not None:
+                payload = {k: v for k, v in update_message.items() if k not in ('origin', 'timestamp')}
+                future = self.batcher.submit(port, item_id, payload)
+                future.add_done_callback(
+                    lambda f, port=port, started=self.scheduler.monotonic(): delivered(port, started, f.result())
+                )
+            else:
+                self.sender_pool.submit(deliver, port)
+
+        with done:
+            self.scheduler.wait_for(
+                done,
+                lambda: state['confirmations'] >= majority
+                or state['confirmations'] + state['pending'] < majority,
+                deadline
+            )
+            confirmations = state['confirmations']
+
+        # Consenso simple: mayoría
+        self.metrics.observe('quorum_wait', self.scheduler.monotonic() - started,
+                             'confirmed' if confirmations >= majority else 'not_confirmed')
+        if confirmations >= majority:
+            self.log.info(f"Inventory update confirmed by majority ({confirmations}/{total_nodes})")
+            return True
+        else:
+            self.log.warning(f"Inventory update NOT confirmed by majority ({confirmations}/{total_nodes})")
+            return False
+
+    def _remember_rumor(self, rumor_id):
+        """Registra un rumor; devuelve False si ya se había visto (duplicado)"""
+        with self._rumor_lock:
+            if rumor_id in self._seen_rumors:
+                return False
+            self._seen_rumors[rumor_id] = None
+            if len(self._seen_rumors) > self._seen_capacity:
+                self._seen_rumors.popitem(last=False)
+            return True
+
+    def _disseminate(self, payload, deadline=5.0):
+        """
+        Difunde un mensaje con la estrategia configurada (gossip o árbol). El origen sólo
+        envía a sus primeros saltos, que se encargan de hacerlo llegar al resto. Las
+        confirmaciones suben por el mismo camino (cada nodo junta en un RUMOR_RECEIPT las
+        de los nodos a los que reenvió), así que al origen sólo le escriben sus primeros
+        saltos; se espera a la mayoría igual que en 'direct'.
+
+        Returns:
+            True si la mayoría de la membresía (incluido este nodo) lo aplicó antes de `deadline`
+        """
+        started = self.scheduler.monotonic()
+        rumor_id = f"{self.id_node}-{next(self._rumor_ids)}"
+        self._remember_rumor(rumor_id)
+        majority = (len(self.nodes_info) + 1) // 2 + 1
+        with self.rumor_condition:
+            self._rumor_receipts[rumor_id] = {self.id_node}
+        try:
+            return self._spread_rumor(rumor_id, payload, majority, started + deadline)
+        finally:
+            with self.rumor_condition:
+                self._rumor_receipts.pop(rumor_id, None)
+
+    def _spread_rumor(self, rumor_id, payload, majority, deadline):
+        peers = self.live_peers()
+        rumor = {
+            'type': 'RUMOR',
+            'rumor_id': rumor_id,
+            'root': self.id_node,
+            'ttl': self.dissemination.ttl(len(self.nodes_info) + 1),
+            'payload': payload,
+            'origin': self.id_node
+        }
+        targets = self.dissemination.first_hops(self.port, peers)
+        if not targets:
+            return majority <= 1
+        timeout = max(0, deadline - self.scheduler.monotonic())
+        # Cada nivel tiene la mitad del plazo de su padre para juntar las confirmaciones de abajo
+        rumor['timeout'] = timeout / 2
+        for port in targets:
+            self.sender_pool.submit(self._relay, port, rumor, peers, timeout)
+        with self.rumor_condition:
+            self.scheduler.wait_for(
+                self.rumor_condition, lambda: len(self._rumor_receipts[rumor_id]) >= majority,
+                max(0, deadline - self.scheduler.monotonic())
+            )
+            confirmations = len(self._rumor_receipts[rumor_id])
+        if confirmations >= majority:
+            self.log.info(f"Rumor {rumor_id} ({payload['type']}) applied by majority "
+                          f"({confirmations}/{len(self.nodes_info) + 1})")
+            return True
+        self.log.warning(f"Rumor {rumor_id} ({payload['type']}) NOT applied by majority "
+                         f"({confirmations}/{len(self.nodes_info) + 1})")
+        return False
+
+    def handle_rumor_receipt(self, message):
         """
-        Args:
-            id_node: Identificador único del nodo (1, 2, 3...)
-            port: Puerto de escucha
-            nodes_info: Diccionario {puerto: ip} de nodos disponibles
-            node_ip: IP del nodo
-            server_ready_event: Evento para sincronización
-            base_port: Puerto base para cálculo de IDs
+        Junta las confirmaciones (`nodes`) de un nodo al que se le reenvió un rumor: si el
+        rumor es propio se cuentan; si sólo se reenvió, se suman a las que se informarán al padre.
         """
-        self.id_node = id_node
-        self.port = port
-        self.ip = node_ip
-        self.nodes_info = nodes_info
-        self.messages = []
-        self.server = None
-        self.server_ready_event = server_ready_event
-        self.base_port = base_port
-        self.db_name = f"node_{self.id_node}.db"
-        self._init_db()
-        self.clock = 0  # Reloj lógico Lamport
-        self.request_queue = []  # Cola de solicitudes pendientes
-        self.in_critical_section = False  # Indica si el nodo está en la sección crítica
-        self.replies_received = 0  # Contador de respuestas REPLY
+        rumor_id = message['rumor_id']
+        late = None
+        with self.rumor_condition:
+            receipts = self._rumor_receipts.get(rumor_id)
+            if receipts is not None:
+                receipts.update(message['nodes'])
+                self.rumor_condition.notify_all()
+                return
+            relay = self._rumor_relays.get(rumor_id)
+            if relay is None:
+                return
+            if relay['reported']:
+                # Llegó después de informar al padre: se le pasa sólo lo nuevo
+                late = set(message['nodes']) - relay['nodes']
+            relay['nodes'].update(message['nodes'])
+            relay['reporters'].add(self.base_port + message['origin'])
+        if late:
+            self._send_rumor_receipt(relay['parent'], rumor_id, late)
+        elif late is None:
+            self._report_rumor(rumor_id)
+        self._expire_rumor_relays()
 
-    def increment_clock(self):
-        """Incrementa el reloj lógico"""
-        self.clock += 1
+    def _send_rumor_receipt(self, port, rumor_id, nodes):
+        self.send_message({'destination': port, 'content': {
+            'type': 'RUMOR_RECEIPT', 'rumor_id': rumor_id, 'nodes': sorted(nodes), 'origin': self.id_node
+        }})
 
-    def synchronize_clock(self, received_clock):
-        """Sincroniza el reloj lógico con un valor recibido"""
-        self.clock = max(self.clock, received_clock) + 1
+    def _report_rumor(self, rumor_id, expired=False):
+        """
+        Informa al padre los nodos que aplicaron un rumor reenviado cuando terminaron los
+        reenvíos y respondieron todos los que lo recibieron (o, con `expired`, venció el plazo).
+        """
+        with self.rumor_condition:
+            relay = self._rumor_relays.get(rumor_id)
+            if relay is None or relay['reported']:
+                return
+            if not expired and (relay['relaying'] or not relay['delivered'] <= relay['reporters']):
+                return
+            relay['reported'] = True
+            self._open_relays.pop(rumor_id, None)
+            nodes = set(relay['nodes'])
+        self._send_rumor_receipt(relay['parent'], rumor_id, nodes)
 
-    def request_critical_section(self, timeout=5):
-        """Solicita acceso a la sección crítica con un timeout"""
-        self.increment_clock()
-        self.in_critical_section = True
-        self.replies_received = 0
-        self.pending_replies = len(self.nodes_info)  # Número de nodos de los que se espera respuesta
+    def _expire_rumor_relays(self):
+        """Informa lo que haya de los rumores reenviados cuyo plazo venció (un hijo cayó tras recibirlo)"""
+        now = self.scheduler.monotonic()
+        with self.rumor_condition:
+            expired = [rumor_id for rumor_id, deadline in self._open_relays.items() if deadline <= now]
+        for rumor_id in expired:
+            self._report_rumor(rumor_id, expired=True)
 
-        # Enviar mensaje REQUEST a todos los nodos
-        for port, ip in self.nodes_info.items():
-            message = {
-                'type': 'REQUEST',
-                'clock': self.clock,
-                'origin': self.id_node,
-                'timestamp': datetime.now().isoformat()
-            }
-            if self.send_message({
-                'destination': port,
-                'content': json.dumps(message)
-            }):
-                print(f"[Node {self.id_node}] Sent REQUEST to Node {port - self.base_port}")
-            else:
-                print(f"[Node {self.id_node}] Failed to send REQUEST to Node {port - self.base_port}")
-                self.pending_replies -= 1  # Reducir el número de respuestas esperadas si el nodo no está disponible
-
-        # Esperar respuestas con un timeout
-        start_time = time.time()
-        while self.replies_received < self.pending_replies:
-            if time.time() - start_time > timeout:
-                print(f"[Node {self.id_node}] Timeout waiting for replies. Aborting critical section request.")
-                print(f"[Node {self.id_node}] Received {self.replies_received} replies out of {self.pending_replies} expected.")
-                self.in_critical_section = False
-                return  # Abortamos si no recibimos suficientes respuestas
-            time.sleep(0.1)  # Esperar un breve momento antes de verificar nuevamente
-
-        # Si se recibieron suficientes respuestas, entrar en la sección crítica
-        if self.replies_received >= self.pending_replies:
-            print(f"[Node {self.id_node}] Received all necessary replies. Entering critical section.")
-            self.enter_critical_section()
+    def _relay(self, port, rumor, peers, ack_timeout=None):
+        """
+        Entrega un rumor a `port`. En modo árbol, si el hijo no responde se entrega
+        directamente a los hijos de ese hijo. Devuelve los puertos que lo recibieron.
+        """
+        if self.send_message({'destination': port, 'content': rumor}, wait_ack=True, ack_timeout=ack_timeout):
+            return [port]
+        if isinstance(self.dissemination, TreeDissemination):
+            root = self.base_port + rumor['root']
+            orphans = self.dissemination.children(port, root, peers + [self.port])
+            return [delivered for child in orphans for delivered in self._relay(child, rumor, peers, ack_timeout)]
+        return []
 
-    def handle_request(self, message):
-        """Maneja un mensaje REQUEST recibido"""
-        self.synchronize_clock(message['clock'])
-        origin = message['origin']
+    def _relay_and_report(self, port, rumor, peers):
+        """Reenvía un rumor ajeno y, si era el último reenvío pendiente, intenta informar al padre"""
+        try:
+            delivered = self._relay(port, rumor, peers)
+        finally:
+            with self.rumor_condition:
+                relay = self._rumor_relays.get(rumor['rumor_id'])
+                if relay is not None:
+                    relay['relaying'] -= 1
+                    relay['delivered'].update(delivered)
+        self._report_rumor(rumor['rumor_id'])
 
-        # Responder con REPLY si no estoy en la sección crítica o si mi solicitud tiene menor prioridad
-        if not self.in_critical_section or (self.clock, self.id_node) > (message['clock'], origin):
-            reply_message = {
-                'type': 'REPLY',
-                'clock': self.clock,
-                'origin': self.id_node,
-                'timestamp': datetime.now().isoformat()
+    def handle_rumor(self, message):
+        """
+        Aplica un rumor nuevo, lo reenvía y le informa a quien se lo mandó qué nodos lo
+        aplicaron (este y los de más abajo). Un duplicado se descarta por rumor_id y se
+        contesta con un RUMOR_RECEIPT vacío para que el emisor no lo espere.
+        """
+        rumor_id = message['rumor_id']
+        sender = self.base_port + message['origin']
+        if not self._remember_rumor(rumor_id):
+            self.sender_pool.submit(self._send_rumor_receipt, sender, rumor_id, ())
+            return
+        payload = message['payload']
+        self._dispatch(payload.get('type'), payload, 0)
+        ttl = message['ttl'] - 1
+        peers = self.live_peers()
+        targets = []
+        if ttl > 0 and self.dissemination is not None:
+            targets = self.dissemination.next_hops(self.port, self.base_port + message['root'], sender, peers)
+        if not targets:
+            self.sender_pool.submit(self._send_rumor_receipt, sender, rumor_id, (self.id_node,))
+            return
+        with self.rumor_condition:
+            self._rumor_relays[rumor_id] = {
+                'parent': sender, 'nodes': {self.id_node}, 'relaying': len(targets),
+                'delivered': set(), 'reporters': set(), 'reported': False
             }
-            self.send_message({
-                'destination': self.base_port + origin,
-                'content': json.dumps(reply_message)
-            })
-            print(f"[Node {self.id_node}] Sent REPLY to Node {origin}.")
+            self._open_relays[rumor_id] = self.scheduler.monotonic() + message['timeout']
+            if len(self._rumor_relays) > self._relay_capacity:
+                old, _ = self._rumor_relays.popitem(last=False)
+                self._open_relays.pop(old, None)
+        relayed = dict(message, ttl=ttl, origin=self.id_node, timeout=message['timeout'] / 2)
+        for port in targets:
+            self.sender_pool.submit(self._relay_and_report, port, relayed, peers)
+        self._expire_rumor_relays()
+
+    def _send_inventory_batch(self, port, updates):
+        """Envía un lote de actualizaciones ya agrupadas (lo invoca UpdateBatcher)"""
+        return self.send_message({
+            'destination': port,
+            'content': {
+                'type': 'INVENTORY_BATCH',
+                'updates': updates,
+                'origin': self.id_node
+            }
+        }, wait_ack=True)
+
+    def _apply_inventory_update(self, content):
+        """Aplica localmente, SIN propagar, un INVENTORY_UPDATE o CRDT_MERGE recibido"""
+        if content['type'] == 'CRDT_MERGE':
+            changed = self.crdt.merge(content['counters'])
+            if changed and self.log.sampled():
+                self.log.info("Inventory merged from CRDT_MERGE for items %s", changed)
+            return
+        item_id = content['item_id']
+        # Se descartan versiones viejas o repetidas
+        applied = self.inventory.apply_remote(item_id, content['new_quantity'], content['version'])
+        if not self.log.sampled():
+            return
+        if applied:
+            self.log.info("Inventory updated from INVENTORY_UPDATE for item %s", item_id)
         else:
-            # Agregar la solicitud a la cola
-            self.request_queue.append(message)
+            self.log.info("Ignored stale INVENTORY_UPDATE for item %s (version %s)", item_id, content['version'])
 
-    def handle_reply(self, message):
-        """Maneja un mensaje REPLY recibido"""
-        self.synchronize_clock(message['clock'])
-        self.replies_received += 1
-        print(f"[Node {self.id_node}] Received REPLY from Node {message['origin']}. Total replies: {self.replies_received}")
-    
-    def enter_critical_section(self):
-        """Entra en la sección crítica"""
-        print(f"[Node {self.id_node}] In critical section.")
-        # Aquí puedes realizar la operación crítica (por ejemplo, comprar un artículo)
-        self.purchase_item()
+    def _record_peer_latency(self, port, latency):
+        """Registra la latencia de una entrega a un nodo"""
+        with self._latency_lock:
+            samples = self.peer_latencies.get(port)
+            if samples is None:
+                samples = self.peer_latencies[port] = deque(maxlen=256)
+            samples.append(latency)
 
-        # Salir de la sección crítica
-        self.exit_critical_section()
+    def peer_latency_stats(self):
+        """Devuelve {puerto: (muestras, mediana_ms, máximo_ms)} de las entregas recientes"""
+        with self._latency_lock:
+            snapshot = {port: sorted(samples) for port, samples in self.peer_latencies.items()}
+        return {
+            port: (len(samples), samples[len(samples) // 2] * 1000, samples[-1] * 1000)
+            for port, samples in snapshot.items() if samples
+        }
 
-    def exit_critical_section(self):
-        """Sale de la sección crítica"""
-        print(f"[Node {self.id_node}] Exiting critical section.")
-        self.in_critical_section = False
+    def stats(self):
+        """Métricas del nodo junto con el tráfico y el estado de la membresía (serializable a JSON)"""
+        stats = self.metrics.snapshot()
+        stats['node'] = self.id_node
+        stats['traffic'] = dict(self.traffic)
+        stats['membership'] = {
+            port - self.base_port: status for port, (status, _) in self.detector.view().items()
+        }
+        if self.oplog is not None:
+            stats['log'] = self.log_status()
+        return stats
 
-        # Responder a las solicitudes pendientes en la col
-        while self.request_queue:
-            pending_request = self.request_queue.pop(0)
-            self.handle_request(pending_request)
+    def dump_stats(self, filename=None):
+        """Escribe stats() en un archivo JSON; devuelve su nombre"""
+        filename = filename or f"node_{self.id_node}_stats.json"
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(self.stats(), f, indent=2)
+        return filename
 
-    def _purchase_item_ui(self):
-        """Interfaz para comprar un artículo con exclusión mutua"""
-        try:
-            item_id = int(input("Enter the item ID to purchase: "))
-            quantity = int(input("Enter the quantity to purchase: "))
+    def start_stats_server(self, port):
+        """Sirve stats() en http://127.0.0.1:<port>/stats; sólo escucha en la interfaz local"""
+        node = self
 
-            # Define la lógica de compra como un método interno
-            def purchase_item():
-                if self.update_inventory(item_id, -quantity):
-                    print(f"Purchased {quantity} of item {item_id}.")
-                else:
-                    print(f"Failed to purchase item {item_id}.")
+        class StatsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') not in ('', '/stats'):
+                    self.send_error(404)
+                    return
+                body = json.dumps(node.stats()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
 
-            # Asigna la lógica de compra al atributo `self.purchase_item`
-            self.purchase_item = purchase_item
+            def log_message(self, format, *args):
+                pass  # Sin una línea de log por consulta
 
-            # Solicitar acceso a la sección crítica
-            self.request_critical_section()
+        self.stats_server = ThreadingHTTPServer(('127.0.0.1', port), StatsHandler)
+        threading.Thread(target=self.stats_server.serve_forever, daemon=True).start()
+        self.log.info(f"Stats available at http://127.0.0.1:{port}/stats")
 
-        except ValueError:
-            print("Invalid input. Please enter numeric values.")
+    def show_stats(self):
+        """Muestra contadores y percentiles de latencia y guarda la foto completa en JSON"""
+        stats = self.stats()
+        print("\nNode Metrics:")
+        print("=" * 40)
+        for name, values in stats['counters'].items():
+            print(f"{name}: " + ", ".join(f"{label}={value}" for label, value in values.items()))
+        for name, values in stats['latency'].items():
+            for label, summary in values.items():
+                if summary['count']:
+                    print(f"{name}[{label}]: n={summary['count']} p50={summary['p50_ms']}ms "
+                          f"p95={summary['p95_ms']}ms p99={summary['p99_ms']}ms max={summary['max_ms']}ms")
+        print(f"Stats written to {self.dump_stats()}")
 
-    def propagate_inventory_update(self, item_id, new_quantity):
-        """Propaga la actualización de inventario a los demás nodos y espera confirmaciones"""
-        confirmations = 1  # Ya está confirmado localmente
-        total_nodes = len(self.nodes_info) + 1  # Incluye este nodo
+    def start_client_server(self, port):
+        """
+        Abre la API para clientes programáticos (client.NodeClient) en 127.0.0.1:<port>.
+        Cada petición es un frame JSON {"id", "op", ...}; la respuesta {"id", "result"} o
+        {"id", "error"} sale en cuanto termina, así que un cliente puede tener muchas
+        peticiones en vuelo sobre la misma conexión y las compras se agrupan en self.orders.
+        """
+        self.client_pool = ThreadPoolExecutor(max_workers=self.client_workers,
+                                              thread_name_prefix=f"node{self.id_node}-client")
+        self.client_server = socket.create_server(('127.0.0.1', port))
+        threading.Thread(target=self._client_accept_loop, daemon=True).start()
+        self.log.info(f"Client API listening on 127.0.0.1:{port}")
 
-        update_message = {
-            'type': 'INVENTORY_UPDATE',
-            'item_id': item_id,
-            'new_quantity': new_quantity,
-            'origin': self.id_node,
-            'timestamp': datetime.now().isoformat()
-        }
+    def _client_accept_loop(self):
+        while not self._stopped.is_set():
+            try:
+                conn, addr = self.client_server.accept()
+            except OSError as e:
+                if not self._stopped.is_set():
+                    self.log.error(f"Client API error: {e}")
+                return
+            threading.Thread(target=self._handle_client, args=(conn,), daemon=True).start()
 
-        for port, ip in self.nodes_info.items():
+    def _handle_client(self, conn):
+        """Lee peticiones de un cliente y las atiende en client_pool sin esperar a que terminen"""
+        self._client_conns.add(conn)
+        write_lock = threading.Lock()
+
+        def respond(request_id, future):
             try:
-                msg = {
-                    'destination': port,
-                    'content': json.dumps(update_message)
-                }
-                if self.send_message(msg):
-                    confirmations += 1
+                response = {'id': request_id, 'result': future.result()}
             except Exception as e:
-                print(f"[Node {self.id_node}] Error sending inventory update to Node {port - self.base_port}: {e}")
+                response = {'id': request_id, 'error': f"{type(e).__name__}: {e}"}
+            frame = encode_frame(json.dumps(response).encode('utf-8'))
+            try:
+                with write_lock:
+                    conn.sendall(frame)
+            except OSError:
+                pass  # El cliente ya cerró la conexión
 
-        # Consenso simple: mayoría
-        if confirmations >= (total_nodes // 2) + 1:
-            print(f"[Node {self.id_node}] Inventory update confirmed by majority ({confirmations}/{total_nodes})")
-            return True
-        else:
-            print(f"[Node {self.id_node}] Inventory update NOT confirmed by majority ({confirmations}/{total_nodes})")
-            return False
+        with conn:
+            try:
+                for payload in FrameReader(conn):
+                    request = json.loads(payload)
+                    self.metrics.inc('client_requests', request.get('op'))
+                    future = self.client_pool.submit(self._client_call, request)
+                    future.add_done_callback(lambda f, request_id=request.get('id'): respond(request_id, f))
+            except Exception as e:
+                if not self._stopped.is_set():
+                    self.log.error(f"Client connection error: {e}")
+            finally:
+                self._client_conns.discard(conn)
+
+    @staticmethod
+    def _parse_order(order):
+        """Pedido recibido en JSON ({"item_id": cantidad}) a {int: int}, con cantidades positivas"""
+        parsed = {int(item_id): int(quantity) for item_id, quantity in order.items()}
+        if not parsed or any(quantity <= 0 for quantity in parsed.values()):
+            raise ValueError(f"Invalid order: {order}")
+        return parsed
+
+    def _client_call(self, request):
+        """Ejecuta una petición de la API de clientes y devuelve su resultado (serializable a JSON)"""
+        op = request.get('op')
+        timeout = float(request.get('timeout', 5))
+        if op == 'purchase':
+            return self.queue_purchase(self._parse_order(request['order']), timeout=timeout)
+        if op == 'purchase_batch':
+            orders = [self._parse_order(order) for order in request['orders']]
+            return self.purchase_batch(orders, timeout=timeout)
+        if op == 'restock':
+            return self.restock(int(request['item_id']), int(request['quantity']), timeout=timeout)
+        if op == 'query':
+            item_id = request.get('item_id')
+            return self.query_inventory(None if item_id is None else int(item_id))
+        if op == 'stats':
+            return self.stats()
+        raise ValueError(f"Unknown operation: {op}")
 
-            
     def start_server(self):
-        """Inicia el servidor TCP para recibir mensajes"""
+        """Inicia el servidor TCP para recibir mensajes con el runtime configurado"""
+        if self.runtime == 'asyncio':
+            asyncio.run(self._serve_async())
+            return
+
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             self.server = s
             s.bind((self.ip, self.port))
             s.listen()
-            print(f"Node {self.id_node} Server is ready and listening on {self.ip}:{self.port}")
+            self.log.info(f"Server is ready and listening on {self.ip}:{self.port}")
             if self.server_ready_event:
                 self.server_ready_event.set()
 
-            while True:
+            while not self._stopped.is_set():
                 try:
                     conn, addr = s.accept()
                     threading.Thread(
@@ -204,119 +3726,334 @@ class Node:
                         daemon=True
                     ).start()
                 except Exception as e:
-                    print(f"[Node {self.id_node}] Server error: {e}")
+                    if not self._stopped.is_set():
+                        self.log.error(f"Server error: {e}")
+
+    async def _serve_async(self):
+        """Servidor basado en asyncio: un único event loop atiende todas las conexiones"""
+        self.loop = asyncio.get_running_loop()
+        # Los handlers esperan candados, ACK y SQLite: corren fuera del loop, que sólo hace E/S
+        self.handler_pool = ThreadPoolExecutor(max_workers=max(32, 4 * (len(self.nodes_info) + 1)),
+                                               thread_name_prefix=f"node{self.id_node}-handler")
+        server = await asyncio.start_server(self._handle_async_connection, self.ip, self.port)
+        self.server = server
+        self.log.info(f"Server (asyncio) is ready and listening on {self.ip}:{self.port}")
+        if self.server_ready_event:
+            self.server_ready_event.set()
+        async with server:
+            try:
+                await server.serve_forever()
+            except asyncio.CancelledError:
+                pass  # shutdown() cerró el servidor
+
+    def shutdown(self):
+        """
+        Detiene el nodo dentro del proceso: deja de aceptar conexiones, corta las abiertas
+        (los demás nodos lo ven caído), detiene los hilos de fondo y cierra la base.
+        """
+        self._stopped.set()
+        if self.runtime == 'asyncio' and self.loop is not None:
+            def close_all():
+                self.server.close()
+                for writer in list(self._server_conns):
+                    writer.close()
+                self.async_pool.close()
+            self.loop.call_soon_threadsafe(close_all)
+        else:
+            for sock in [self.server, *list(self._server_conns)]:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except (OSError, AttributeError):
+                    pass
+                try:
+                    sock.close()
+                except (OSError, AttributeError):
+                    pass
+        self.pool.close()
+        if self.stats_server is not None:
+            self.stats_server.shutdown()
+            self.stats_server.server_close()
+        if self.client_server is not None:
+            for sock in [self.client_server, *list(self._client_conns)]:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                sock.close()
+            self.client_pool.shutdown(wait=False)
+        if self.batcher is not None:
+            self.batcher.close()
+        self.sender_pool.shutdown(wait=False)
+        if self.handler_pool is not None:
+            self.handler_pool.shutdown(wait=False)
+        self.messages.spill()
+        self.storage.close()
+        flush_logs()
+
+    async def _handle_async_connection(self, reader, writer):
+        """Maneja una conexión entrante en el runtime asyncio"""
+        self._server_conns.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                (length,) = FRAME_HEADER.unpack(header)
+                if length > MAX_FRAME_SIZE:
+                    raise ValueError(f"Frame too large: {length} bytes")
+                payload = await reader.readexactly(length)
+                # De a un mensaje por conexión, para conservar el orden en que llegan
+                msg_id = await self.loop.run_in_executor(self.handler_pool, self._process_message, payload)
+                if msg_id is not None:
+                    writer.write(self._ack_frame(msg_id))
+                    await writer.drain()
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                self.log.warning("Connection closed in the middle of a frame")
+        except Exception as e:
+            self.log.error(f"Connection error: {e}")
+        finally:
+            self._server_conns.discard(writer)
+            writer.close()
 
     def _init_db(self):
         """Inicializa la base de datos y crea las tablas si no existen"""
         try:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
-            # Crear tabla de mensajes
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    origin INTEGER,
-                    destination INTEGER,
-                    content TEXT,
-                    timestamp TEXT
-                )
-            """)
-            # Crear tabla de inventario
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS inventory (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT,
-                    quantity INTEGER,
-                    price REAL,
-                    last_updated TEXT
-                )
-            """)
-            conn.commit()
-            conn.close()
-            print(f"[Node {self.id_node}] Database initialized.")
+            with self.storage.transaction() as cursor:
+                # Crear tabla de mensajes
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS messages (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        origin INTEGER,
+                        destination INTEGER,
+                        content TEXT,
+                        timestamp TEXT,
+                        msg_type TEXT
+                    )
+                """)
+                # Bases creadas antes de guardar el tipo de mensaje
+                columns = [row[1] for row in cursor.execute("PRAGMA table_info(messages)")]
+                if 'msg_type' not in columns:
+                    cursor.execute("ALTER TABLE messages ADD COLUMN msg_type TEXT")
+                # Índices para las consultas filtradas y paginadas del historial
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_origin ON messages (origin, id)")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_destination ON messages (destination, id)")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_type ON messages (msg_type, id)")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp, id)")
+                # Particiones del log ya movidas a archivos comprimidos
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS message_archives (
+                        path TEXT PRIMARY KEY,
+                        day TEXT,
+                        min_id INTEGER,
+                        max_id INTEGER,
+                        rows INTEGER,
+                        blocks TEXT
+                    )
+                """)
+                # Archivos creados antes del índice de bloques: se leen desde el principio
+                columns = [row[1] for row in cursor.execute("PRAGMA table_info(message_archives)")]
+                if 'blocks' not in columns:
+                    cursor.execute("ALTER TABLE message_archives ADD COLUMN blocks TEXT")
+                # Crear tabla de inventario
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS inventory (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT,
+                        quantity INTEGER,
+                        price REAL,
+                        last_updated TEXT,
+                        version INTEGER DEFAULT 0
+                    )
+                """)
+                # Cuota local de cada artículo en modo escrow
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS escrow (
+                        item_id INTEGER PRIMARY KEY,
+                        share INTEGER NOT NULL
+                    )
+                """)
+                # Base acordada del reparto escrow: stock repartido y nodos entre los que se repartió
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS escrow_basis (
+                        item_id INTEGER PRIMARY KEY,
+                        quantity INTEGER NOT NULL,
+                        members TEXT NOT NULL
+                    )
+                """)
+                # Contadores PN por artículo y nodo para la replicación CRDT
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS crdt_counters (
+                        item_id INTEGER NOT NULL,
+                        node_id INTEGER NOT NULL,
+                        p INTEGER NOT NULL DEFAULT 0,
+                        n INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (item_id, node_id)
+                    )
+                """)
+                # Log replicado de operaciones de inventario (replication='log') y su estado
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS op_log (
+                        idx INTEGER PRIMARY KEY,
+                        term INTEGER NOT NULL,
+                        op TEXT NOT NULL
+                    )
+                """)
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS op_log_state (
+                        key TEXT PRIMARY KEY,
+                        value INTEGER
+                    )
+                """)
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS op_log_applied (
+                        request_id TEXT PRIMARY KEY,
+                        idx INTEGER NOT NULL,
+                        result INTEGER
+                    )
+                """)
+                # Clientes registrados en este nodo
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS clients (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT NOT NULL,
+                        email TEXT,
+                        created TEXT
+                    )
+                """)
+                # Bases creadas antes de versionar el inventario
+                columns = [row[1] for row in cursor.execute("PRAGMA table_info(inventory)")]
+                if 'version' not in columns:
+                    cursor.execute("ALTER TABLE inventory ADD COLUMN version INTEGER DEFAULT 0")
+            self.log.debug("Database initialized.")
         except Exception as e:
-            print(f"[Node {self.id_node}] DB init error: {e}")
+            self.log.error(f"DB init error: {e}")
 
     def handle_connection(self, conn, addr):
-        """Maneja una conexión entrante"""
+        """Maneja una conexión entrante; la conexión es persistente y trae frames con prefijo de longitud"""
+        self._server_conns.add(conn)
         with conn:
             try:
-                data = conn.recv(1024).decode()
-                if not data:
-                    return
+                for payload in FrameReader(conn):
+                    msg_id = self._process_message(payload)
+                    if msg_id is not None:
+                        # ACK en la misma conexión, sólo con el ID del mensaje procesado
+                        conn.sendall(self._ack_frame(msg_id))
+            except Exception as e:
+                if not self._stopped.is_set():
+                    self.log.error(f"Connection error: {e}")
+            finally:
+                self._server_conns.discard(conn)
 
-                message = json.loads(data)
-                hour = datetime.fromisoformat(message['timestamp']).strftime("%H:%M:%S")
-                print(f"[Node {self.id_node}] Received from {message['origin']} at {hour}: {message['content']}")
+    def _ack_frame(self, msg_id):
+        return encode_frame(encode_ack(msg_id, self.codec))
+
+    def _process_message(self, payload):
+        """Procesa un mensaje recibido; devuelve su msg_id si hay que confirmarlo con un ACK"""
+        try:
+            started = time.perf_counter()
+            message = decode_message(payload)
+            decoded = time.perf_counter()
+            content = message['content']
+            # Los mensajes del protocolo llegan ya decodificados; el texto de chat no tiene tipo
+            msg_type = self._message_type(content)
+            label = msg_type or 'TEXT'
+            self.metrics.observe('decode', decoded - started, label)
+            self.metrics.inc('messages_received', label)
+            self.metrics.inc('bytes_received', label, FRAME_HEADER.size + len(payload))
+            self.metrics.inc('messages_received_from', message['origin'])
+            if msg_type not in UNCOUNTED_TYPES:
+                self._count_traffic('received', FRAME_HEADER.size + len(payload))
+            if msg_type == 'HEARTBEAT':
+                self.handle_heartbeat(message)
+                return message.get('msg_id')
 
-                self.messages.append(message)
+            if msg_type not in UNLOGGED_TYPES:
+                if self.log.sampled():
+                    hour = datetime.fromtimestamp(message['timestamp'] / 1e9).strftime("%H:%M:%S")
+                    self.log.info("Received from %s at %s: %s", message['origin'], hour, content)
 
                 # Guardar el mensaje en la base de datos
-                self._save_message_to_db(message)
+                self._save_message_to_db(message, msg_type)
 
-                # Procesar mensaje INVENTORY_UPDATE
-                try:
-                    content = message['content']
-                    # Si el mensaje es un dict (ya decodificado), úsalo directamente
-                    if isinstance(content, dict):
-                        msg_type = content.get('type')
-                    else:
-                        # Si es string, intenta decodificarlo como JSON
-                        content = json.loads(content)
-                        msg_type = content.get('type')
-                except Exception:
-                    msg_type = None
-
-                if msg_type == 'INVENTORY_UPDATE':
-                    item_id = content['item_id']
-                    new_quantity = content['new_quantity']
-                    # Actualiza el inventario local SIN propagar
-                    self.update_inventory(item_id, new_quantity - self.get_item_quantity(item_id), propagate=False)
-                    print(f"[Node {self.id_node}] Inventory updated from INVENTORY_UPDATE for item {item_id}")
-
-                # Enviar ACK al puerto correcto
-                if not str(message['content']).startswith("ACK:"):
-                    ack = {
-                        'origin': self.id_node,
-                        'destination': self.base_port + message['origin'],
-                        'content': f"ACK: {message['content']}",
-                        'timestamp': datetime.now().isoformat()
-                    }
-
-                    if self.send_message(ack):
-                        print(f"[Node {self.id_node}] ACK sent to {message['origin']}: {ack['content']}")
-                    else:
-                        print(f"[Node {self.id_node}] Failed to send ACK to {message['origin']}")
+                clock = content.get('clock') if isinstance(content, dict) else None
+                self.messages.append(MessageRecord(
+                    message['origin'], message.get('destination'), msg_type,
+                    self.clock if clock is None else clock, message['timestamp'], content, True
+                ))
 
-            except json.JSONDecodeError:
-                print(f"[Node {self.id_node}] Invalid message format")
-            except Exception as e:
-                print(f"[Node {self.id_node}] Connection error: {e}")
+            self._dispatch(msg_type, content, len(payload))
+            self.metrics.observe('handle', time.perf_counter() - decoded, label)
+            return message.get('msg_id')
+
+        except (json.JSONDecodeError, ValueError, struct.error):
+            self.log.warning("Invalid message format")
+        except Exception as e:
+            self.log.error(f"Connection error: {e}")
+
+    def _dispatch(self, msg_type, content, size):
+        """Ejecuta el handler de un mensaje del protocolo; `size` son sus bytes en la red"""
+        if msg_type == 'REQUEST':
+            self.handle_request(content)
+        elif msg_type == 'REPLY':
+            self.handle_reply(content)
+        elif msg_type == 'ESCROW_REQUEST':
+            self.handle_escrow_request(content)
+        elif msg_type == 'ESCROW_GRANT':
+            self.handle_escrow_grant(content)
+        elif msg_type == 'ESCROW_SOLD':
+            self.handle_escrow_sold(content)
+        elif msg_type == 'ESCROW_BASIS_REQUEST':
+            self.handle_escrow_basis_request(content)
+        elif msg_type == 'ESCROW_BASIS':
+            self.handle_escrow_basis(content)
+        elif msg_type in ('INVENTORY_UPDATE', 'CRDT_MERGE'):
+            self._apply_inventory_update(content)
+        elif msg_type == 'INVENTORY_BATCH':
+            for update in content['updates']:
+                self._apply_inventory_update(update)
+        elif msg_type == 'SYNC_DIGEST':
+            self.handle_sync_digest(content, size)
+        elif msg_type == 'SYNC_ROWS':
+            self.handle_sync_rows(content, size)
+        elif msg_type == 'SNAPSHOT_REQUEST':
+            self.handle_snapshot_request(content)
+        elif msg_type == 'SNAPSHOT_CHUNK':
+            self.handle_snapshot_chunk(content, size)
+        elif msg_type == 'SNAPSHOT_END':
+            self.handle_snapshot_end(content)
+        elif msg_type == 'JOIN':
+            self.handle_join(content)
+        elif msg_type == 'MEMBERS':
+            self.handle_members(content)
+        elif msg_type == 'LEAVE':
+            self.remove_member(self.base_port + content['origin'])
+        elif msg_type == 'RUMOR':
+            self.handle_rumor(content)
+        elif msg_type == 'RUMOR_RECEIPT':
+            self.handle_rumor_receipt(content)
+        elif msg_type == 'LOG_APPEND':
+            self.handle_log_append(content)
+        elif msg_type == 'LOG_APPEND_RESULT':
+            self.handle_log_append_result(content)
+        elif msg_type == 'LOG_VOTE_REQUEST':
+            self.handle_log_vote_request(content)
+        elif msg_type == 'LOG_VOTE':
+            self.handle_log_vote(content)
+        elif msg_type == 'LOG_SUBMIT':
+            self.handle_log_submit(content)
 
     # Debes agregar este método auxiliar en tu clase Node:
     def get_item_quantity(self, item_id):
         """Obtiene la cantidad actual de un artículo en el inventario local"""
         try:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
-            cursor.execute("SELECT quantity FROM inventory WHERE id = ?", (item_id,))
-            result = cursor.fetchone()
-            conn.close()
-            if result:
-                return result[0]
-            return 0
+            return self.inventory.quantity(item_id)
         except Exception as e:
-            print(f"[Node {self.id_node}] Error getting item quantity: {e}")
+            self.log.error(f"Error getting item quantity: {e}")
             return 0
 
     def show_inventory(self):
         """Muestra el inventario local"""
         try:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, name, quantity, price, last_updated FROM inventory")
-            rows = cursor.fetchall()
-            conn.close()
+            rows = self.storage.query("SELECT id, name, quantity, price, last_updated FROM inventory")
 
             print("\nLocal Inventory:")
             print("=" * 40)
@@ -325,134 +4062,566 @@ class Node:
         except Exception as e:
             print(f"[Node {self.id_node}] Error reading inventory: {e}")
 
+    def query_inventory(self, item_id=None):
+        """Inventario local (o un solo artículo) como {item_id: {name, quantity, price, version}}"""
+        sql = "SELECT id, name, quantity, price, version FROM inventory"
+        params = ()
+        if item_id is not None:
+            sql += " WHERE id = ?"
+            params = (item_id,)
+        return {
+            row[0]: {'name': row[1], 'quantity': row[2], 'price': row[3], 'version': row[4]}
+            for row in self.storage.query(sql, params)
+        }
+
+    def add_client(self, name, email=None):
+        """Registra un cliente en este nodo; devuelve su ID"""
+        with self.storage.transaction() as cursor:
+            cursor.execute("INSERT INTO clients (name, email, created) VALUES (?, ?, ?)",
+                           (name, email, datetime.now().isoformat()))
+            return cursor.lastrowid
+
+    def list_clients(self):
+        """Lista de (id, nombre, email, alta) de los clientes registrados"""
+        return self.storage.query("SELECT id, name, email, created FROM clients ORDER BY id")
+
     def update_inventory(self, item_id, quantity_change, propagate=True):
         """Actualiza la cantidad de un artículo en el inventario y propaga el cambio si es necesario"""
+        if self.replication == 'log' and propagate:
+            return self.submit_operations([{'op': 'adjust', 'item_id': item_id, 'delta': quantity_change}])[0]
+        if self.replication == 'crdt':
+            return self._update_inventory_crdt(item_id, quantity_change, propagate)
         try:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
-            cursor.execute("SELECT quantity FROM inventory WHERE id = ?", (item_id,))
-            result = cursor.fetchone()
-            if result:
-                new_quantity = result[0] + quantity_change
-                if new_quantity < 0:
-                    print(f"[Node {self.id_node}] Error: Not enough stock for item {item_id}")
-                    return False
-                cursor.execute("""
-                    UPDATE inventory
-                    SET quantity = ?, last_updated = ?
-                    WHERE id = ?
-                """, (new_quantity, datetime.now().isoformat(), item_id))
-                conn.commit()
-                print(f"[Node {self.id_node}] Inventory updated for item {item_id}")
-
-                # Propaga la actualización si es necesario
-                if propagate:
-                    success = self.propagate_inventory_update(item_id, new_quantity)
-                    if not success:
-                        print(f"[Node {self.id_node}] Rolling back inventory update for item {item_id}")
-                        # Rollback: restaurar cantidad anterior
-                        cursor.execute("""
-                            UPDATE inventory
-                            SET quantity = ?, last_updated = ?
-                            WHERE id = ?
-                        """, (result[0], datetime.now().isoformat(), item_id))
-                        conn.commit()
-                        conn.close()
+            try:
+                _, new_quantity, version = self.inventory.apply_delta(item_id, quantity_change)
+            except KeyError:
+                self.log.warning(f"Error: Item {item_id} not found in inventory")
+                return False
+            except ValueError:
+                self.log.warning(f"Error: Not enough stock for item {item_id}")
+                return False
+            self.log.info(f"Inventory updated for item {item_id}")
+
+            # Propaga la actualización si es necesario
+            if propagate:
+                success = self.propagate_inventory_update(item_id, new_quantity, version)
+                if not success:
+                    self.log.warning(f"Compensating inventory update for item {item_id}")
+                    # Algunos nodos sí recibieron la actualización: se aplica el cambio inverso
+                    # con una versión nueva y se difunde igual, como en _update_inventory_crdt
+                    try:
+                        _, restored, restored_version = self.inventory.apply_delta(item_id, -quantity_change)
+                    except ValueError:
+                        self.log.warning(f"Error: Cannot compensate item {item_id}, stock already used")
                         return False
-            else:
-                print(f"[Node {self.id_node}] Error: Item {item_id} not found in inventory")
-            conn.close()
+                    self._broadcast_async({'type': 'INVENTORY_UPDATE', 'item_id': item_id,
+                                           'new_quantity': restored, 'version': restored_version})
+                    return False
             return True
         except Exception as e:
-            print(f"[Node {self.id_node}] Error updating inventory: {e}")
+            self.log.error(f"Error updating inventory: {e}")
             return False
 
-    def sync_inventory(self):
-        """Sincroniza el inventario con otros nodos"""
-        for port, ip in self.nodes_info.items():
+    def _update_inventory_crdt(self, item_id, quantity_change, propagate=True):
+        """Versión CRDT de update_inventory: el cambio se registra en el contador PN de este nodo"""
+        try:
             try:
-                message = {
-                    'origin': self.id_node,
-                    'destination': port,
-                    'content': 'SYNC_INVENTORY',
-                    'timestamp': datetime.now().isoformat()
+                self.crdt.apply_local(item_id, self.id_node, quantity_change)
+            except KeyError:
+                self.log.warning(f"Error: Item {item_id} not found in inventory")
+                return False
+            except ValueError:
+                self.log.warning(f"Error: Not enough stock for item {item_id}")
+                return False
+            self.log.info(f"Inventory updated for item {item_id}")
+
+            if propagate and not self.propagate_inventory_update(item_id, self.crdt.value(item_id), None):
+                self.log.warning(f"Compensating inventory update for item {item_id}")
+                # Un CRDT no se deshace: se compensa con el cambio inverso y se difunde igual
+                self.crdt.apply_local(item_id, self.id_node, -quantity_change)
+                self._broadcast_async({'type': 'CRDT_MERGE', 'counters': self.crdt.state([item_id])})
+                return False
+            return True
+        except Exception as e:
+            self.log.error(f"Error updating inventory: {e}")
+            return False
+
+    def sync_inventory(self, timeout=5):
+        """
+        Sincroniza el inventario con los demás nodos por anti-entropía:
+        se intercambian hashes por rango de item_id y sólo viajan las filas de los rangos distintos.
+
+        Returns:
+            Lista con las estadísticas (filas y bytes movidos) de cada sincronización
+        """
+        started = self.scheduler.monotonic()
+        sessions = []
+        peers = self.live_peers()
+        if self.dissemination is not None:
+            # Anti-entropía epidémica: cada ronda compara con unos pocos nodos al azar y las
+            # diferencias se propagan en las rondas siguientes de los demás
+            peers = random.sample(peers, min(self.dissemination.fanout, len(peers)))
+        for port in peers:
+            with self.sync_condition:
+                self._request_seq += 1
+                sync_id = f"{self.id_node}-sync-{self._request_seq}"
+                session = self._sync_sessions[sync_id] = {
+                    'peer': port - self.base_port, 'done': False,
+                    'rows_in': 0, 'rows_out': 0, 'bytes_in': 0, 'bytes_out': 0
                 }
-                if self.send_message(message):
-                    print(f"[Node {self.id_node}] Sync request sent to Node {port - self.base_port}")
-            except Exception as e:
-                print(f"[Node {self.id_node}] Error syncing inventory with Node {port - self.base_port}: {e}")
+            content = {
+                'type': 'SYNC_DIGEST',
+                'sync_id': sync_id,
+                'digest': self._inventory_digest(),
+                'origin': self.id_node
+            }
+            message = {'destination': port, 'content': content}
+            if self.send_message(message):
+                session['bytes_out'] += message['size']
+                sessions.append((sync_id, session))
+                if self.log.sampled():
+                    self.log.info("Sync digest sent to Node %s", port - self.base_port)
+            else:
+                with self.sync_condition:
+                    del self._sync_sessions[sync_id]
+                self.log.warning(f"Error syncing inventory with Node {port - self.base_port}")
+
+        with self.sync_condition:
+            self.scheduler.wait_for(
+                self.sync_condition, lambda: all(session['done'] for _, session in sessions), timeout
+            )
+            for sync_id, _ in sessions:
+                self._sync_sessions.pop(sync_id, None)
+        self.metrics.observe('sync_inventory', self.scheduler.monotonic() - started)
+
+        reports = []
+        for _, session in sessions:
+            report = dict(session)
+            reports.append(report)
+            status = "done" if report.pop('done') else "incomplete"
+            self.log.info(f"Sync with Node {report['peer']} {status}: "
+                          f"{report['rows_in']} rows / {report['bytes_in']} bytes in, "
+                          f"{report['rows_out']} rows / {report['bytes_out']} bytes out")
+        return reports
+
+    def _inventory_digest(self):
+        """Hash de cada rango de SYNC_BUCKET_SIZE item_ids, calculado desde la caché"""
+        if self.replication == 'crdt':
+            state = self.crdt.state()
+            entries = {item_id: sorted(counter.items()) for item_id, counter in state.items()}
+        else:
+            entries = {item_id: entry for item_id, entry in self.inventory.items().items()}
+        hashes = {}
+        for item_id in sorted(entries):
+            bucket = item_id // SYNC_BUCKET_SIZE
+            h = hashes.get(bucket)
+            if h is None:
+                h = hashes[bucket] = hashlib.blake2b(digest_size=8)
+            h.update(repr((item_id, entries[item_id])).encode())
+        return {str(bucket): h.hexdigest() for bucket, h in hashes.items()}
+
+    def _inventory_rows(self, buckets):
+        """Filas completas del inventario en los rangos indicados"""
+        rows = []
+        for bucket in buckets:
+            start = bucket * SYNC_BUCKET_SIZE
+            for item_id, name, quantity, price, version in self.storage.query("""
+                SELECT id, name, quantity, price, version FROM inventory
+                WHERE id >= ? AND id < ? ORDER BY id
+            """, (start, start + SYNC_BUCKET_SIZE)):
+                rows.append({'id': item_id, 'name': name, 'quantity': quantity, 'price': price, 'version': version})
+        if self.replication == 'crdt':
+            counters = self.crdt.state([row['id'] for row in rows])
+            for row in rows:
+                row['counters'] = counters.get(row['id'], {})
+        return rows
+
+    def _apply_sync_rows(self, rows):
+        """Aplica las filas recibidas en una sincronización; devuelve cuántas cambiaron algo"""
+        applied = 0
+        for row in rows:
+            item_id = row['id']
+            if self.replication == 'crdt':
+                created = self.inventory.ensure(item_id, row['name'], row['price'])
+                changed = self.crdt.merge({item_id: row.get('counters', {})})
+                if created and not changed:
+                    self.crdt.materialize(item_id)
+                applied += bool(created or changed)
+            elif self.inventory.ensure(item_id, row['name'], row['price'], row['quantity'], row['version']):
+                applied += 1
+            elif self.inventory.apply_remote(item_id, row['quantity'], row['version']):
+                applied += 1
+        return applied
+
+    def handle_sync_digest(self, message, size):
+        """Compara el digest recibido con el local y envía las filas de los rangos distintos"""
+        local = self._inventory_digest()
+        remote = message['digest']
+        buckets = sorted(
+            int(bucket) for bucket in set(local) | set(remote) if local.get(bucket) != remote.get(bucket)
+        )
+        rows = self._inventory_rows(buckets)
+        self.send_message({
+            'destination': self.base_port + message['origin'],
+            'content': {
+                'type': 'SYNC_ROWS',
+                'sync_id': message['sync_id'],
+                'buckets': buckets,
+                'rows': rows,
+                'reply': True,
+                'origin': self.id_node
+            }
+        })
+        if self.log.sampled():
+            self.log.info("Sync with Node %s: %s divergent ranges, sent %s rows",
+                          message['origin'], len(buckets), len(rows))
+
+    def handle_sync_rows(self, message, size):
+        """Aplica las filas recibidas y, si es la respuesta al digest, devuelve las filas locales"""
+        applied = self._apply_sync_rows(message['rows'])
+        if self.log.sampled():
+            self.log.info("Sync rows from Node %s: %s received, %s applied",
+                          message['origin'], len(message['rows']), applied)
+        if not message.get('reply'):
+            return
+
+        rows = self._inventory_rows(message['buckets'])
+        content = {
+            'type': 'SYNC_ROWS',
+            'sync_id': message['sync_id'],
+            'buckets': message['buckets'],
+            'rows': rows,
+            'reply': False,
+            'origin': self.id_node
+        }
+        reply = {'destination': self.base_port + message['origin'], 'content': content}
+        sent = self.send_message(reply)
+        with self.sync_condition:
+            session = self._sync_sessions.get(message['sync_id'])
+            if session is not None:
+                session['rows_in'] += len(message['rows'])
+                session['bytes_in'] += size
+                if sent:
+                    session['rows_out'] += len(rows)
+                    session['bytes_out'] += reply['size']
+                session['done'] = True
+                self.sync_condition.notify_all()
+
+    def bootstrap_from(self, peer_port, include_messages=False, chunk_size=500, timeout=60):
+        """
+        Descarga por partes una foto consistente del inventario de otro nodo (y opcionalmente
+        de su historial). Cada parte se aplica al llegar, así que el nodo ya responde
+        lecturas antes de terminar y ningún lado mantiene el catálogo completo en memoria.
+
+        Args:
+            peer_port: Puerto del nodo que envía la foto
+            include_messages: Copiar también la tabla messages
+            chunk_size: Filas por mensaje SNAPSHOT_CHUNK
+
+        Returns:
+            Estadísticas {tabla: filas} o None si no terminó a tiempo
+        """
+        with self.sync_condition:
+            self._request_seq += 1
+            snapshot_id = f"{self.id_node}-snapshot-{self._request_seq}"
+            progress = self._snapshots[snapshot_id] = {'rows': {}, 'bytes': 0, 'done': False}
+        request = {
+            'type': 'SNAPSHOT_REQUEST',
+            'snapshot_id': snapshot_id,
+            'include_messages': include_messages,
+            'chunk_size': chunk_size,
+            'origin': self.id_node
+        }
+        if not self.send_message({'destination': peer_port, 'content': request}):
+            with self.sync_condition:
+                del self._snapshots[snapshot_id]
+            return None
+        self.log.info(f"Bootstrapping from Node {peer_port - self.base_port}...")
+
+        with self.sync_condition:
+            done = self.scheduler.wait_for(self.sync_condition, lambda: progress['done'], timeout)
+            del self._snapshots[snapshot_id]
+        if not done:
+            self.log.warning(f"Bootstrap from Node {peer_port - self.base_port} did not finish in time")
+            return None
+        self.log.info(f"Bootstrap complete: {progress['rows']} rows, {progress['bytes']} bytes")
+        return progress['rows']
+
+    def handle_snapshot_request(self, message):
+        """Atiende un SNAPSHOT_REQUEST en segundo plano para no bloquear la recepción"""
+        self.sender_pool.submit(self._stream_snapshot, message)
+
+    def _stream_snapshot(self, message):
+        """Envía la foto en partes leyendo con fetchmany dentro de una transacción de lectura"""
+        destination = self.base_port + message['origin']
+        chunk_size = message.get('chunk_size', 500)
+        # Los contadores CRDT van antes que el inventario para poder materializar cada artículo
+        tables = []
+        if self.replication == 'crdt':
+            tables.append(('crdt_counters', "SELECT item_id, node_id, p, n FROM crdt_counters"))
+        tables.append(('inventory', "SELECT id, name, quantity, price, version FROM inventory ORDER BY id"))
+        if message.get('include_messages'):
+            self.storage.flush()
+            tables.append(('messages', "SELECT origin, destination, msg_type, content, timestamp "
+                                       "FROM messages ORDER BY id"))
+
+        totals = {}
+        try:
+            with self.storage.snapshot() as conn:
+                for table, sql in tables:
+                    cursor = conn.execute(sql)
+                    totals[table] = 0
+                    while True:
+                        rows = cursor.fetchmany(chunk_size)
+                        if not rows:
+                            break
+                        chunk = {
+                            'type': 'SNAPSHOT_CHUNK',
+                            'snapshot_id': message['snapshot_id'],
+                            'table': table,
+                            'rows': rows,
+                            'origin': self.id_node
+                        }
+                        if not self.send_message({'destination': destination, 'content': chunk}):
+                            raise ConnectionError(f"Node {message['origin']} stopped receiving the snapshot")
+                        totals[table] += len(rows)
+        except Exception as e:
+            self.log.error(f"Snapshot error: {e}")
+            return
+
+        self.send_message({'destination': destination, 'content': {
+            'type': 'SNAPSHOT_END',
+            'snapshot_id': message['snapshot_id'],
+            'totals': totals,
+            'origin': self.id_node
+        }})
+        self.log.info(f"Snapshot sent to Node {message['origin']}: {totals}")
+
+    def handle_snapshot_chunk(self, message, size):
+        """Aplica una parte de la foto en cuanto llega"""
+        table, rows = message['table'], message['rows']
+        if table == 'crdt_counters' and self.crdt is not None:
+            state = {}
+            for item_id, node_id, p, n in rows:
+                state.setdefault(item_id, {})[node_id] = [p, n]
+            self.crdt.merge(state)
+        elif table == 'inventory':
+            self._apply_sync_rows([
+                {'id': item_id, 'name': name, 'quantity': quantity, 'price': price, 'version': version}
+                for item_id, name, quantity, price, version in rows
+            ])
+        elif table == 'messages':
+            for row in rows:
+                self.storage.log_message(tuple(row))
+        with self.sync_condition:
+            progress = self._snapshots.get(message['snapshot_id'])
+            if progress is not None:
+                progress['rows'][table] = progress['rows'].get(table, 0) + len(rows)
+                progress['bytes'] += size
+
+    def handle_snapshot_end(self, message):
+        with self.sync_condition:
+            progress = self._snapshots.get(message['snapshot_id'])
+            if progress is not None:
+                progress['done'] = True
+                self.sync_condition.notify_all()
 
-    def _save_message_to_db(self, msg):
+    def _save_message_to_db(self, msg, msg_type=None):
         """Guarda un mensaje en la base de datos"""
         try:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO messages (origin, destination, content, timestamp)
-                VALUES (?, ?, ?, ?)
-            """, (
+            # El escritor de Storage lo confirma en lote junto con otros mensajes
+            self.storage.log_message((
                 msg.get('origin', self.id_node),
                 msg.get('destination'),
-                msg.get('content'),
-                msg.get('timestamp', datetime.now().isoformat())
+                msg_type,
+                content_to_text(msg.get('content')),
+                timestamp_to_iso(msg.get('timestamp') or self.scheduler.time_ns())
             ))
-            conn.commit()
-            conn.close()
         except Exception as e:
-            print(f"[Node {self.id_node}] DB insert error: {e}")
+            self.log.error(f"DB insert error: {e}")
 
     
-    def _show_history(self):
-        """Muestra el historial de mensajes desde la base de datos"""
-        try:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
-            cursor.execute("SELECT origin, destination, content, timestamp FROM messages ORDER BY id ASC")
-            rows = cursor.fetchall()
-            conn.close()
+    @staticmethod
+    def _message_type(content):
+        """Tipo de un mensaje del protocolo; None para el texto de chat"""
+        return content.get('type') if isinstance(content, dict) else None
 
-            print("\nMessage History (from DB):")
-            print("=" * 40)
-            for i, (origin, dest, content, ts) in enumerate(rows, 1):
-                print(f"{i}. [{ts}] {origin} -> {dest - self.base_port}: {content}")
+    def _record_sent(self, message_dict):
+        """Agrega un mensaje enviado al historial en memoria (pasa a SQLite al ser desalojado)"""
+        self.messages.append(MessageRecord(
+            self.id_node, message_dict['destination'], self._message_type(message_dict['content']),
+            self.clock, message_dict['timestamp'], message_dict['content'], False
+        ))
 
-        except Exception as e:
-            print(f"[Node {self.id_node}] Error reading history: {e}")
+    def _iter_history(self):
+        """
+        Recorre el historial completo en el orden en que se registró (id): los días archivados
+        mezclados por id con las filas de la tabla messages (leídas por partes), y al final
+        los mensajes en memoria que aún no están en disco, que recibirán ids mayores.
+        Los timestamps vienen del reloj del emisor, así que no sirven como clave de orden.
+        """
+        self.storage.flush()
+        hot = self.storage.iter_query(
+            "SELECT id, origin, destination, msg_type, content, timestamp FROM messages ORDER BY id"
+        )
+        db_rows = (
+            {'origin': origin, 'destination': destination, 'type': msg_type, 'clock': None,
+             'timestamp': timestamp, 'content': content}
+            for _, origin, destination, msg_type, content, timestamp
+            in heapq.merge(self.storage.iter_archived(), hot, key=lambda row: row[0])
+        )
+        pending = [record.to_dict() for record in self.messages.records() if not record.persisted]
+        return itertools.chain(db_rows, pending)
+
+    def send_message(self, message_dict, wait_ack=False, ack_timeout=None):
+        """
+        Envía un mensaje a otro nodo.
 
+        Args:
+            wait_ack: Esperar el ACK que el receptor devuelve por la misma conexión tras procesarlo
+            ack_timeout: Tiempo máximo (s) de espera del ACK (por defecto el timeout del pool)
+
+        Returns:
+            True si se envió (y, con wait_ack, si el receptor lo confirmó)
+        """
+        if self.transport is not None:
+            return self.transport.send(self, message_dict, wait_ack, ack_timeout)
+        if self.runtime == 'asyncio' and self.loop is not None:
+            return self._send_message_via_loop(message_dict, wait_ack, ack_timeout)
 
-    def send_message(self, message_dict):
-        """Envía un mensaje a otro nodo"""
         try:
             dest_port = message_dict['destination']
             if dest_port == self.port:
-                print(f"[Node {self.id_node}] Warning: Cannot send message to self.")
+                self.log.warning("Warning: Cannot send message to self.")
                 return False
 
             dest_ip = self.nodes_info.get(dest_port)
             if not dest_ip:
-                print(f"[Node {self.id_node}] Error: Unknown destination port {dest_port}")
+                self.log.warning(f"Error: Unknown destination port {dest_port}")
                 return False
 
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(5.0)
+            # Un frame por mensaje sobre la conexión persistente del pool
+            frame = self._frame(message_dict)
+            msg_id = message_dict['msg_id']
+            ack = self.pool.send(dest_port, frame, msg_id if wait_ack else None)
+            if self._message_type(message_dict['content']) not in UNLOGGED_TYPES:
+                self._record_sent(message_dict)
+                if self.log.sampled():
+                    self.log.info("Sent to %s: %s", dest_port, message_dict['content'])
+            if ack is not None:
+                started = self.scheduler.monotonic()
+                try:
+                    ack.result(timeout=ack_timeout or self.pool.timeout)
+                    self.metrics.observe('ack_wait', self.scheduler.monotonic() - started, dest_port - self.base_port)
+                except Exception as e:
+                    self.metrics.inc('ack_timeouts', dest_port - self.base_port)
+                    self.pool.forget(msg_id)
+                    self.log.warning(f"No ACK from node {dest_port - self.base_port} "
+                                     f"for message {msg_id}: {e or 'timeout'}")
+                    return False
+            return True
+
+        except ConnectionRefusedError:
+            self.log.warning(f"Error: Node {dest_port - self.base_port} not available")
+            self._peer_unreachable(dest_port)
+        except socket.timeout:
+            self.log.warning(f"Error: Connection timeout with node {dest_port - self.base_port}")
+            self._peer_unreachable(dest_port)
+        except OSError as e:
+            self.log.warning(f"Error: Node {dest_port - self.base_port} unreachable: {e}")
+            self._peer_unreachable(dest_port)
+        except Exception as e:
+            self.log.error(f"Send error: {e}")
+        
+        return False
 
-                s.connect((dest_ip, dest_port))
+    def _send_message_via_loop(self, message_dict, wait_ack=False, ack_timeout=None):
+        """
+        Delega el envío al event loop en el runtime asyncio y espera su resultado.
+        Desde el propio loop no se puede esperar: ahí hay que usar async_send_message.
+        """
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            raise RuntimeError("send_message cannot block the event loop; await async_send_message instead")
+        future = asyncio.run_coroutine_threadsafe(
+            self.async_send_message(message_dict, wait_ack, ack_timeout), self.loop
+        )
+        try:
+            return future.result(timeout=self.async_pool.timeout * 2 + (ack_timeout or self.async_pool.timeout) + 1)
+        except Exception as e:
+            self.log.error(f"Send error: {e}")
+            return False
 
-                message_dict['origin'] = self.id_node
-                message_dict['timestamp'] = datetime.now().isoformat()
+    def _frame(self, message_dict):
+        """Completa el sobre del mensaje (msg_id, origen, timestamp en ns) y lo codifica en un frame"""
+        message_dict['msg_id'] = next(self._msg_ids)
+        message_dict['origin'] = self.id_node
+        message_dict['timestamp'] = self.scheduler.time_ns()
+        started = time.perf_counter()
+        frame = encode_frame(encode_message(message_dict, self.codec))
+        msg_type = self._message_type(message_dict['content'])
+        label = msg_type or 'TEXT'
+        self.metrics.observe('encode', time.perf_counter() - started, label)
+        self.metrics.inc('messages_sent', label)
+        self.metrics.inc('bytes_sent', label, len(frame))
+        self.metrics.inc('messages_sent_to', message_dict['destination'] - self.base_port)
+        message_dict['size'] = len(frame)  # Bytes en la red, para las estadísticas
+        if msg_type not in UNCOUNTED_TYPES:
+            self._count_traffic('sent', len(frame))
+        return frame
 
-                s.sendall(json.dumps(message_dict).encode('utf-8'))
-                self.messages.append(message_dict)
-                print(f"[Node {self.id_node}] Sent to {dest_port}: {message_dict['content']}")
-                return True
+    def _count_traffic(self, direction, size):
+        with self._traffic_lock:
+            self.traffic[f'messages_{direction}'] += 1
+            self.traffic[f'bytes_{direction}'] += size
+
+    async def async_send_message(self, message_dict, wait_ack=False, ack_timeout=None):
+        """Envía un mensaje a otro nodo sin bloquear el event loop (mismos argumentos que send_message)"""
+        dest_port = message_dict['destination']
+        try:
+            if dest_port == self.port:
+                self.log.warning("Warning: Cannot send message to self.")
+                return False
+
+            if not self.nodes_info.get(dest_port):
+                self.log.warning(f"Error: Unknown destination port {dest_port}")
+                return False
+
+            frame = self._frame(message_dict)
+            msg_id = message_dict['msg_id']
+            ack = await self.async_pool.send(dest_port, frame, msg_id if wait_ack else None)
+            if self._message_type(message_dict['content']) not in UNLOGGED_TYPES:
+                self._record_sent(message_dict)
+                if self.log.sampled():
+                    self.log.info("Sent to %s: %s", dest_port, message_dict['content'])
+            if ack is not None:
+                started = time.monotonic()
+                try:
+                    await asyncio.wait_for(ack, ack_timeout or self.async_pool.timeout)
+                    self.metrics.observe('ack_wait', time.monotonic() - started, dest_port - self.base_port)
+                except Exception as e:
+                    self.metrics.inc('ack_timeouts', dest_port - self.base_port)
+                    self.async_pool.forget(msg_id)
+                    self.log.warning(f"No ACK from node {dest_port - self.base_port} "
+                                     f"for message {msg_id}: {e or 'timeout'}")
+                    return False
+            return True
 
         except ConnectionRefusedError:
-            print(f"[Node {self.id_node}] Error: Node {dest_port - self.base_port} not available")
-        except socket.timeout:
-            print(f"[Node {self.id_node}] Error: Connection timeout with node {dest_port - self.base_port}")
+            self.log.warning(f"Error: Node {dest_port - self.base_port} not available")
+            self._peer_unreachable(dest_port)
+        except asyncio.TimeoutError:
+            self.log.warning(f"Error: Connection timeout with node {dest_port - self.base_port}")
+            self._peer_unreachable(dest_port)
+        except OSError as e:
+            self.log.warning(f"Error: Node {dest_port - self.base_port} unreachable: {e}")
+            self._peer_unreachable(dest_port)
         except Exception as e:
-            print(f"[Node {self.id_node}] Send error: {e}")
-        
+            self.log.error(f"Send error: {e}")
+
         return False
 
     def user_interface(self):
@@ -473,7 +4642,9 @@ class Node:
                 print("8. Add new client")
                 print("9. View client list")
                 print("10. Purchase an item (with mutual exclusion)")
-                print("11. Exit")
+                print("11. Show cluster membership")
+                print("12. Show metrics")
+                print("13. Exit")
 
                 choice = input("Select option: ").strip()
 
@@ -498,7 +4669,13 @@ class Node:
                 elif choice == "10":
                     self._purchase_item_ui()
                 elif choice == "11":
+                    self.show_membership()
+                elif choice == "12":
+                    self.show_stats()
+                elif choice == "13":
                     print("Exiting...")
+                    self.leave()
+                    flush_logs()
                     break
                 else:
                     print("Invalid option")
@@ -506,6 +4683,16 @@ class Node:
             except Exception as e:
                 print(f"Error: {e}")
 
+    def show_membership(self):
+        """Muestra la vista de membresía del detector de fallos"""
+        print("\nCluster Membership:")
+        for port, (status, phi) in sorted(self.detector.view().items()):
+            print(f"Node {port - self.base_port} ({self.nodes_info.get(port)}:{port}): {status}, phi={phi}")
+        status = self.log_status()
+        if status is not None:
+            print(f"Replicated log: {status['role']} in term {status['term']}, leader {status['leader']}, "
+                  f"commit {status['commit_index']}/{status['last_index']}, applied {status['last_applied']}")
+
     def _send_message_ui(self):
         """Maneja el envío de mensajes desde la UI"""
         available_ids = [p - self.base_port for p in self.nodes_info.keys()]
@@ -533,40 +4720,92 @@ class Node:
             print("Error: Please enter a valid node ID")
 
     def _show_history(self):
-        """Muestra el historial de mensajes"""
-        print("\nMessage History:")
-        print("=" * 40)
-        for i, msg in enumerate(self.messages, 1):
-            direction = f"{msg.get('origin', '?')} -> {msg['destination'] - self.base_port}"
-            print(f"{i}. [{msg['timestamp']}] {direction}: {msg['content']}")
+        """Muestra el historial de mensajes (memoria y base de datos)"""
+        try:
+            print("\nMessage History:")
+            print("=" * 40)
+            for i, msg in enumerate(self._iter_history(), 1):
+                destination = msg['destination'] - self.base_port if msg['destination'] is not None else '?'
+                print(f"{i}. [{msg['timestamp']}] {msg.get('origin', '?')} -> {destination}: {msg['content']}")
+        except Exception as e:
+            print(f"[Node {self.id_node}] Error reading history: {e}")
 
     def export_history(self):
-        """Exporta el historial a JSON"""
+        """Exporta el historial a JSON escribiendo mensaje por mensaje"""
         filename = f"node_{self.id_node}_history.json"
         try:
             with open(filename, 'w', encoding='utf-8') as f:
-                json.dump({
-                    'node_id': self.id_node,
-                    'timestamp': datetime.now().isoformat(),
-                    'messages': self.messages
-                }, f, indent=2, ensure_ascii=False)
+                f.write('{\n  "node_id": %s,\n  "timestamp": %s,\n  "messages": [' % (
+                    json.dumps(self.id_node), json.dumps(datetime.now().isoformat())
+                ))
+                for i, msg in enumerate(self._iter_history()):
+                    f.write(',\n    ' if i else '\n    ')
+                    f.write(json.dumps(msg, ensure_ascii=False))
+                f.write('\n  ]\n}\n')
             print(f"History exported to {filename}")
         except Exception as e:
             print(f"Export failed: {e}")
 
-    def _show_db_messages(self):
-        """Muestra los mensajes guardados en la base de datos"""
+    def query_history(self, origin=None, destination=None, msg_type=None, since=None, until=None,
+                      after_id=0, limit=100):
+        """
+        Consulta paginada del historial en la base de datos.
+        Los IDs de nodo se traducen a puertos para el filtro de destino.
+        Lo que está en memoria o en la cola del escritor se guarda sólo al pedir la primera
+        página (after_id=0): las siguientes no vuelven a esperar al disco.
+
+        Returns:
+            (lista de mensajes, cursor para la página siguiente o None)
+        """
+        if not after_id:
+            self.messages.spill()
+            self.storage.flush()
+        rows, cursor = self.storage.query_messages(
+            origin=origin,
+            destination=None if destination is None else self.base_port + destination,
+            msg_type=msg_type, since=since, until=until, after_id=after_id, limit=limit
+        )
+        return [
+            {'id': row_id, 'origin': origin, 'destination': dest, 'type': row_type,
+             'content': content, 'timestamp': timestamp}
+            for row_id, origin, dest, row_type, content, timestamp in rows
+        ], cursor
+
+    def export_history_ndjson(self, filename=None, **filters):
+        """
+        Exporta el historial como NDJSON (un mensaje por línea) escribiendo cada página
+        en cuanto se lee, con memoria constante sin importar el tamaño del historial.
+        Acepta los mismos filtros que query_history.
+        """
+        filename = filename or f"node_{self.id_node}_history.ndjson"
         try:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
-            cursor.execute("SELECT origin, destination, content, timestamp FROM messages")
-            rows = cursor.fetchall()
-            conn.close()
+            exported = 0
+            with open(filename, 'w', encoding='utf-8') as f:
+                cursor = 0
+                while cursor is not None:
+                    messages, cursor = self.query_history(after_id=cursor, limit=1000, **filters)
+                    for msg in messages:
+                        f.write(json.dumps(msg, ensure_ascii=False))
+                        f.write('\n')
+                    exported += len(messages)
+            print(f"History exported to {filename} ({exported} messages)")
+            return exported
+        except Exception as e:
+            print(f"Export failed: {e}")
+            return None
 
+    def _show_db_messages(self, page_size=50):
+        """Muestra los mensajes guardados en la base de datos, por páginas"""
+        try:
             print("\nDatabase Messages:")
-            for i, row in enumerate(rows, 1):
-                origin, destination, content, timestamp = row
-                print(f"{i}. [{timestamp}] {origin} -> {destination - self.base_port}: {content}")
+            i = 0
+            cursor = 0
+            while cursor is not None:
+                messages, cursor = self.query_history(after_id=cursor, limit=page_size)
+                for msg in messages:
+                    i += 1
+                    print(f"{i}. [{msg['timestamp']}] {msg['origin']} -> {msg['destination'] - self.base_port}: "
+                          f"{msg['content']}")
         except Exception as e:
             print(f"[Node {self.id_node}] Error reading messages from DB: {e}")
 
@@ -574,6 +4813,14 @@ class Node:
 if __name__ == "__main__":
     # Configuración - CAMBIAR POR CADA NODO
     NODE_ID = int(os.getenv("NODE_ID", 1))  # Toma el valor de la variable de entorno NODE_ID, por defecto 1  # Cambiar este valor (1, 2, 3...)
+    RUNTIME = os.getenv("NODE_RUNTIME", "thread")  # 'thread' o 'asyncio'
+    PURCHASE_MODE = os.getenv("PURCHASE_MODE", "lock")  # 'lock' o 'escrow'
+    REPLICATION = os.getenv("REPLICATION", "version")  # 'version', 'crdt' o 'log'
+    DISSEMINATION = os.getenv("DISSEMINATION", "direct")  # 'direct', 'gossip' o 'tree'
+    CODEC = os.getenv("NODE_CODEC", "binary")  # 'binary' o 'json' (para depurar)
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")  # 'DEBUG', 'INFO', 'WARNING' o 'ERROR'
+    STATS_PORT = int(os.getenv("STATS_PORT", 0)) or None  # Métricas en http://127.0.0.1:STATS_PORT/stats
+    CLIENT_PORT = int(os.getenv("CLIENT_PORT", 0)) or None  # API para client.py en 127.0.0.1:CLIENT_PORT
     BASE_PORT = 5000
     NODE_IPS = {
         5001: '192.168.100.61',
@@ -582,15 +4829,35 @@ if __name__ == "__main__":
         5004: '192.168.100.64'
     }
 
+    # Unirse en caliente a un clúster en marcha: JOIN_SEED=ip:puerto de cualquier nodo
+    JOIN_SEED = os.getenv("JOIN_SEED")
+
     server_ready = threading.Event()
     node = Node(
         id_node=NODE_ID,
         port=BASE_PORT + NODE_ID,
-        nodes_info={p: ip for p, ip in NODE_IPS.items() if p != BASE_PORT + NODE_ID},
+        nodes_info={} if JOIN_SEED else {p: ip for p, ip in NODE_IPS.items() if p != BASE_PORT + NODE_ID},
         server_ready_event=server_ready,
-        base_port=BASE_PORT
+        base_port=BASE_PORT,
+        runtime=RUNTIME,
+        purchase_mode=PURCHASE_MODE,
+        replication=REPLICATION,
+        codec=CODEC,
+        dissemination=DISSEMINATION,
+        log_level=LOG_LEVEL,
+        stats_port=STATS_PORT,
+        client_port=CLIENT_PORT
     )
 
     threading.Thread(target=node.start_server, daemon=True).start()
     server_ready.wait()
+    if JOIN_SEED:
+        seed_ip, seed_port = JOIN_SEED.rsplit(':', 1)
+        node.join(int(seed_port), seed_ip)
+    # Nodo nuevo o recuperado: copiar inventario (e historial) de otro nodo antes de operar
+    BOOTSTRAP_FROM = os.getenv("BOOTSTRAP_FROM")
+    if BOOTSTRAP_FROM:
+        node.bootstrap_from(BASE_PORT + int(BOOTSTRAP_FROM), include_messages=True)
+    if PURCHASE_MODE == 'escrow':
+        node.init_escrow()
     node.user_interface()
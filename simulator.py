@@ -0,0 +1,683 @@
+"""
+Simulador determinista del clúster en un solo proceso, con tiempo virtual.
+
+Los nodos son instancias reales de Node: la lógica del protocolo (handle_request,
+handle_reply, propagate_inventory_update, sync_inventory...) es la misma que en
+producción, pero la red TCP se reemplaza por SimNetwork y el reloj por VirtualScheduler:
+
+    - Cada mensaje es un evento que llega tras una latencia aleatoria (semilla fija),
+      en orden FIFO por enlace como en TCP, con pérdidas y particiones opcionales.
+    - Los hilos del protocolo (pool de envíos y clientes) corren de a uno; cada espera
+      (wait_for, ACK, Future.result) cede el turno y el reloj salta al próximo evento.
+      Con la misma semilla dos corridas dan exactamente el mismo resultado, y los
+      timeouts de 5 s no cuestan tiempo real.
+
+Reporta mensajes por operación y por tipo, tiempo hasta la mayoría en
+propagate_inventory_update, latencia de las compras y los invariantes: a lo sumo
+un nodo en la sección crítica de cada artículo, sin sobreventa y réplicas que
+convergen tras rondas finales de sync_inventory, sin diferencia entre el stock de
+las réplicas y el que dejan las ventas confirmadas. Sale con código 1 si alguno falla.
+
+Latidos, batching de actualizaciones, anti-entropía de fondo y rotación del log
+van desactivados: un nodo caído se detecta porque la red rechaza la conexión.
+
+Uso:
+    python simulator.py --nodes 50 --ops 1000 --rate 20 --drop 0.01 --partition 20:10 --crash 2 --seed 7
+"""
+import argparse
+import contextlib
+import heapq
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+from benchmark import percentile
+from nodes import FRAME_HEADER, GLOBAL_RESOURCE, Node
+
+EPOCH_NS = 1_700_000_000 * 10 ** 9  # Instante inicial de la simulación: timestamps reproducibles
+
+
+class SimFuture(Future):
+    """Future cuyo result() espera en tiempo virtual"""
+    def __init__(self, scheduler):
+        super().__init__()
+        self._scheduler = scheduler
+
+    def result(self, timeout=None):
+        if not self.done():
+            # set_result/set_exception notifican _condition: sólo entonces se revisa esta espera
+            with self._condition:
+                self._scheduler.wait_for(self._condition, self.done, timeout)
+        return super().result(timeout=0)
+
+
+def _turn():
+    lock = threading.Lock()
+    lock.acquire()
+    return lock
+
+
+class _Worker:
+    """Hilo real que sólo corre cuando el planificador le pasa el turno"""
+    __slots__ = ('resume', 'job')
+
+    def __init__(self):
+        # Candado usado como semáforo binario: release() da el turno, acquire() lo espera.
+        # Es mucho más barato que un Event, que crea una Condition en cada espera
+        self.resume = _turn()
+        self.job = None  # (fn, args, kwargs, future)
+
+
+class _Waiter:
+    __slots__ = ('worker', 'condition', 'predicate')
+
+    def __init__(self, worker, condition, predicate):
+        self.worker = worker
+        self.condition = condition
+        self.predicate = predicate
+
+
+class _SimExecutor:
+    """Pool de envíos de un nodo: cada tarea corre en un hilo del planificador, sin límite de concurrencia"""
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def submit(self, fn, *args, **kwargs):
+        return self.scheduler.spawn(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class VirtualScheduler:
+    """
+    Reloj virtual y planificador de eventos con la interfaz de SystemScheduler.
+    Los eventos se ejecutan en el hilo que llama a run(); las tareas (spawn) en hilos
+    propios, pero nunca dos a la vez: el orden depende sólo de la cola de eventos.
+    """
+    def __init__(self):
+        self.now = 0.0
+        self.switches = 0
+        self._events = []  # heap de [instante, secuencia, acción]; acción None = cancelado
+        self._seq = itertools.count()
+        self._workers = {}  # {ident del hilo: _Worker}
+        self._idle_workers = []
+        self._waiting = []  # _Waiter bloqueados en wait_for, en orden de llegada
+        # Condiciones notificadas desde la última revisión: sólo sus esperas pueden
+        # haber cambiado, igual que con threading.Condition
+        self._dirty = set()
+        self._yielded = _turn()
+
+    def monotonic(self):
+        return self.now
+
+    def time_ns(self):
+        return EPOCH_NS + int(self.now * 1e9)
+
+    def executor(self, max_workers, name):
+        return _SimExecutor(self)
+
+    def call_later(self, delay, action):
+        """Programa una acción; devuelve el evento, que se cancela con cancel()"""
+        event = [self.now + max(0.0, delay), next(self._seq), action]
+        heapq.heappush(self._events, event)
+        return event
+
+    @staticmethod
+    def cancel(event):
+        event[2] = None
+
+    def spawn(self, fn, *args, **kwargs):
+        """Programa fn(*args) como tarea en el instante actual; devuelve un SimFuture"""
+        future = SimFuture(self)
+        self.call_later(0, lambda: self._start((fn, args, kwargs, future)))
+        return future
+
+    def _hook(self, condition):
+        """Marca la condición como pendiente de revisión cada vez que alguien la notifica"""
+        if getattr(condition, '_sim_hooked', False):
+            return
+        notify, notify_all = condition.notify, condition.notify_all
+
+        def hooked_notify(n=1):
+            self._dirty.add(condition)
+            notify(n)
+
+        def hooked_notify_all():
+            self._dirty.add(condition)
+            notify_all()
+        condition.notify, condition.notify_all = hooked_notify, hooked_notify_all
+        condition._sim_hooked = True
+
+    def wait_for(self, condition, predicate, timeout=None):
+        """Como condition.wait_for, pero el tiempo de espera es virtual; hay que tener tomado `condition`"""
+        result = predicate()
+        worker = self._workers.get(threading.get_ident())
+        if result or worker is None or (timeout is not None and timeout <= 0):
+            # Un handler del bucle de eventos no puede bloquearse: devuelve el estado actual
+            return result
+        self._hook(condition)
+        waiter = _Waiter(worker, condition, predicate)
+        self._waiting.append(waiter)
+        timer = self.call_later(timeout, lambda: self._wake(waiter)) if timeout is not None else None
+        saved = condition._release_save()
+        try:
+            self._park(worker)
+        finally:
+            condition._acquire_restore(saved)
+        if timer is not None:
+            # Un timeout vencido no debe adelantar el reloj
+            self.cancel(timer)
+        return predicate()
+
+    def run(self, until=None):
+        """Ejecuta eventos hasta el instante `until` (s) o hasta que no quede ninguno"""
+        self._poll()
+        while self._events and (until is None or self._events[0][0] <= until):
+            when, _, action = heapq.heappop(self._events)
+            if action is None:
+                continue
+            self.now = when
+            action()
+            self._poll()
+        if until is not None:
+            self.now = max(self.now, until)
+
+    def close(self):
+        """Termina los hilos ociosos"""
+        for worker in self._idle_workers:
+            worker.resume.release()
+        self._idle_workers = []
+
+    def _start(self, job):
+        if self._idle_workers:
+            worker = self._idle_workers.pop()
+        else:
+            worker = _Worker()
+            thread = threading.Thread(target=self._work, args=(worker,), daemon=True)
+            thread.start()
+            self._workers[thread.ident] = worker
+        worker.job = job
+        self._switch(worker)
+
+    def _work(self, worker):
+        worker.resume.acquire()
+        while worker.job is not None:
+            fn, args, kwargs, future = worker.job
+            worker.job = None
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            self._idle_workers.append(worker)
+            self._park(worker)
+
+    def _switch(self, worker):
+        """Pasa el turno a una tarea y espera a que termine o vuelva a bloquearse"""
+        self.switches += 1
+        worker.resume.release()
+        self._yielded.acquire()
+
+    def _park(self, worker):
+        self._yielded.release()
+        worker.resume.acquire()
+
+    def _wake(self, waiter):
+        if waiter in self._waiting:
+            self._waiting.remove(waiter)
+            self._switch(waiter.worker)
+
+    def _poll(self):
+        """
+        Despierta, en orden de llegada, a las tareas cuya condición ya se cumple.
+        Sólo se evalúan los predicados de las condiciones notificadas; una condición
+        deja de revisarse cuando ninguna de sus esperas está lista.
+        """
+        while self._dirty:
+            dirty = self._dirty
+            ready = None
+            for waiter in self._waiting:
+                if waiter.condition not in dirty:
+                    continue
+                with waiter.condition:
+                    if waiter.predicate():
+                        ready = waiter
+                        break
+            if ready is None:
+                dirty.clear()
+                return
+            self._waiting.remove(ready)
+            self._switch(ready.worker)
+
+
+class SimNetwork:
+    """
+    Red simulada, el `transport` de cada Node. Latencia uniforme en `latency` (s),
+    pérdida de mensajes (y ACK) con probabilidad `drop_rate` y particiones; los
+    mensajes de un mismo enlace llegan en orden, como sobre una conexión TCP.
+    """
+    def __init__(self, scheduler, rng, latency=(0.0005, 0.005), drop_rate=0.0, ack_timeout=5.0):
+        self.scheduler = scheduler
+        self.rng = rng
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.ack_timeout = ack_timeout
+        self.nodes = {}  # {puerto: Node}
+        self.down = set()  # Puertos de nodos caídos
+        self.groups = None  # {puerto: grupo} mientras hay una partición
+        self._link_clear = {}  # {(origen, destino): instante de la última entrega del enlace}
+        self.sent = Counter()  # Mensajes enviados por tipo
+        self.sent_bytes = Counter()
+        self.dropped = 0
+        self.refused = 0
+
+    def attach(self, node):
+        self.nodes[node.port] = node
+
+    def crash(self, port):
+        self.down.add(port)
+
+    def partition(self, *groups):
+        self.groups = {port: i for i, group in enumerate(groups) for port in group}
+
+    def heal(self):
+        self.groups = None
+
+    def reachable(self, source, dest):
+        return self.groups is None or self.groups.get(source) == self.groups.get(dest)
+
+    def totals(self):
+        return {'messages': sum(self.sent.values()), 'bytes': sum(self.sent_bytes.values()),
+                'by_type': dict(self.sent), 'dropped': self.dropped, 'refused': self.refused}
+
+    def send(self, node, message_dict, wait_ack=False, ack_timeout=None):
+        dest = message_dict['destination']
+        if dest == node.port or dest not in node.nodes_info or node.port in self.down:
+            return False
+        if dest in self.down or dest not in self.nodes:
+            # Conexión rechazada: el emisor lo nota enseguida, igual que con TCP
+            self.refused += 1
+            node._peer_unreachable(dest)
+            return False
+        frame = node._frame(message_dict)
+        msg_type = node._message_type(message_dict['content']) or 'TEXT'
+        self.sent[msg_type] += 1
+        self.sent_bytes[msg_type] += len(frame)
+        ack = {'done': False, 'condition': threading.Condition()} if wait_ack else None
+        if self._passes(node.port, dest):
+            self.scheduler.call_later(
+                self._delay(node.port, dest), lambda: self._deliver(node.port, dest, frame, ack)
+            )
+        if ack is None:
+            return True
+        with ack['condition']:
+            return self.scheduler.wait_for(
+                ack['condition'], lambda: ack['done'], ack_timeout or self.ack_timeout
+            )
+
+    def _passes(self, source, dest):
+        if self.reachable(source, dest) and self.rng.random() >= self.drop_rate:
+            return True
+        self.dropped += 1
+        return False
+
+    def _delay(self, source, dest):
+        arrival = max(self.scheduler.now + self.rng.uniform(*self.latency), self._link_clear.get((source, dest), 0.0))
+        self._link_clear[(source, dest)] = arrival
+        return arrival - self.scheduler.now
+
+    def _deliver(self, source, dest, frame, ack):
+        if dest in self.down:
+            return  # Llegó a un nodo que ya se cayó
+        msg_id = self.nodes[dest]._process_message(frame[FRAME_HEADER.size:])
+        if ack is not None and msg_id is not None and source not in self.down and self._passes(dest, source):
+            # El ACK vuelve por la misma conexión
+            self.scheduler.call_later(self._delay(dest, source), lambda: self._acknowledge(ack))
+
+    def _acknowledge(self, ack):
+        with ack['condition']:
+            ack['done'] = True
+            ack['condition'].notify_all()
+
+
+class Invariants:
+    """Registra quién está en la sección crítica de cada recurso y detecta solapamientos"""
+    def __init__(self, scheduler, network):
+        self.scheduler = scheduler
+        self.network = network
+        self.holders = {}  # {recurso: set de id_node dentro de la sección crítica}
+        self.entries = 0
+        self.violations = []
+
+    def watch(self, node):
+        """Envuelve request_critical_section del nodo para marcar entrada y salida de cada acción"""
+        request = node.request_critical_section
+
+        def guarded_request(timeout=5, resources=None, action=None):
+            keys = sorted(set(resources), key=str) if resources else [GLOBAL_RESOURCE]
+            inner = action or node.purchase_item
+
+            def guarded():
+                self._enter(node, keys)
+                try:
+                    inner()
+                finally:
+                    self._exit(node, keys)
+            return request(timeout=timeout, resources=resources, action=guarded)
+        node.request_critical_section = guarded_request
+
+    def crashed(self, node):
+        """Un nodo caído ya no retiene ningún recurso"""
+        for holders in self.holders.values():
+            holders.discard(node.id_node)
+
+    def _enter(self, node, keys):
+        if node.port in self.network.down:
+            return
+        self.entries += 1
+        for key in keys:
+            holders = self.holders.setdefault(key, set())
+            if holders:
+                self.violations.append({'time': round(self.scheduler.now, 6), 'resource': key,
+                                        'holders': sorted(holders | {node.id_node})})
+            holders.add(node.id_node)
+
+    def _exit(self, node, keys):
+        for key in keys:
+            self.holders.get(key, set()).discard(node.id_node)
+
+
+def _latency_summary(values):
+    values = sorted(value * 1000 for value in values)
+    if not values:
+        return None
+    return {
+        'p50': round(percentile(values, 0.50), 3),
+        'p95': round(percentile(values, 0.95), 3),
+        'p99': round(percentile(values, 0.99), 3),
+        'max': round(values[-1], 3),
+    }
+
+
+class Simulation:
+    """Clúster de `count` nodos sobre SimNetwork con un VirtualScheduler compartido"""
+    def __init__(self, count, seed=0, latency=(0.0005, 0.005), drop_rate=0.0, items=16, stock=1000,
+                 **node_options):
+        random.seed(seed)  # gossip y sync_inventory eligen nodos con el random global
+        self.rng = random.Random(seed)
+        self.scheduler = VirtualScheduler()
+        self.network = SimNetwork(self.scheduler, random.Random(seed + 1), latency, drop_rate)
+        self.invariants = Invariants(self.scheduler, self.network)
+        self.items = items
+        self.stock = stock
+        self.sold = Counter()  # {item_id: unidades vendidas en compras confirmadas}
+        self.restocked = Counter()  # {item_id: unidades repuestas en reposiciones confirmadas}
+        self.propagations = []  # (duración virtual, confirmada) de cada propagate_inventory_update
+        base_port = 5000
+        # Bases en memoria: sin fsync por commit, y el estado de la simulación se descarta al terminar.
+        # El log de mensajes se confirma en el hilo de la tarea: un hilo escritor real por nodo
+        # se despertaría con cada mensaje y competiría por el GIL con el planificador
+        options = dict(heartbeat_interval=None, batch_window=0, anti_entropy_interval=0, archive_interval=None,
+                       db_flush_interval=None, log_level='WARNING')
+        options.update(node_options)
+        self.nodes = {}
+        for node_id in range(1, count + 1):
+            peers = {base_port + i: '127.0.0.1' for i in range(1, count + 1) if i != node_id}
+            node = Node(node_id, base_port + node_id, peers, node_ip='127.0.0.1', base_port=base_port,
+                        db_path=':memory:',
+                        transport=self.network, scheduler=self.scheduler, **options)
+            for item_id in range(items):
+                node.inventory.ensure(item_id, f"item-{item_id}", 1.0, stock)
+            if node.crdt is not None:
+                # Los contadores se sembraron al construir el nodo, con el catálogo aún vacío
+                node.crdt.seed()
+            self.network.attach(node)
+            self.invariants.watch(node)
+            self._time_propagation(node)
+            self.nodes[node_id] = node
+        escrow = [node for node in self.nodes.values() if node.purchase_mode == 'escrow']
+        if escrow:
+            # Los nodos piden la base del reparto al de menor id: hace falta la red simulada
+            for node in escrow:
+                self.scheduler.spawn(node.init_escrow)
+            self.scheduler.run()
+
+    def _time_propagation(self, node):
+        propagate = node.propagate_inventory_update
+
+        def timed(*args, **kwargs):
+            started = self.scheduler.now
+            ok = propagate(*args, **kwargs)
+            self.propagations.append((self.scheduler.now - started, ok))
+            return ok
+        node.propagate_inventory_update = timed
+
+    def live_nodes(self):
+        return [node for node in self.nodes.values() if node.port not in self.network.down]
+
+    def crash(self, node_id):
+        node = self.nodes[node_id]
+        self.network.crash(node.port)
+        self.invariants.crashed(node)
+
+    def remove(self, node_id):
+        """Baja acordada de un nodo (la decide un operador): los demás dejan de esperar su REPLY"""
+        port = self.nodes[node_id].port
+        for node in self.live_nodes():
+            node.remove_member(port)
+
+    def partition(self, start, duration):
+        """Divide el clúster en dos mitades durante `duration` s a partir de `start`"""
+        ports = sorted(self.network.nodes)
+        half = len(ports) // 2
+        self.scheduler.call_later(start - self.scheduler.now,
+                                  lambda: self.network.partition(ports[:half], ports[half:]))
+        self.scheduler.call_later(start + duration - self.scheduler.now, self.network.heal)
+
+    def run_workload(self, ops, rate, workload='purchase', timeout=5.0):
+        """
+        `ops` operaciones con llegadas Poisson de tasa `rate` (por s virtual), cada una en un
+        nodo vivo al azar: compras de una unidad ('purchase') o reposiciones de una unidad
+        ('update'), ambas dentro de la sección crítica del artículo.
+        Devuelve (latencias de las confirmadas, cantidad confirmada).
+        """
+        latencies = []
+        outcome = {'ok': 0}
+
+        def operation(node, item_id):
+            started = self.scheduler.now
+            if workload == 'purchase':
+                ok = node.purchase_items({item_id: 1}, timeout=timeout)
+            else:
+                # Un update_inventory suelto compite por la misma versión con los demás nodos
+                ok = node.restock(item_id, 1, timeout=timeout)
+            # Lo que confirma un nodo que ya se cayó no le llegó al cliente
+            if ok and node.port not in self.network.down:
+                outcome['ok'] += 1
+                (self.sold if workload == 'purchase' else self.restocked)[item_id] += 1
+                latencies.append(self.scheduler.now - started)
+
+        def arrive():
+            live = self.live_nodes()
+            if live:
+                self.scheduler.spawn(operation, self.rng.choice(live), self.rng.randrange(self.items))
+
+        at = self.scheduler.now
+        for _ in range(ops):
+            at += self.rng.expovariate(rate)
+            self.scheduler.call_later(at - self.scheduler.now, arrive)
+        self.scheduler.run()
+        return latencies, outcome['ok']
+
+    def settle(self, max_rounds=5):
+        """Rondas de sync_inventory en todos los nodos vivos hasta que las réplicas coinciden"""
+        for rounds in range(1, max_rounds + 1):
+            for node in self.live_nodes():
+                self.scheduler.spawn(node.sync_inventory)
+            self.scheduler.run()
+            if self.converged():
+                return rounds
+        return None
+
+    def quantities(self, node):
+        return [node.get_item_quantity(item_id) for item_id in range(self.items)]
+
+    def converged(self):
+        views = [self.quantities(node) for node in self.live_nodes()]
+        return all(view == views[0] for view in views)
+
+    def check(self):
+        """Invariantes al final de la corrida"""
+        live = self.live_nodes()
+        oversold = {item_id: sold for item_id, sold in self.sold.items()
+                    if sold > self.stock + self.restocked[item_id]}
+        negative = sorted({node.id_node for node in live if any(q < 0 for q in self.quantities(node))})
+        result = {
+            'mutual_exclusion': not self.invariants.violations,
+            'critical_sections': self.invariants.entries,
+            'violations': self.invariants.violations[:10],
+            'no_oversell': not oversold and not negative,
+            'passed': False,
+            'oversold_items': oversold,
+            'negative_stock_nodes': negative,
+            'replicas_converged': self.converged(),
+        }
+        if live and live[0].purchase_mode == 'escrow':
+            # Cada unidad está en la cuota de un nodo o ya se vendió; nunca en dos lados
+            shares = Counter()
+            for node in self.nodes.values():
+                for item_id, share in node.escrow.items():
+                    shares[item_id] += share
+            result['escrow_conserved'] = all(
+                shares[item_id] + self.sold[item_id] <= self.stock + self.restocked[item_id]
+                for item_id in range(self.items)
+            )
+            consistent = result['escrow_conserved']
+        else:
+            expected = [self.stock - self.sold[item_id] + self.restocked[item_id] for item_id in range(self.items)]
+            view = self.quantities(live[0]) if live else expected
+            # Diferencia entre el stock esperado por las ventas confirmadas y el de las réplicas:
+            # > 0 quedaron descuentos sin venta (un rollback que no se difundió),
+            # < 0 se perdieron ventas confirmadas (una versión vieja pisó a una nueva)
+            result['stock_drift'] = sum(e - q for e, q in zip(expected, view))
+            # Unidades vendidas que siguen en stock también son una sobreventa
+            result['no_oversell'] = result['no_oversell'] and result['stock_drift'] >= 0
+            consistent = result['stock_drift'] == 0
+        result['passed'] = (result['mutual_exclusion'] and result['no_oversell']
+                            and result['replicas_converged'] and consistent)
+        return result
+
+    def close(self):
+        for node in self.nodes.values():
+            node.shutdown()
+        self.scheduler.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Deterministic virtual-time simulation of the inventory cluster")
+    parser.add_argument('--nodes', type=int, default=50)
+    parser.add_argument('--ops', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=20.0, help="Operations per simulated second")
+    parser.add_argument('--workload', choices=('purchase', 'update'), default='purchase',
+                        help="purchase: buy one unit; update: restock one unit (both under the item lock)")
+    parser.add_argument('--items', type=int, default=16)
+    parser.add_argument('--stock', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, nargs=2, default=(0.5, 5.0), metavar=('MIN_MS', 'MAX_MS'))
+    parser.add_argument('--drop', type=float, default=0.0, help="Probability of losing each message")
+    parser.add_argument('--partition', metavar='START:DURATION',
+                        help="Split the cluster in two halves at START for DURATION simulated seconds")
+    parser.add_argument('--crash', type=int, default=0, help="Nodes crashed halfway through the workload")
+    parser.add_argument('--remove-after', type=float, default=1.0,
+                        help="Simulated seconds until crashed nodes are removed from the membership; "
+                             "until then purchases that need their REPLY fail")
+    parser.add_argument('--timeout', type=float, default=5.0)
+    parser.add_argument('--purchase-mode', choices=('lock', 'escrow'), default='lock')
+    parser.add_argument('--replication', choices=('version', 'crdt'), default='version')
+    parser.add_argument('--dissemination', choices=('direct', 'gossip', 'tree'), default='direct',
+                        help="How inventory updates spread; gossip and tree still confirm on a majority of receipts")
+    parser.add_argument('--fanout', type=int, default=3)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', help="Write the JSON report to this file as well")
+    args = parser.parse_args(argv)
+
+    wall_started = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        sim = Simulation(
+            args.nodes, seed=args.seed, latency=(args.latency[0] / 1000, args.latency[1] / 1000),
+            drop_rate=args.drop, items=args.items, stock=args.stock, purchase_mode=args.purchase_mode,
+            replication=args.replication, dissemination=args.dissemination, fanout=args.fanout,
+            log_level=args.log_level
+        )
+        try:
+            if args.partition:
+                start, duration = (float(x) for x in args.partition.split(':'))
+                sim.partition(start, duration)
+            if args.crash:
+                victims = sim.rng.sample(sorted(sim.nodes), args.crash)
+                at = args.ops / args.rate / 2
+                for node_id in victims:
+                    sim.scheduler.call_later(at, lambda node_id=node_id: sim.crash(node_id))
+                    sim.scheduler.call_later(at + args.remove_after, lambda node_id=node_id: sim.remove(node_id))
+            latencies, ok = sim.run_workload(args.ops, args.rate, args.workload, args.timeout)
+            workload_time = sim.scheduler.now
+            traffic = sim.network.totals()
+            sim.network.heal()
+            settle_rounds = sim.settle()
+            settle_traffic = sim.network.totals()
+            invariants = sim.check()
+        finally:
+            sim.close()
+    wall_time = time.perf_counter() - wall_started
+
+    quorum_times = [duration for duration, confirmed in sim.propagations if confirmed]
+    report = {
+        'config': vars(args),
+        'simulated_s': round(sim.scheduler.now, 3),
+        'wall_s': round(wall_time, 3),
+        'speedup': round(sim.scheduler.now / wall_time, 1) if wall_time else None,
+        'task_switches': sim.scheduler.switches,
+        'workload': {
+            'ops': args.ops,
+            'ok': ok,
+            'failed': args.ops - ok,
+            'simulated_s': round(workload_time, 3),
+            'latency_ms': _latency_summary(latencies),
+        },
+        'messages': {
+            'total': traffic['messages'],
+            'per_op': round(traffic['messages'] / args.ops, 2) if args.ops else None,
+            'bytes_per_op': round(traffic['bytes'] / args.ops, 1) if args.ops else None,
+            'by_type': traffic['by_type'],
+            'dropped': traffic['dropped'],
+            'refused': traffic['refused'],
+        },
+        'quorum': {
+            'propagations': len(sim.propagations),
+            'confirmed': len(quorum_times),
+            'time_to_quorum_ms': _latency_summary(quorum_times),
+        },
+        'settle': {
+            'rounds': settle_rounds,
+            'messages': settle_traffic['messages'] - traffic['messages'],
+        },
+        'invariants': invariants,
+    }
+    text = json.dumps(report, indent=2, default=str)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    return report
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main()['invariants']['passed'] else 1)
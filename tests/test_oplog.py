@@ -0,0 +1,158 @@
+"""Pruebas del log replicado de operaciones (replication='log')"""
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import find_base_port
+from nodes import Node, OperationLog, Storage
+
+
+def op(request_id, item_id=1, quantity=1):
+    return {'op': 'purchase', 'order': [[item_id, quantity]], 'request_id': request_id}
+
+
+class OperationLogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.dir.name, 'log.db')
+        self.storage = self._storage()
+
+    def tearDown(self):
+        self.storage.close()
+        self.dir.cleanup()
+
+    def _storage(self):
+        storage = Storage(self.db, flush_interval=None)
+        with storage.transaction() as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS op_log (idx INTEGER PRIMARY KEY, term INTEGER NOT NULL, op TEXT NOT NULL)")
+            cursor.execute("CREATE TABLE IF NOT EXISTS op_log_state (key TEXT PRIMARY KEY, value INTEGER)")
+            cursor.execute("CREATE TABLE IF NOT EXISTS op_log_applied "
+                           "(request_id TEXT PRIMARY KEY, idx INTEGER NOT NULL, result INTEGER)")
+        return storage
+
+    def _reload(self):
+        self.storage.close()
+        self.storage = self._storage()
+        log = OperationLog(self.storage)
+        log.load()
+        return log
+
+    def test_merge_skips_matching_entries(self):
+        log = OperationLog(self.storage)
+        log.merge(0, [[1, op('a')], [1, op('b')]])
+        self.assertEqual(log.merge(0, [[1, op('a')], [1, op('b')]]), 2)
+        self.assertEqual(log.merge(1, [[1, op('b')]]), 2)
+        self.assertEqual([entry['request_id'] for _, entry in log.entries], ['a', 'b'])
+        self.assertEqual(log.persisted, 2)
+
+    def test_merge_truncates_conflicting_suffix(self):
+        log = OperationLog(self.storage)
+        log.merge(0, [[1, op('a')], [1, op('b')], [1, op('c')]])
+        self.assertEqual(log.merge(1, [[2, op('x')]]), 2)
+        # Una entrada con otro término descarta esa entrada y todas las siguientes
+        self.assertEqual([(term, entry['request_id']) for term, entry in log.entries], [(1, 'a'), (2, 'x')])
+        log = self._reload()
+        self.assertEqual([(term, entry['request_id']) for term, entry in log.entries], [(1, 'a'), (2, 'x')])
+        self.assertEqual(log.term_at(2), 2)
+        self.assertEqual(log.term_at(3), 0)
+
+    def test_restart_restores_state(self):
+        log = OperationLog(self.storage)
+        log.append(3, [op('a'), op('b')])
+        log.flush()
+        log.save_vote(3, 7)
+        with self.storage.transaction():
+            log.record_applied('a', 1, True)
+            log.mark_applied(1)
+        log = self._reload()
+        self.assertEqual((log.last_index, log.persisted, log.last_applied), (2, 2, 1))
+        self.assertEqual((log.term, log.voted_for), (3, 7))
+        self.assertEqual(log.applied_result('a'), (True, 1))
+        self.assertEqual(log.applied_result('b'), (False, None))
+
+    def test_load_backfills_applied_requests(self):
+        # Base anterior a op_log_applied: lo aplicado se reconoce aunque no tenga resultado
+        log = OperationLog(self.storage)
+        log.append(1, [op('a'), op('b')])
+        log.flush()
+        with self.storage.transaction():
+            log.mark_applied(1)
+        log = self._reload()
+        self.assertEqual(log.applied_result('a'), (True, None))
+        self.assertEqual(log.applied_result('b'), (False, None))
+
+
+class ReplicatedLogNodeTest(unittest.TestCase):
+    """Un nodo solo, líder de su propio log, sobre una base que sobrevive a los reinicios"""
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.dir.name, 'node.db')
+        self.node = None
+
+    def tearDown(self):
+        if self.node is not None:
+            self.node.shutdown()
+        self.dir.cleanup()
+
+    def _start(self):
+        if self.node is not None:
+            self.node.shutdown()
+        base = find_base_port(1)
+        ready = threading.Event()
+        self.node = Node(0, base, {}, node_ip='127.0.0.1', base_port=base, server_ready_event=ready,
+                         db_path=self.db, heartbeat_interval=None, archive_interval=None,
+                         log_level='WARNING', replication='log', election_timeout=0.1)
+        threading.Thread(target=self.node.start_server, daemon=True).start()
+        ready.wait()
+        self.node.inventory.ensure(1, 'item', 1.0, 10)
+        self._wait(lambda: self.node.log_status()['role'] == 'leader')
+        return self.node
+
+    def _wait(self, predicate, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() > deadline:
+                self.fail("timeout")
+            time.sleep(0.01)
+
+    def _submit(self, *ops):
+        """Agrega operaciones como lo haría un LOG_SUBMIT reenviado y espera a que se apliquen"""
+        node = self.node
+        target = node.oplog.last_index + len(ops)
+        node.handle_log_submit({'type': 'LOG_SUBMIT', 'ops': list(ops), 'origin': 1})
+        self._wait(lambda: node.oplog.last_applied >= target)
+
+    def test_duplicate_submit_applies_once(self):
+        node = self._start()
+        self._submit(op('r1', quantity=3), op('r1', quantity=3))
+        self._submit(op('r1', quantity=3))
+        self.assertEqual(node.inventory.quantity(1), 7)
+        # También cuando el request_id ya salió de la caché en memoria
+        node._applied_requests.clear()
+        self._submit(op('r1', quantity=3))
+        self.assertEqual(node.inventory.quantity(1), 7)
+
+    def test_restart_replays_nothing_twice(self):
+        node = self._start()
+        self.assertEqual(node.purchase_items({1: 4}), True)
+        self._submit(op('r1', quantity=2))
+        applied = node.oplog.last_applied
+        node = self._start()
+        # Lo aplicado antes del reinicio sigue aplicado; el nuevo líder sólo agrega su noop
+        self.assertGreaterEqual(node.oplog.last_applied, applied)
+        self.assertEqual({entry['op'] for _, entry in node.oplog.entries[applied:]} - {'noop'}, set())
+        self.assertEqual(node.inventory.quantity(1), 4)
+        # Un reintento que llega después del reinicio no se aplica de nuevo
+        self._submit(op('r1', quantity=2))
+        self.assertEqual(node.inventory.quantity(1), 4)
+        self.assertEqual(node.purchase_items({1: 1}), True)
+        self.assertEqual(node.inventory.quantity(1), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()